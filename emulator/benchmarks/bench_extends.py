@@ -0,0 +1,88 @@
+"""
+Measure how extends resolution scales with the number of jobs and the depth of template chains
+
+usage: python3 benchmarks/bench_extends.py [--jobs 100 500 2000] [--depth 1 5 10] [--memory]
+
+--memory also reports the peak memory allocated while resolving extends, measured with tracemalloc in a separate
+untimed run
+"""
+import argparse
+import copy
+import time
+import tracemalloc
+from typing import Dict, Any
+
+from gitlabemu.configloader import do_extends
+
+
+def make_config(jobs: int, depth: int) -> Dict[str, Any]:
+    """Make a pipeline where every job extends the end of a chain of templates"""
+    config = {
+        "variables": {"COLOR": "red"},
+        "default": {"image": "alpine:latest", "before_script": ["echo default"]},
+    }
+    for level in range(depth):
+        template = {
+            "variables": {f"LEVEL_{level}": str(level)},
+            "script": [f"echo level {level}"] * 10,
+            "tags": ["linux"],
+        }
+        if level > 0:
+            template["extends"] = f".template-{level - 1}"
+        config[f".template-{level}"] = template
+    for index in range(jobs):
+        config[f"job-{index}"] = {
+            "extends": f".template-{depth - 1}",
+            "variables": {"INDEX": str(index)},
+        }
+    return config
+
+
+def measure(jobs: int, depth: int, repeat: int) -> float:
+    config = make_config(jobs, depth)
+    best = None
+    for _ in range(repeat):
+        data = copy.deepcopy(config)
+        started = time.perf_counter()
+        do_extends(data)
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def measure_memory(jobs: int, depth: int) -> int:
+    """Get the peak bytes allocated by do_extends, not counting the config it starts with"""
+    data = copy.deepcopy(make_config(jobs, depth))
+    tracemalloc.start()
+    try:
+        do_extends(data)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, nargs="+", default=[100, 500, 2000])
+    parser.add_argument("--depth", type=int, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--memory", action="store_true", default=False)
+    opts = parser.parse_args()
+
+    header = f"{'jobs':>8} {'depth':>6} {'seconds':>10} {'us/job':>10}"
+    if opts.memory:
+        header += f" {'peak KiB':>10}"
+    print(header)
+    for jobs in opts.jobs:
+        for depth in opts.depth:
+            elapsed = measure(jobs, depth, opts.repeat)
+            line = f"{jobs:>8} {depth:>6} {elapsed:>10.4f} {1000000 * elapsed / jobs:>10.1f}"
+            if opts.memory:
+                line += f" {measure_memory(jobs, depth) // 1024:>10}"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Measure how fast job output passes through communicate() for shell jobs and, if docker is available, docker jobs
+
+usage: python3 benchmarks/bench_output.py [--megabytes 64] [--line-length 80 1000] [--batch 65536 262144]
+                                          [--runner thread async] [--docker-image alpine:latest] [--joblog]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List
+
+from gitlabemu import helpers
+from gitlabemu.aiorunner import popen
+from gitlabemu.helpers import communicate
+from gitlabemu.joblogs import JobLog
+
+
+class NullOutput:
+    """Discard output, like a terminal that is infinitely fast"""
+    encoding = "utf-8"
+
+    def write(self, text: str) -> int:
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+
+def shell_command(megabytes: int, line_length: int) -> List[str]:
+    """A command that prints about this many megabytes of lines"""
+    script = (f"import sys\n"
+              f"line = b'x' * {line_length - 1} + b'\\n'\n"
+              f"block = line * max(1, 65536 // len(line))\n"
+              f"for _ in range({megabytes} * 1048576 // len(block)):\n"
+              f"    sys.stdout.buffer.write(block)\n")
+    return [sys.executable, "-c", script]
+
+
+def docker_command(image: str, megabytes: int, line_length: int) -> List[str]:
+    """A docker job that prints about this many megabytes of lines"""
+    script = f"yes $(head -c {line_length - 1} /dev/zero | tr '\\0' x) | head -c {megabytes * 1048576}"
+    return ["docker", "run", "--rm", "-i", image, "sh", "-c", script]
+
+
+def measure(cmd: List[str], megabytes: int, repeat: int, runner: str, joblog: bool) -> float:
+    """Run the command and return the best MB/s seen"""
+    best = None
+    for _ in range(repeat):
+        if runner == "async":
+            proc = popen(cmd)
+        else:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        with tempfile.TemporaryDirectory() as temp:
+            log = JobLog(os.path.join(temp, "bench.log.gz")) if joblog else None
+            started = time.perf_counter()
+            communicate(proc, stdout=NullOutput(), joblog=log)
+            if log:
+                log.close()
+            elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return megabytes / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--megabytes", type=int, default=64)
+    parser.add_argument("--line-length", type=int, nargs="+", default=[80, 1000])
+    parser.add_argument("--batch", type=int, nargs="+", default=[helpers.OUTPUT_CHUNK_SIZE,
+                                                                 helpers.DEFAULT_OUTPUT_BATCH])
+    parser.add_argument("--runner", type=str, nargs="+", choices=["thread", "async"], default=["thread", "async"])
+    parser.add_argument("--docker-image", type=str, default="alpine:latest")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--joblog", default=False, action="store_true",
+                        help="Also save the output to a job log")
+    opts = parser.parse_args()
+
+    kinds = ["shell"]
+    if shutil.which("docker"):
+        subprocess.call(["docker", "pull", "-q", opts.docker_image], stdout=subprocess.DEVNULL)
+        kinds.append("docker")
+
+    print(f"{'job':>8} {'runner':>7} {'line':>6} {'batch':>8} {'MB/s':>10}")
+    for kind in kinds:
+        for line_length in opts.line_length:
+            if kind == "shell":
+                cmd = shell_command(opts.megabytes, line_length)
+            else:
+                cmd = docker_command(opts.docker_image, opts.megabytes, line_length)
+            for runner in opts.runner:
+                for batch in opts.batch:
+                    os.environ[helpers.OUTPUT_BATCH_ENV] = str(batch)
+                    rate = measure(cmd, opts.megabytes, opts.repeat, runner, opts.joblog)
+                    print(f"{kind:>8} {runner:>7} {line_length:>6} {batch:>8} {rate:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
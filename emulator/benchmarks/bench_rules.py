@@ -0,0 +1,70 @@
+"""
+Compare the native and antlr rule engines
+
+Measures the time to parse and compile a rule (with the caches cleared), to evaluate
+an already compiled rule and to import each engine in a fresh interpreter.
+
+usage: python3 benchmarks/bench_rules.py [--repeat 2000]
+"""
+import argparse
+import subprocess
+import sys
+import time
+
+from gitlabemu import ruleengine, ruleparser
+
+RULES = [
+    '$CI_COMMIT_BRANCH == "main"',
+    '$CI_MERGE_REQUEST_ID || $CI_COMMIT_TAG',
+    '($CI_COMMIT_BRANCH == "main" || $CI_COMMIT_TAG) && $CI_PIPELINE_SOURCE =~ /push|web/',
+    '$BUILD_TYPE != "release" && $PLATFORM !~ /^win/ && $SKIP_TESTS == ""',
+]
+
+VARIABLES = {
+    "CI_COMMIT_BRANCH": "main",
+    "CI_PIPELINE_SOURCE": "push",
+    "PLATFORM": "linux",
+    "BUILD_TYPE": "debug",
+}
+
+ENGINES = {
+    "native": (ruleengine.compile_native_rule, "gitlabemu.ruleengine"),
+    "antlr": (ruleparser.compile_rule, "gitlabemu.ruleparser"),
+}
+
+
+def compile_uncached(engine: str, rule: str):
+    if engine == "native":
+        return ruleengine.RuleParser(rule).parse()
+    ruleparser.compile_rule.cache_clear()
+    return ruleparser.compile_rule(rule)
+
+
+def per_call(func, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat * 1e6
+
+
+def import_time(module: str) -> float:
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    output = subprocess.check_output([sys.executable, "-c", code], encoding="utf-8")
+    return float(output) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=2000)
+    opts = parser.parse_args()
+
+    print(f"{'engine':>8} {'compile us':>12} {'evaluate us':>12} {'import ms':>10}")
+    for engine, (compile_cached, module) in ENGINES.items():
+        compile_us = sum(per_call(lambda: compile_uncached(engine, rule), opts.repeat) for rule in RULES) / len(RULES)
+        compiled = [compile_cached(rule) for rule in RULES]
+        evaluate_us = sum(per_call(lambda: func(VARIABLES), opts.repeat) for func in compiled) / len(compiled)
+        print(f"{engine:>8} {compile_us:12.2f} {evaluate_us:12.2f} {import_time(module):10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+"""
+Run job processes on one shared asyncio event loop, so that running jobs do not each need
+threads to read their output, enforce their timeouts or abort them
+"""
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Optional, List, Dict, Any, Coroutine
+
+from .errors import GitlabEmulatorError
+from .helpers import OUTPUT_CHUNK_SIZE, new_process_group
+from .logmsg import debug
+from .variables import truth_string
+
+ASYNC_RUNNER_ENV = "GLE_ASYNC_RUNNER"
+ABORT_GRACE_ENV = "GLE_ABORT_GRACE"
+# asyncio.get_running_loop() and child watchers that work outside the main thread
+ASYNC_RUNNER_MIN_PYTHON = (3, 8)
+# how often the pretty mode spinner is redrawn
+FRONTEND_INTERVAL = 0.5
+# how long an aborted process has to exit before it is killed
+DEFAULT_ABORT_GRACE = 10
+STOP_POLL_INTERVAL = 0.05
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_thread: Optional[threading.Thread] = None
+_loop_lock = threading.Lock()
+
+
+def async_runner_enabled() -> bool:
+    """Return True unless GLE_ASYNC_RUNNER is set to something false or python is too old for it"""
+    if sys.version_info < ASYNC_RUNNER_MIN_PYTHON:
+        return False
+    value = os.environ.get(ASYNC_RUNNER_ENV, "")
+    return not value or truth_string(value)
+
+
+def _run_loop(loop: asyncio.AbstractEventLoop) -> None:
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """
+    Get the shared event loop, starting the thread that runs it the first time
+    :return:
+    """
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None or _loop_thread is None or not _loop_thread.is_alive():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_run_loop, args=(loop,), name="gle-asyncio", daemon=True)
+            # raises RuntimeError if we can't have threads
+            thread.start()
+            _loop = loop
+            _loop_thread = thread
+        return _loop
+
+
+def run_coroutine(coro: Coroutine, timeout: Optional[float] = None) -> Any:
+    """
+    Run a coroutine on the shared loop and wait for its result
+    :param coro: the coroutine
+    :param timeout: if set, raise concurrent.futures.TimeoutError if it has not finished after this many seconds
+    :return:
+    """
+    loop = get_loop()
+    if threading.current_thread() is _loop_thread:
+        coro.close()
+        raise GitlabEmulatorError("cannot wait for the event loop from one of its own tasks")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+
+def get_abort_grace() -> float:
+    """Get how many seconds an aborted job has to exit after SIGTERM before it is killed, set by GLE_ABORT_GRACE"""
+    value = os.environ.get(ABORT_GRACE_ENV, "")
+    try:
+        grace = float(value) if value else DEFAULT_ABORT_GRACE
+    except ValueError:
+        grace = DEFAULT_ABORT_GRACE
+    return max(grace, 0)
+
+
+def process_group(pid: int) -> Optional[int]:
+    """Return the process group of a process if it leads its own group, else None"""
+    if not hasattr(os, "killpg"):  # pragma: cover if windows
+        return None
+    try:
+        group = os.getpgid(pid)
+    except (ProcessLookupError, PermissionError):
+        return None
+    if group == pid and group != os.getpgrp():
+        return group
+    return None
+
+
+def group_alive(group: Optional[int]) -> bool:
+    """Return True if anything in the process group is still running"""
+    if group is None:
+        return False
+    try:
+        os.killpg(group, 0)
+        return True
+    except (ProcessLookupError, PermissionError):
+        return False
+
+
+def send_signal(process, group: Optional[int], sig: int) -> None:
+    """Signal the process group if the process has one, else just the process"""
+    try:
+        if group is not None:
+            os.killpg(group, sig)
+        elif process.poll() is None:
+            if hasattr(os, "killpg"):
+                os.kill(process.pid, sig)
+            elif sig == signal.SIGTERM:  # pragma: cover if windows
+                process.terminate()
+            else:  # pragma: cover if windows
+                process.kill()
+    except ProcessLookupError:
+        pass
+
+
+def stopped(process, group: Optional[int]) -> bool:
+    return process.poll() is not None and not group_alive(group)
+
+
+async def escalate(process, grace: float) -> None:
+    """
+    Send SIGTERM to a process and its process group, then SIGKILL to whatever is left after grace seconds
+    :param process: a Popen or AsyncProcess
+    :param grace: seconds to wait
+    :return:
+    """
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + grace
+    group = process_group(process.pid)
+    send_signal(process, group, signal.SIGTERM)
+    while not stopped(process, group) and loop.time() < deadline:
+        await asyncio.sleep(STOP_POLL_INTERVAL)
+    if not stopped(process, group):
+        debug(f"process {process.pid} is still running {grace} sec after SIGTERM, killing it")
+        send_signal(process, group, getattr(signal, "SIGKILL", signal.SIGTERM))
+
+
+def stop_process(process, grace: Optional[float] = None) -> None:
+    """
+    Stop a process and everything in its process group, waiting for it to exit
+    :param process: a Popen or AsyncProcess
+    :param grace: seconds to wait after SIGTERM before sending SIGKILL, GLE_ABORT_GRACE if not set
+    :return:
+    """
+    if grace is None:
+        grace = get_abort_grace()
+    run_coroutine(escalate(process, grace))
+    process.wait()
+
+
+def wait_for_exit(process, timeout: float) -> bool:
+    """
+    Wait for a Popen-like process to exit
+    :param process: the process
+    :param timeout: seconds to wait
+    :return: False if it is still running
+    """
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        pass
+    return process.poll() is not None
+
+
+class AsyncProcess:
+    """A Popen-like view of a process started on the shared event loop"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, process: asyncio.subprocess.Process, args: List[str]):
+        self.loop = loop
+        self.process = process
+        self.args = args
+        self.stdin = process.stdin
+        self.stdout = process.stdout
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self.process.returncode
+
+    def poll(self) -> Optional[int]:
+        return self.process.returncode
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        try:
+            return run_coroutine(self.process.wait(), timeout)
+        except FutureTimeoutError:
+            raise subprocess.TimeoutExpired(self.args, timeout)
+
+    def _signal(self, method: str) -> None:
+        if self.process.returncode is None:
+            try:
+                getattr(self.process, method)()
+            except ProcessLookupError:  # pragma: no cover
+                pass
+
+    def terminate(self) -> None:
+        self.loop.call_soon_threadsafe(self._signal, "terminate")
+
+    def kill(self) -> None:
+        self.loop.call_soon_threadsafe(self._signal, "kill")
+
+    def communicate(self, writer, script: Optional[bytes] = None) -> None:
+        """
+        Send the script to stdin and copy output to the writer until the process exits
+        :param writer: a ProcessLineProxyThread (which is not started) used to decode and write the output
+        :param script: bytes for stdin
+        :return:
+        """
+        run_coroutine(communicate_async(self.process, writer, script))
+
+
+async def start_process(cmdline: List[str],
+                        env: Optional[Dict[str, str]] = None,
+                        cwd: Optional[str] = None,
+                        stdin=subprocess.DEVNULL,
+                        new_group: bool = False) -> asyncio.subprocess.Process:
+    """Start a process with stdout and stderr going to one pipe"""
+    group = new_process_group() if new_group else {}
+    return await asyncio.create_subprocess_exec(*cmdline,
+                                                env=env,
+                                                cwd=cwd,
+                                                stdin=stdin,
+                                                stdout=subprocess.PIPE,
+                                                stderr=subprocess.STDOUT,
+                                                limit=OUTPUT_CHUNK_SIZE,
+                                                **group)
+
+
+def popen(cmdline: List[str],
+          env: Optional[Dict[str, str]] = None,
+          cwd: Optional[str] = None,
+          stdin=subprocess.DEVNULL,
+          new_group: bool = False) -> AsyncProcess:
+    """
+    Start a process on the shared loop
+    :param cmdline: the command and its arguments
+    :param env: the environment, or None to inherit ours
+    :param cwd: the working directory
+    :param stdin: subprocess.PIPE to be able to send it a script, else subprocess.DEVNULL
+    :param new_group: if True, start it in its own process group (on posix) so that stopping it stops its children
+    :return:
+    """
+    loop = get_loop()
+    process = run_coroutine(start_process(cmdline, env=env, cwd=cwd, stdin=stdin, new_group=new_group))
+    return AsyncProcess(loop, process, cmdline)
+
+
+async def feed_stdin(stdin: asyncio.StreamWriter, script: Optional[bytes]) -> None:
+    """Write the script to the process and close its stdin"""
+    try:
+        if script:
+            stdin.write(script)
+            await stdin.drain()
+        stdin.close()
+    except (BrokenPipeError, ConnectionResetError):
+        # the process exited without reading it all
+        pass
+
+
+async def pump_output(stream: asyncio.StreamReader, writer) -> None:
+    """
+    Copy output to the writer until the end of the stream. Output is written once the batch is full or
+    the process has stopped printing for now, and is not read while it is being written.
+    :param stream: the process stdout
+    :param writer: the ProcessLineProxyThread that decodes and writes it
+    :return:
+    """
+    loop = asyncio.get_event_loop()
+    writing = None
+    batch = []
+    batched = 0
+    while True:
+        data = await stream.read(OUTPUT_CHUNK_SIZE)
+        batch.append(writer.decoder.decode(data, not data))
+        batched += len(data)
+        if data:
+            writer.log_output(data)
+            if writer.linehandler:
+                writer.handle_lines(data)
+        # write once the batch is full or we have read everything the job has printed so far
+        if not data or batched >= writer.batch_size or len(data) < OUTPUT_CHUNK_SIZE:
+            if writing is not None:
+                # only one batch is written at a time
+                await writing
+                writing = None
+            text = "".join(batch)
+            batch.clear()
+            batched = 0
+            if text:
+                # writing may block on a slow terminal, so keep it off the loop
+                writing = loop.run_in_executor(None, writer.flush_text, text)
+        if not data:
+            break
+    if writing is not None:
+        await writing
+    if writer.linehandler:
+        writer.handle_lines(b"", final=True)
+
+
+async def run_frontend(writer) -> None:
+    """Redraw the pretty mode status line until cancelled"""
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(FRONTEND_INTERVAL)
+        await loop.run_in_executor(None, writer.frontend_once)
+
+
+async def communicate_async(process: asyncio.subprocess.Process, writer, script: Optional[bytes] = None) -> None:
+    """Send the script to stdin and copy output to the writer until the process exits"""
+    tasks = []
+    if process.stdin is not None:
+        tasks.append(asyncio.ensure_future(feed_stdin(process.stdin, script)))
+    if hasattr(writer, "frontend_once"):
+        tasks.append(asyncio.ensure_future(run_frontend(writer)))
+    try:
+        await pump_output(process.stdout, writer)
+        await process.wait()
+    except Exception as err:  # pragma: no cover
+        writer.errors.append(err)
+        raise
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
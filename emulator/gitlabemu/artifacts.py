@@ -18,7 +18,7 @@ class GitlabArtifacts:
         self.name = data.get("name", self.name)
         self.public = data.get("public", self.public)
         self.untracked = data.get("untracked", self.untracked)
-        self.reports = data.get("reports", {})
+        self.reports = dict(data.get("reports", {}))
         self.when = data.get("when", self.when)
 
         if isinstance(self.reports.get("junit", []), str):
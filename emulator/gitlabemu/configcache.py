@@ -0,0 +1,220 @@
+"""
+Persistent on-disk caches of loaded pipeline configurations and downloaded include files
+"""
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+from typing import Dict, Any, Optional, List
+
+import requests
+
+from .logmsg import debug, warning
+from .userconfig import USER_CFG_DIR
+
+CACHE_DIR_ENV = "GLE_CACHE_DIR"
+CACHE_FORMAT = 1
+
+
+def get_cache_dir() -> str:
+    """Get the folder used to store cached data"""
+    folder = os.environ.get(CACHE_DIR_ENV, None)
+    if not folder:
+        folder = os.path.join(USER_CFG_DIR, ".gle", "cache")
+    return folder
+
+
+def atomic_write(path: str, data: bytes) -> None:
+    """Replace the content of path with data such that readers never see a partial file"""
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as outfile:
+            outfile.write(data)
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp):
+            os.unlink(temp)
+
+
+def file_digest(filename: str) -> Optional[str]:
+    """Return the sha256 hex digest of a file or None if it cannot be read"""
+    hasher = hashlib.sha256()
+    try:
+        with open(filename, "rb") as fd:
+            while True:
+                chunk = fd.read(65536)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+    except OSError:
+        return None
+    return hasher.hexdigest()
+
+
+class PipelineCache:
+    """
+    Store the resolved configuration of a pipeline keyed on its root file and the
+    inputs that change how it is loaded. Each entry records the content hash of every
+    file that contributed to it and is discarded if any of them change.
+    """
+
+    def __init__(self, folder: Optional[str] = None):
+        if folder is None:
+            folder = os.path.join(get_cache_dir(), "pipelines")
+        self.folder = folder
+
+    @staticmethod
+    def entry_key(filename: str, inputs: Dict[str, Any]) -> str:
+        """Compute the key for a pipeline file loaded with the given inputs"""
+        hasher = hashlib.sha256()
+        hasher.update(os.path.abspath(filename).encode("utf-8"))
+        for name in sorted(inputs.keys()):
+            hasher.update(b"\0")
+            hasher.update(str(name).encode("utf-8"))
+            hasher.update(b"=")
+            hasher.update(repr(inputs[name]).encode("utf-8"))
+        return hasher.hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.folder, key + ".pickle")
+
+    def get(self, filename: str, inputs: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Return the cached data for this pipeline if all of its source files are unchanged
+        :param filename: the top level pipeline file
+        :param inputs: other values that affect loading, eg variables used by include rules
+        :return:
+        """
+        path = self.entry_path(self.entry_key(filename, inputs))
+        try:
+            with open(path, "rb") as fd:
+                entry = pickle.load(fd)
+        except FileNotFoundError:
+            return None
+        except Exception as err:
+            debug(f"ignoring unreadable pipeline cache {path}: {err}")
+            return None
+
+        if not isinstance(entry, dict) or entry.get("format") != CACHE_FORMAT:
+            return None
+
+        for source, digest in entry.get("files", {}).items():
+            if file_digest(source) != digest:
+                debug(f"pipeline cache for {filename} is stale, {source} has changed")
+                return None
+        debug(f"loaded {filename} from pipeline cache")
+        return entry.get("data")
+
+    def put(self, filename: str, inputs: Dict[str, Any], files: List[str], data: Dict[str, Any]) -> None:
+        """
+        Save the loaded data for this pipeline
+        :param filename: the top level pipeline file
+        :param inputs: other values that affect loading, eg variables used by include rules
+        :param files: all the files that were read to produce data
+        :param data: the loaded pipeline data to save
+        :return:
+        """
+        digests = {}
+        for source in files:
+            digest = file_digest(source)
+            if digest is None:
+                return
+            digests[os.path.abspath(source)] = digest
+        entry = {
+            "format": CACHE_FORMAT,
+            "files": digests,
+            "data": data,
+        }
+        path = self.entry_path(self.entry_key(filename, inputs))
+        try:
+            atomic_write(path, pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception as err:
+            debug(f"could not save pipeline cache {path}: {err}")
+
+    def clear(self) -> None:
+        """Remove all cached pipelines"""
+        if os.path.isdir(self.folder):
+            for item in os.listdir(self.folder):
+                if item.endswith(".pickle"):
+                    os.unlink(os.path.join(self.folder, item))
+
+
+class IncludeCache:
+    """
+    Store downloaded include files and re-validate them with the server using
+    ETag and Last-Modified headers. If the server can't be reached the last
+    downloaded copy is used instead.
+    """
+
+    def __init__(self, folder: Optional[str] = None):
+        if folder is None:
+            folder = os.path.join(get_cache_dir(), "includes")
+        self.folder = folder
+
+    def entry_path(self, url: str, params: Optional[Dict[str, str]] = None) -> str:
+        hasher = hashlib.sha256()
+        hasher.update(url.encode("utf-8"))
+        hasher.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+        return os.path.join(self.folder, hasher.hexdigest() + ".json")
+
+    def get_entry(self, path: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path, "r", encoding="utf-8") as fd:
+                entry = json.load(fd)
+            if isinstance(entry, dict) and "content" in entry:
+                return entry
+        except FileNotFoundError:
+            pass
+        except Exception as err:
+            debug(f"ignoring unreadable include cache {path}: {err}")
+        return None
+
+    def fetch(self,
+              session: requests.Session,
+              url: str,
+              params: Optional[Dict[str, str]] = None,
+              timeout: Optional[float] = None) -> str:
+        """
+        Get the text content of url, using the cached copy if it is still current
+        :param session: the requests session to use
+        :param url:
+        :param params: query parameters
+        :param timeout: request timeout in seconds
+        :return:
+        """
+        path = self.entry_path(url, params)
+        entry = self.get_entry(path)
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        try:
+            resp = session.get(url, params=params, headers=headers, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as err:
+            if entry is None:
+                raise
+            warning(f"could not fetch {url}, using cached copy: {err}")
+            return entry["content"]
+
+        if resp.status_code == 304 and entry is not None:
+            debug(f"include {url} not modified")
+            return entry["content"]
+        resp.raise_for_status()
+        content = resp.text
+        etag = resp.headers.get("ETag", None)
+        last_modified = resp.headers.get("Last-Modified", None)
+        try:
+            atomic_write(path, json.dumps({
+                "url": url,
+                "etag": etag,
+                "last_modified": last_modified,
+                "content": content,
+            }).encode("utf-8"))
+        except OSError as err:
+            debug(f"could not save include cache {path}: {err}")
+        return content
@@ -1,17 +1,20 @@
 """
 Load a .gitlab-ci.yml file
 """
+import concurrent.futures
+import json
 import os
-import copy
 import sys
-import tempfile
+import threading
 import urllib.parse
 from abc import ABC, abstractmethod
 from typing import Dict, Any, Union, Optional, List
 
 import requests
+import requests.adapters
 from gitlab import Gitlab
 
+from .configcache import PipelineCache, IncludeCache
 from .errors import ConfigLoaderError, BadSyntaxError, FeatureNotSupportedError
 from .gitlab.types import RESERVED_TOP_KEYS, DEFAULT_JOB_KEYS
 from .gitlab.urls import GITLAB_SERVER_TEMPLATE_PATH
@@ -20,18 +23,51 @@ from .helpers import stringlist_if_string
 from .jobtypes import JobFactory, Job, DockerJob
 from .jobs import NoSuchJob
 from . import yamlloader
-from .references import process_references
+from .ruleengine import evaluate_rule
+from .references import process_references, process_block_references, reference_targets
 from .userconfig import get_user_config_context
 from .logmsg import warning, debugrule, fatal
 
-try:
-    from .ruleparser import evaluate_rule
-except ImportError:
-    # pragma: no cover
-    evaluate_rule = None
-
 
 DEFAULT_CI_FILE = ".gitlab-ci.yml"
+REMOTE_INCLUDE_TYPES = ["remote", "template", "project"]
+INCLUDE_FETCH_WORKERS = 8
+INCLUDE_FETCH_TIMEOUT = 30
+
+
+def include_rules_match(inc: Dict[str, Any],
+                        variables: Dict[str, str],
+                        filename: Optional[str] = None) -> bool:
+    """
+    Return True if the rules of an include permit it to be included
+    :param inc: the include map
+    :param variables:
+    :param filename: the name of the parent file wanting to include this one
+    :return:
+    """
+    rules = inc.get("rules", [])
+    if not rules:
+        debugrule(f"{filename} include: {inc}")
+        return True
+    for rule in rules:
+        # execute the rules, skip inclusion if none pass
+        if_rule = rule.get("if", None)
+        if if_rule:
+            matched = evaluate_rule(if_rule, dict(variables))
+            if matched:
+                debugrule(f"{filename} include '{inc}' matched {if_rule}")
+                return True
+    debugrule(f"{filename} not including: {inc}")
+    return False
+
+
+def remote_include_name(inc: Dict[str, Any]) -> str:
+    """Get a readable name for a remote, project or template include"""
+    if "remote" in inc:
+        return inc["remote"]
+    if "template" in inc:
+        return f"template:{inc['template']}"
+    return f"{inc.get('project')}:{inc.get('file', '')}@{inc.get('ref', 'HEAD')}"
 
 
 def do_single_include(baseobj: Dict[str, Any],
@@ -73,23 +109,8 @@ def do_single_include(baseobj: Dict[str, Any],
         if not supported:
             raise FeatureNotSupportedError(f"Do not understand how to include {inc}")
 
-        rules = inc.get("rules", [])
-        if not rules:
-            debugrule(f"{filename} include: {inc}")
-        else:
-            matched_rules = False
-            for rule in rules:
-                # execute the rules, skip inclusion if none pass
-                if_rule = rule.get("if", None)
-                if if_rule:
-                    matched = evaluate_rule(if_rule, dict(variables))
-                    if matched:
-                        debugrule(f"{filename} include '{inc}' matched {if_rule}")
-                        matched_rules = True
-                        break
-            if not matched_rules:
-                debugrule(f"{filename} not including: {inc}")
-                return {}
+        if not include_rules_match(inc, variables, filename):
+            return {}
 
     if inc_type == "local":
         if location is None:
@@ -106,14 +127,12 @@ def do_single_include(baseobj: Dict[str, Any],
         return handle_read(location, variables=False, validate_jobs=False, topdir=yamldir, baseobj=baseobj)
     else:
         warning(f"Including remote CI yaml file: {inc}")
-        temp_content = handle_fetch(inc)
-
-    if temp_content is not None:
-        with tempfile.TemporaryDirectory() as temp_folder:
-            path = os.path.join(str(temp_folder), "remote.yml")
-            with open(path, "w") as fd:
-                fd.write(temp_content)
-            return handle_read(path, variables=False, validate_jobs=False, topdir=str(temp_folder), baseobj=baseobj)
+        remote_content = handle_fetch(inc)
+
+    if remote_content is not None:
+        return handle_read(remote_include_name(inc),
+                           variables=False, validate_jobs=False, topdir=yamldir, baseobj=baseobj,
+                           content=remote_content)
     return {}
 
 
@@ -121,9 +140,11 @@ def do_includes(baseobj: Dict[str, Any],
                 yamldir: str,
                 incs: Union[str, List],
                 handle_include=do_single_include,
-                filename: Optional[str] = None) -> None:
+                filename: Optional[str] = None,
+                handle_prefetch=None) -> None:
     """
     Deep process include directives
+    :param handle_prefetch: if set, called with the list of includes before they are processed
     :param filename:
     :param handle_include:
     :param baseobj:
@@ -153,6 +174,8 @@ def do_includes(baseobj: Dict[str, Any],
             includes = incs
         else:
             includes = [incs]
+        if handle_prefetch is not None:
+            handle_prefetch(includes)
         for inc in includes:
             obj = handle_include(baseobj, yamldir, inc, filename=filename)
             for item in obj:
@@ -174,29 +197,86 @@ def strict_needs_stages() -> bool:
     return False
 
 
-class ExtendsMixin:
+def extends_bases(alljobs: Dict[str, Any], name: str) -> List[str]:
+    """Get the list of jobs the named job extends"""
+    base_jobs = stringlist_if_string(alljobs[name].get("extends", []))
+    if base_jobs is None:
+        base_jobs = []
+    if name in base_jobs:
+        raise BadSyntaxError(f"Job '{name}' cannot extend itself")
+    return base_jobs
 
-    @staticmethod
-    def do_single_extend_recursive(alljobs: dict, default_job: Dict[str, Any], name: str) -> Dict[str, Any]:
-        """Do all the extends and !reference expansion for a single job"""
-        assert name in alljobs
-        current_un_extended = alljobs.get(name)
+
+class ExtendsResolver:
+    """
+    Expand extends for a set of jobs. The extends graph is ordered so that each
+    template is resolved once before any job that extends it.
+    """
+
+    def __init__(self, alljobs: Dict[str, Any], default_job: Dict[str, Any]):
+        self.alljobs = alljobs
+        self.default_job = default_job
+        self.pipeline_variables = dict(alljobs.get("variables", {}))
+        self.resolved: Dict[str, Dict[str, Any]] = {}
+
+    def order(self, names: List[str]) -> List[str]:
+        """
+        Return the given jobs and every template they extend in the order they must be resolved
+        :param names:
+        :return:
+        """
+        ordered = []
+        visiting = set()
+        done = set(self.resolved.keys())
+        for root in names:
+            if root in done:
+                continue
+            assert root in self.alljobs
+            visiting.add(root)
+            stack = [(root, iter(extends_bases(self.alljobs, root)))]
+            while stack:
+                name, bases = stack[-1]
+                for base in bases:
+                    if base not in self.alljobs:
+                        raise BadSyntaxError(f"Job '{name}' extends '{base}' which does not exist")
+                    if "extends" not in self.alljobs[base] or base in done:
+                        # plain templates are used as-is
+                        continue
+                    if base in visiting:
+                        path = [x for x, _ in stack]
+                        cycle = path[path.index(base):] + [base]
+                        raise BadSyntaxError(f"Job '{name}' has circular extends: {' -> '.join(cycle)}")
+                    visiting.add(base)
+                    stack.append((base, iter(extends_bases(self.alljobs, base))))
+                    break
+                else:
+                    stack.pop()
+                    visiting.discard(name)
+                    done.add(name)
+                    ordered.append(name)
+        return ordered
+
+    def resolve(self, names: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Resolve the given jobs
+        :param names:
+        :return: a map of every resolved job including the templates they extend
+        """
+        for name in self.order(names):
+            self.resolved[name] = self.resolve_single(name)
+        return self.resolved
+
+    def resolve_single(self, name: str) -> Dict[str, Any]:
+        """Do all the extends and inherit expansion for a job whose templates are already resolved"""
+        current_un_extended = self.alljobs.get(name)
         current_extended = {}
-        default_job = copy.deepcopy(default_job)
-        pipeline_variables = alljobs.get("variables", {})
-
-        base_jobs = stringlist_if_string(current_un_extended.get("extends", []))
-        if base_jobs is None:
-            base_jobs = []
-        if name in base_jobs:
-            raise BadSyntaxError(f"Job '{name}' cannot extend itself")
-
-        for base in base_jobs:
-            if base not in alljobs:
-                raise BadSyntaxError(f"Job '{name}' extends '{base}' which does not exist")
-            supp = alljobs[base]
+        default_job = self.default_job
+        pipeline_variables = self.pipeline_variables
+
+        for base in extends_bases(self.alljobs, name):
+            supp = self.alljobs[base]
             if "extends" in supp:
-                supp = do_single_extend_recursive(alljobs, default_job, base)
+                supp = self.resolved[base]
             recursive_merge_dicts(current_extended, supp)
 
         # now do overrides
@@ -224,17 +304,28 @@ class ExtendsMixin:
             for valuekey in inherit_default:
                 if valuekey not in current_extended:
                     if valuekey in default_job:
-                        current_extended[valuekey] = copy.deepcopy(default_job[valuekey])
+                        current_extended[valuekey] = copy_tree(default_job[valuekey])
 
         if "extends" in current_extended:
             del current_extended["extends"]
 
         return current_extended
 
-    def do_extends(self, alljobs: Dict[str, Any]) -> None:
+
+class ExtendsMixin:
+
+    @staticmethod
+    def do_single_extend_recursive(alljobs: dict, default_job: Dict[str, Any], name: str) -> Dict[str, Any]:
+        """Do all the extends and !reference expansion for a single job"""
+        assert name in alljobs
+        resolver = ExtendsResolver(alljobs, default_job)
+        return resolver.resolve([name])[name]
+
+    @staticmethod
+    def prepare_default_job(alljobs: Dict[str, Any]) -> Dict[str, Any]:
         """
-        Process all the extends and !reference directives recursively
-        :return:
+        Move the top level image and services into the default job
+        :return: the default job
         """
         default_image = alljobs.get("image", None)
         default_job = alljobs.get("default", None)
@@ -249,36 +340,57 @@ class ExtendsMixin:
                 alljobs["default"]["services"] = default_services
                 del alljobs["services"]
             default_job = alljobs["default"]
+        return default_job
+
+    @staticmethod
+    def check_default_job(alljobs: Dict[str, Any]) -> None:
+        """Raise an error if the default job contains keys that cannot be set there"""
+        unexpected_keys = [x for x in alljobs["default"].keys() if x not in DEFAULT_JOB_KEYS]
+        if unexpected_keys:
+            raise BadSyntaxError(f"default config contains unknown keys: {unexpected_keys}")
 
-        jobnames = [x for x in alljobs.keys() if x not in RESERVED_TOP_KEYS] + ["default"]
+    @staticmethod
+    def flatten_job(alljobs: Dict[str, Any], name: str) -> None:
+        """Flatten script lists and ensure default variables are populated"""
+        variables = alljobs[name].get("variables", {})
+        if name != "default":
+            alljobs[name]["variables"] = dict(variables)
+        for scriptpart in ["before_script", "script", "after_script"]:
+            if scriptpart in alljobs[name]:
+                scriptlines = alljobs[name][scriptpart]
+                if scriptlines is None:
+                    alljobs[name][scriptpart] = []
+                elif isinstance(scriptlines, str):
+                    alljobs[name][scriptpart] = [scriptlines]
+                elif not isinstance(scriptlines, list) or any(isinstance(x, bool) for x in scriptlines):
+                    newlines = []
+                    for line in scriptlines:
+                        if isinstance(line, bool):
+                            print(f"warning, line: {line} in job {name} evaluates to a yaml boolean, you probably want to quote \"true\" or \"false\"", file=sys.stderr)
+                            line = str(line).lower()
+                        newlines.append(line)
+                    alljobs[name][scriptpart] = newlines
+
+    def do_extends(self, alljobs: Dict[str, Any]) -> None:
+        """
+        Process all the extends and !reference directives recursively
+        :return:
+        """
+        default_job = self.prepare_default_job(alljobs)
+        jobnames = [x for x in alljobs.keys() if x not in RESERVED_TOP_KEYS]
 
-        unextended = copy.deepcopy(alljobs)
+        # jobs are replaced, never modified, so the originals remain available to the resolver
+        unextended = dict(alljobs)
+        resolver = ExtendsResolver(unextended, default_job)
+        resolved = resolver.resolve(jobnames)
         for name in jobnames:
-            if name == "default":
-                unexpected_keys = [x for x in alljobs["default"].keys() if x not in DEFAULT_JOB_KEYS]
-                if unexpected_keys:
-                    raise BadSyntaxError(f"default config contains unknown keys: {unexpected_keys}")
-                continue
-            new_job = self.do_single_extend_recursive(unextended, default_job, name)
-            alljobs[name] = new_job
+            alljobs[name] = resolved[name]
+
+        self.check_default_job(alljobs)
 
-        # flatten lists and ensure default variables are populated
         for name in alljobs:
             if name not in RESERVED_TOP_KEYS:
-                variables = alljobs[name].get("variables", {})
-                if name != "default":
-                    alljobs[name]["variables"] = dict(variables)
-                for scriptpart in ["before_script", "script", "after_script"]:
-                    if scriptpart in alljobs[name]:
-                        scriptlines = alljobs[name][scriptpart]
-                        newlines = []
-                        if scriptlines is not None:                            
-                            for line in scriptlines:
-                                if isinstance(line, bool):
-                                    print(f"warning, line: {line} in job {name} evaluates to a yaml boolean, you probably want to quote \"true\" or \"false\"", file=sys.stderr)
-                                    line = str(line).lower()
-                                newlines.append(line)
-                        alljobs[name][scriptpart] = list(newlines)
+                self.flatten_job(alljobs, name)
 
 
 def do_extends(alljobs: Dict[str, Any]) -> None:
@@ -323,9 +435,8 @@ def get_job(config: Dict[str, Any], name: str) -> Optional[Dict[str, Any]]:
     :param name:
     :return:
     """
-    assert name in get_jobs(config)
-
     job = config.get(name)
+    assert name not in RESERVED_TOP_KEYS and isinstance(job, dict)
 
     # set some implied defaults
     if "stage" not in job:
@@ -334,6 +445,22 @@ def get_job(config: Dict[str, Any], name: str) -> Optional[Dict[str, Any]]:
     return job
 
 
+def needed_jobs(job: Dict[str, Any]) -> List[str]:
+    """
+    Get the names of the jobs that a job needs (or depends on)
+    :param job:
+    :return:
+    """
+    needed = job.get("needs", job.get("dependencies", []))
+    names = []
+    for item in stringlist_if_string(needed) or []:
+        if isinstance(item, dict):
+            item = item.get("job")
+        if isinstance(item, str) and item not in names:
+            names.append(item)
+    return names
+
+
 def job_docker_image(config: Dict[str, Any], name: str) -> Optional[Union[str, Dict[str, Any]]]:
     """
     Return a docker image if a job is configured for it
@@ -442,6 +569,21 @@ def merge_dicts(baseobj: dict, updated: dict, key: Any) -> None:
             baseobj[key] = newvalue
 
 
+def copy_tree(value: Any) -> Any:
+    """
+    Copy the dicts and lists in a value so each job gets its own, strings and other scalars are immutable
+    so are shared. Much cheaper than copy.deepcopy as there is no memo, subclasses such as StringableOrderedDict
+    keep their type.
+    """
+    if isinstance(value, dict):
+        copied = {keyname: copy_tree(item) for keyname, item in value.items()}
+        return copied if type(value) is dict else type(value)(copied)
+    if isinstance(value, list):
+        copied = [copy_tree(item) for item in value]
+        return copied if type(value) is list else type(value)(copied)
+    return value
+
+
 def recursive_merge_dicts(target: Dict[str, Any], supp: Dict[str, Any]) -> None:
     # deep recursive merge supp into target
     for keyname, value in supp.items():
@@ -450,24 +592,30 @@ def recursive_merge_dicts(target: Dict[str, Any], supp: Dict[str, Any]) -> None:
         if isinstance(current_value, dict) and isinstance(value, dict):
             recursive_merge_dicts(current_value, value)
         else:
-            target[keyname] = copy.deepcopy(value)
+            target[keyname] = copy_tree(value)
 
 
 class ValidatorMixin:
 
     @staticmethod
-    def validate(config: Dict[str, Any]) -> None:
+    def validate(config: Dict[str, Any], names: Optional[List[str]] = None) -> None:
         """
         Validate the jobs in the loaded config map, raise a GitlabEmulatorError on error
+        :param config:
+        :param names: if set, only validate these jobs
         """
         jobs = get_jobs(config)
+        known_jobs = set(jobs)
         stages = list(get_stages(config))
         if ".pre" not in stages:
             stages.insert(0, ".pre")
         if ".post" not in stages:
             stages.append(".post")
+        if names is None:
+            names = jobs
+        strict_needs = strict_needs_stages()
 
-        for name in jobs:
+        for name in names:
             if name.startswith("."):
                 continue
 
@@ -500,11 +648,11 @@ class ValidatorMixin:
                             continue
                         need = need["job"]
 
-                    if need not in jobs:
+                    if need not in known_jobs:
                         raise ConfigLoaderError("job {} needs job {} which does not exist".format(name, need))
 
                     # check the needed job in an earlier stage if running in <14.2 mode
-                    if strict_needs_stages():
+                    if strict_needs:
                         needed = get_job(config, need)
                         stage_order = stages.index(job["stage"])
                         need_stage_order = stages.index(needed["stage"])
@@ -534,10 +682,14 @@ def read(
         handle_include=do_includes,
         handle_extends=do_extends,
         handle_validate=validate,
-        handle_variables=do_variables
+        handle_variables=do_variables,
+        handle_references=process_references,
+        content=None,
          ) -> Dict[str, Any]:
     """
     Read a .gitlab-ci.yml file into python types
+    :param content: if set, parse this yaml text instead of reading yamlfile
+    :param handle_references:
     :param handle_variables:
     :param handle_validate:
     :param handle_extends:
@@ -552,12 +704,13 @@ def read(
     parent = False
     if topdir is None:
         topdir = os.path.dirname(yamlfile)
-    else:
+    elif content is None:
         yamlfile = os.path.join(topdir, yamlfile)
-    with open(yamlfile, "r") as yamlobj:
-        preloaded = yamlloader.ordered_load(yamlobj)
-    with open(yamlfile, "r") as yamlobj:
-        loaded = yamlloader.ordered_load(yamlobj, preloaded)
+    if content is None:
+        with open(yamlfile, "rb") as yamlobj:
+            loaded = yamlloader.ordered_load(yamlobj)
+    else:
+        loaded = yamlloader.ordered_load(content)
 
     if loaded is None:
         # file was empty?
@@ -575,7 +728,7 @@ def read(
     baseobj["include"].append(yamlfile)
 
     # now process references
-    baseobj = process_references(baseobj)
+    baseobj = handle_references(baseobj)
 
     if parent:
         # now do extends
@@ -674,13 +827,30 @@ class BaseLoader(ABC):
 class Loader(BaseLoader, JobLoaderMixin, ValidatorMixin, ExtendsMixin):
     """
     A configuration loader for gitlab pipelines
+
+    If lazy is True, all the files are read but extends, !reference and validation are only
+    processed for a job (and the jobs it needs) when it is first requested.
     """
 
-    def __init__(self, emulator_variables: Optional[bool] = True):
+    def __init__(self,
+                 emulator_variables: Optional[bool] = True,
+                 use_cache: Optional[bool] = False,
+                 lazy: Optional[bool] = False):
         super().__init__()
         self.create_emulator_variables = emulator_variables
+        self.lazy = lazy
+        self._resolver: Optional[ExtendsResolver] = None
+        self._unresolved = set()
+        self._unreferenced = set()
         self.gitlab_api: Optional[Gitlab] = None
         self.tls_verify = True
+        self.use_cache = use_cache
+        self.cache: Optional[PipelineCache] = None
+        self.include_cache = IncludeCache()
+        self._fetched_includes = False
+        self._fetched: Dict[str, str] = {}
+        self._fetch_lock = threading.Lock()
+        self._http_session: Optional[requests.Session] = None
 
     def get_gitlab_client(self) -> Gitlab:
         if self.gitlab_api is None:
@@ -694,6 +864,7 @@ class Loader(BaseLoader, JobLoaderMixin, ValidatorMixin, ExtendsMixin):
                  jobfactory: Optional[JobFactory] = None,
                  ) -> Union["Job", "DockerJob"]:
         """Return a loaded job object"""
+        self.resolve_jobs([name])
         job = self.load_job_ex(self.config, name,
                                overrides=overrides,
                                allow_add_variables=self.create_emulator_variables,
@@ -702,6 +873,14 @@ class Loader(BaseLoader, JobLoaderMixin, ValidatorMixin, ExtendsMixin):
                                )
         return job
 
+    def get_job(self, name: str) -> Dict[str, Any]:
+        self.resolve_jobs([name])
+        return super().get_job(name)
+
+    def get_docker_image(self, jobname: str) -> Optional[str]:
+        self.resolve_jobs([jobname])
+        return super().get_docker_image(jobname)
+
     def do_includes(self, baseobj: Dict[str, Any], yamldir: str, incs: Union[List, str]) -> None:
         """
         Process the list of include files
@@ -712,22 +891,39 @@ class Loader(BaseLoader, JobLoaderMixin, ValidatorMixin, ExtendsMixin):
         """
         return do_includes(baseobj, yamldir, incs,
                            handle_include=self.do_single_include,
-                           filename=self.filename)
+                           filename=self.filename,
+                           handle_prefetch=self.prefetch_includes)
+
+    def get_http_session(self) -> requests.Session:
+        """Get the pooled session used to fetch remote includes"""
+        if self._http_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=INCLUDE_FETCH_WORKERS,
+                                                    pool_maxsize=INCLUDE_FETCH_WORKERS)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._http_session = session
+        return self._http_session
 
     def fetch_include(self, inc) -> str:
         """Download a ci yml file from a remote server/project"""
+        # remote content can't be checked for changes without fetching it again
+        self._fetched_includes = True
+        key = json.dumps(inc, sort_keys=True, default=str)
+        with self._fetch_lock:
+            if key in self._fetched:
+                return self._fetched[key]
+
         get_template = inc.get("template", None)
         get_remote = inc.get("remote", None)
         get_project = inc.get("project", None)
-        resp = None
+        content = ""
         if get_template or get_project:
             gitlab = self.get_gitlab_client()
             if get_template:
                 url = gitlab.api_url + GITLAB_SERVER_TEMPLATE_PATH + get_template
-                resp = gitlab.session.get(url)
-                resp.raise_for_status()
-                data = resp.json()
-                return data.get("content", "")
+                data = json.loads(self.include_cache.fetch(gitlab.session, url, timeout=INCLUDE_FETCH_TIMEOUT))
+                content = data.get("content", "")
             elif get_project:
                 get_file = inc.get("file", None)
                 get_ref = inc.get("ref", "HEAD")
@@ -740,16 +936,34 @@ class Loader(BaseLoader, JobLoaderMixin, ValidatorMixin, ExtendsMixin):
                 url = gitlab.api_url + f"/projects/{encoded_project}/repository/files/{encoded_file}/raw"
                 if get_ref:
                     get_params = {"ref": get_ref}
-                resp = gitlab.session.get(url, params=get_params)
-                # have to decode the content
-                resp.raise_for_status()
-                return resp.text
-
+                content = self.include_cache.fetch(gitlab.session, url,
+                                                   params=get_params,
+                                                   timeout=INCLUDE_FETCH_TIMEOUT)
         elif get_remote:
-            resp = requests.get(get_remote)
-            resp.raise_for_status()
-            return resp.text
-        return ""
+            content = self.include_cache.fetch(self.get_http_session(), get_remote, timeout=INCLUDE_FETCH_TIMEOUT)
+
+        with self._fetch_lock:
+            self._fetched[key] = content
+        return content
+
+    def prefetch_includes(self, includes: List[Union[str, Dict[str, Any]]]) -> None:
+        """
+        Concurrently download all the remote includes in this list that pass their rules
+        :param includes:
+        :return:
+        """
+        remote = []
+        for inc in includes:
+            if isinstance(inc, dict) and any(x in inc for x in REMOTE_INCLUDE_TYPES):
+                if include_rules_match(inc, self.variables, self.filename):
+                    remote.append(inc)
+        if len(remote) > 1:
+            if any("remote" not in x for x in remote):
+                # create the client before the worker threads need it
+                self.get_gitlab_client()
+            workers = min(len(remote), INCLUDE_FETCH_WORKERS)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(self.fetch_include, remote))
 
     def do_single_include(self,
                           baseobj: Dict[str, Any],
@@ -766,14 +980,106 @@ class Loader(BaseLoader, JobLoaderMixin, ValidatorMixin, ExtendsMixin):
                                  variables=self.variables,
                                  filename=filename)
 
+    def do_references(self, baseobj: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Expand !reference tags, deferred until a job is requested in lazy mode
+        :param baseobj:
+        :return:
+        """
+        if self.lazy:
+            self._unreferenced.update(x for x in baseobj if x not in RESERVED_TOP_KEYS)
+            return baseobj
+        return process_references(baseobj)
+
+    def do_extends(self, alljobs: Dict[str, Any]) -> None:
+        """
+        Process extends, deferred until a job is requested in lazy mode
+        :param alljobs:
+        :return:
+        """
+        if not self.lazy:
+            return super().do_extends(alljobs)
+        default_job = self.prepare_default_job(alljobs)
+        self.check_default_job(alljobs)
+        # jobs are replaced when resolved, so keep the originals for the resolver
+        self._resolver = ExtendsResolver(dict(alljobs), default_job)
+        self._unresolved = set(x for x in alljobs if x not in RESERVED_TOP_KEYS)
+
     def do_validate(self, baseobj: Dict[str, Any]) -> None:
         """
-        Validate the pipeline is defined legally
+        Validate the pipeline is defined legally, deferred until a job is requested in lazy mode
         :param baseobj:
         :return:
         """
+        if self.lazy:
+            return
         return self.validate(baseobj)
 
+    def expand_references(self, name: str) -> None:
+        """
+        Expand the !reference tags in a job, the templates it extends and the jobs they refer to
+        :param name:
+        :return:
+        """
+        # references refer to jobs as they were before extends were resolved
+        unextended = self._resolver.alljobs
+        wanted = set()
+        pending = [name]
+        while pending:
+            item = pending.pop()
+            if item in wanted or item not in self._unreferenced:
+                continue
+            wanted.add(item)
+            job = unextended[item]
+            if isinstance(job, dict):
+                pending.extend(reference_targets(job))
+                pending.extend(stringlist_if_string(job.get("extends", [])) or [])
+        # expand in the same order as a full load would
+        for item in [x for x in unextended if x in wanted]:
+            unextended[item] = process_block_references(unextended, unextended[item])
+            self._unreferenced.discard(item)
+
+    def resolve_pending(self, names: List[str]) -> List[str]:
+        """
+        Resolve the given unresolved jobs and the jobs they need
+        :param names:
+        :return: the jobs that were resolved
+        """
+        done = []
+        pending = list(names)
+        while pending:
+            name = pending.pop(0)
+            if name not in self._unresolved:
+                continue
+            self.expand_references(name)
+            job = dict(self._resolver.resolve([name])[name])
+            job.update(normalise_job_scripts(job))
+            self.config[name] = job
+            self.flatten_job(self.config, name)
+            self._unresolved.discard(name)
+            done.append(name)
+            pending.extend(needed_jobs(job))
+        return done
+
+    def resolve_jobs(self, names: List[str]) -> None:
+        """
+        In lazy mode, resolve and validate the given jobs and the jobs they need
+        :param names:
+        :return:
+        """
+        if self._unresolved:
+            done = self.resolve_pending(names)
+            self.validate(self.config, names=[x for x in done if not x.startswith(".")])
+
+    def resolve_all(self) -> None:
+        """
+        Resolve every job in the pipeline and validate the whole pipeline
+        :return:
+        """
+        if self._unresolved:
+            self.resolve_pending(self.get_jobs())
+            self.validate(self.config)
+
     def do_variables(self, baseobj: Dict[str, Any], yamlfile: Optional[str]) -> Dict[str, Any]:
         """
         Process the variables top level section
@@ -817,21 +1123,18 @@ class Loader(BaseLoader, JobLoaderMixin, ValidatorMixin, ExtendsMixin):
                        handle_extends=self.do_extends,
                        handle_validate=self.do_validate,
                        handle_variables=self.do_variables,
+                       handle_references=self.do_references,
                        )
 
         new_keys = (x for x in objdata if x not in before)
         new_keys = [x for x in new_keys if x not in RESERVED_TOP_KEYS]
         self._job_sources[relative_filename] = new_keys
 
-        # collapse down list-of-lists in scripts
+        # collapse down list-of-lists in scripts, lazy jobs are done once they are resolved
         for jobname in objdata:
-            if not isinstance(objdata[jobname], dict):
+            if not isinstance(objdata[jobname], dict) or jobname in self._unreferenced:
                 continue
-            objdata[jobname]: Dict[str, Any]
-            for script_name in ["before_script", "script", "after_script"]:
-                if script_name not in objdata[jobname]:
-                    continue
-                objdata[jobname][script_name] = normalise_script(objdata[jobname][script_name])
+            objdata[jobname].update(normalise_job_scripts(objdata[jobname]))
 
         return objdata
 
@@ -843,10 +1146,62 @@ class Loader(BaseLoader, JobLoaderMixin, ValidatorMixin, ExtendsMixin):
         """
         assert not self._done, "load() called more than once"
         extra_vars = dict(self.config.get(".gle-extra_variables", {}))
+        if self.use_cache:
+            if self.cache is None:
+                self.cache = PipelineCache()
+            if self.load_cached(filename, extra_vars):
+                self._done = True
+                return
         self.config = self._read(filename)
         self.config[".gle-extra_variables"] = dict(extra_vars)
+        # only fully resolved pipelines are saved, lazy loads can still use them
+        if self.use_cache and not self._fetched_includes and not self._unresolved:
+            self.save_cached(filename, extra_vars)
         self._done = True
 
+    def cache_inputs(self, extra_vars: Dict[str, Any]) -> Dict[str, Any]:
+        """Get the values other than file content that change the loaded pipeline"""
+        return {
+            "extra_variables": sorted((str(k), str(v)) for k, v in extra_vars.items()),
+            "emulator_variables": self.create_emulator_variables,
+            "strict_needs_stages": strict_needs_stages(),
+            "environment": sorted((k, v) for k, v in os.environ.items() if k.startswith("CI_")),
+        }
+
+    def load_cached(self, filename: str, extra_vars: Dict[str, Any]) -> bool:
+        """
+        Populate this loader from the pipeline cache
+        :param filename:
+        :param extra_vars:
+        :return: True if a current cache entry was found
+        """
+        data = self.cache.get(filename, self.cache_inputs(extra_vars))
+        if data is None:
+            return False
+        self.config = data["config"]
+        self.config[".gle-extra_variables"] = dict(extra_vars)
+        self.rootdir = data["rootdir"]
+        self.filename = data["filename"]
+        self.included_files = data["included_files"]
+        self._job_sources = data["job_sources"]
+        return True
+
+    def save_cached(self, filename: str, extra_vars: Dict[str, Any]) -> None:
+        """
+        Save the loaded pipeline to the pipeline cache
+        :param filename:
+        :param extra_vars:
+        :return:
+        """
+        sources = [os.path.join(self.rootdir, x) for x in self.included_files]
+        self.cache.put(filename, self.cache_inputs(extra_vars), sources, {
+            "config": self.config,
+            "rootdir": self.rootdir,
+            "filename": self.filename,
+            "included_files": self.included_files,
+            "job_sources": self._job_sources,
+        })
+
 
 def normalise_script(script_item: Optional[Union[List[str], List[List[str]], str]]) -> List[str]:
     """Convert scalar or 2d script lists into 1d lists"""
@@ -854,6 +1209,9 @@ def normalise_script(script_item: Optional[Union[List[str], List[List[str]], str
         return [script_item]
     if script_item is None:
         return []
+    if isinstance(script_item, list) and not any(isinstance(x, list) for x in script_item):
+        # already flat
+        return list(script_item)
     # script is a list
     result = []
     for item in script_item:
@@ -864,6 +1222,11 @@ def normalise_script(script_item: Optional[Union[List[str], List[List[str]], str
     return result
 
 
+def normalise_job_scripts(job: Dict[str, Any]) -> Dict[str, List[str]]:
+    """Return the normalised before_script, script and after_script of a job"""
+    return {x: normalise_script(job[x]) for x in ["before_script", "script", "after_script"] if x in job}
+
+
 def find_ci_config(path: str) -> Optional[str]:
     """
     Starting in path go upwards looking for a .gitlab-ci.yml file
@@ -8,7 +8,7 @@ from . import configtool_gitlab
 from . import configtool_runner
 from . import configtool_vars
 from . import configtool_volumes
-from .userconfig import get_user_config
+from .userconfig import get_user_config, invalidate_user_config
 
 GLOBAL_DESC = __doc__
 
@@ -50,6 +50,8 @@ def main(args=None):
     opts = parser.parse_args(args)
     if hasattr(opts, "func"):
         opts.func(opts)
+        # the command may have changed the config file
+        invalidate_user_config()
     else:
         parser.print_usage()
 
@@ -0,0 +1,200 @@
+"""
+Keep finished job containers running so that later jobs with the same image and settings can re-use them
+"""
+import atexit
+import os
+import subprocess
+import threading
+import time
+from typing import Dict, List, Optional, Tuple, Any
+
+from .logmsg import info, debug
+from .userconfig import get_user_config_context
+from .userconfigdata import DEFAULT_POOL_TTL
+
+POOL_SIZE_ENV = "GLE_DOCKER_POOL"
+POOL_TTL_ENV = "GLE_DOCKER_POOL_TTL"
+
+# run as root in a container before it goes back to the pool, stops everything the last job left running (kill -1
+# skips pid 1, which keeps the container up, and the shell itself) and empties the temp folders
+RESET_SCRIPT = "kill -9 -1 2>/dev/null; rm -rf /tmp/* /tmp/.[!.]* /var/tmp/* /var/tmp/.[!.]* 2>/dev/null; exit 0"
+# paths a passing job may change and still leave a container the next job can use, /etc/gitconfig holds the
+# safe.directory setting added when the container was prepared
+RESET_ALLOWED_PATHS = ["/tmp", "/var/tmp", "/etc/gitconfig"]
+
+_pool: Optional["ContainerPool"] = None
+_pool_lock = threading.Lock()
+
+
+def pool_key(tool: str,
+             image: str,
+             entrypoint: Optional[Any],
+             volumes: List[str],
+             privileged: bool) -> Tuple:
+    """Get the key for containers that can be used for jobs with these settings"""
+    return tool, image, str(entrypoint), tuple(sorted(volumes)), bool(privileged)
+
+
+def changed_paths(diff: str) -> List[str]:
+    """
+    Get the paths changed in a container that a later job could notice
+    :param diff: the output of "docker diff"
+    :return:
+    """
+    found = []
+    for line in diff.splitlines():
+        parts = line.split(None, 1)
+        if len(parts) == 2:
+            found.append((parts[0], parts[1]))
+    changed = []
+    for kind, path in found:
+        if any(path == x or path.startswith(x + "/") for x in RESET_ALLOWED_PATHS):
+            continue
+        if kind == "C" and any(x.startswith(path.rstrip("/") + "/") for _, x in found):
+            # a folder that only changed because something inside it did
+            continue
+        changed.append(path)
+    return changed
+
+
+class PooledContainer:
+    """A running container that a job can use"""
+
+    def __init__(self, key: Tuple, container: str, name: str):
+        self.key = key
+        self.container = container
+        self.name = name
+        self.idle_since = 0.0
+        # setup steps already done in this container
+        self.prepared = set()
+
+    @property
+    def tool(self) -> str:
+        return self.key[0]
+
+    def is_running(self) -> bool:
+        try:
+            output = subprocess.check_output([self.tool, "container", "inspect",
+                                              "--format", "{{.State.Running}}", self.container],
+                                             stderr=subprocess.DEVNULL, encoding="utf-8")
+            return output.strip() == "true"
+        except (subprocess.CalledProcessError, OSError):
+            return False
+
+    def reset(self) -> bool:
+        """
+        Stop the processes the last job left in the container and empty its temp folders, then check that the job
+        did not change anything else (eg, installed packages or added users) that the next job would see
+        :return: True if the container can be given to another job
+        """
+        try:
+            subprocess.check_call([self.tool, "exec", "-u", "0", self.container, "sh", "-c", RESET_SCRIPT],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            diff = subprocess.check_output([self.tool, "diff", self.container],
+                                           stderr=subprocess.DEVNULL, encoding="utf-8")
+        except (subprocess.CalledProcessError, OSError) as err:
+            debug(f"could not reset container {self.name}: {err}")
+            return False
+        changed = changed_paths(diff)
+        if changed:
+            info(f"not re-using container {self.name}, the job changed {', '.join(changed[:3])}")
+            return False
+        return True
+
+    def kill(self) -> None:
+        info(f"removing pooled container {self.name}")
+        subprocess.call([self.tool, "kill", self.container], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+class ContainerPool:
+    """Idle job containers waiting for another job with the same key"""
+
+    def __init__(self, size: int, ttl: float = DEFAULT_POOL_TTL):
+        """
+        :param size: the most idle containers to keep
+        :param ttl: remove containers that have been idle for this many seconds
+        """
+        self.size = size
+        self.ttl = ttl
+        self.idle: List[PooledContainer] = []
+        self.lock = threading.Lock()
+
+    def acquire(self, key: Tuple) -> Optional[PooledContainer]:
+        """
+        Take an idle container for a job
+        :param key: from pool_key()
+        :return: a running container or None
+        """
+        self.evict()
+        while True:
+            with self.lock:
+                found = [x for x in self.idle if x.key == key]
+                if not found:
+                    return None
+                # prefer the most recently used one
+                pooled = found[-1]
+                self.idle.remove(pooled)
+            if pooled.is_running():
+                info(f"re-using container {pooled.name}")
+                return pooled
+            debug(f"pooled container {pooled.name} has stopped")
+
+    def release(self, pooled: PooledContainer) -> None:
+        """Reset a container and return it to the pool after a job has finished with it, or remove it if it cannot be
+        reset"""
+        if not pooled.reset():
+            pooled.kill()
+            return
+        pooled.idle_since = time.monotonic()
+        with self.lock:
+            self.idle.append(pooled)
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove containers that have been idle for too long or that do not fit in the pool"""
+        now = time.monotonic()
+        with self.lock:
+            expired = [x for x in self.idle if now - x.idle_since > self.ttl]
+            keep = [x for x in self.idle if x not in expired]
+            while len(keep) > self.size:
+                expired.append(keep.pop(0))
+            self.idle = keep
+        for pooled in expired:
+            pooled.kill()
+
+    def close(self) -> None:
+        """Remove all the idle containers"""
+        with self.lock:
+            idle = list(self.idle)
+            self.idle.clear()
+        for pooled in idle:
+            pooled.kill()
+
+
+def get_container_pool() -> Optional[ContainerPool]:
+    """
+    Get the container pool if it is enabled by GLE_DOCKER_POOL or the pool_size docker setting
+    :return:
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            docker = get_user_config_context().docker
+            size = int(os.getenv(POOL_SIZE_ENV, docker.pool_size) or 0)
+            ttl = float(os.getenv(POOL_TTL_ENV, docker.pool_ttl) or 0)
+            if size < 1:
+                return None
+            _pool = ContainerPool(size, ttl)
+            atexit.register(_pool.close)
+        return _pool
+
+
+def close_container_pool() -> None:
+    """Remove all pooled containers and disable the pool until it is next requested"""
+    global _pool
+    with _pool_lock:
+        pool = _pool
+        _pool = None
+    if pool is not None:
+        atexit.unregister(pool.close)
+        pool.close()
@@ -6,14 +6,25 @@ import threading
 import time
 import json
 import getpass
+import shlex
+import shutil
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import contextmanager
 from pathlib import Path
 from typing import Dict, Optional, List, Any
 from .logmsg import warning, info, fatal
+from .aiorunner import async_runner_enabled, get_abort_grace, popen, wait_for_exit
+from .containerpool import ContainerPool, PooledContainer, get_container_pool, pool_key
 from .jobs import Job, make_script
 from .helpers import communicate as comm, is_windows
 from .userconfig import get_user_config_context
+from .runtimeprobe import get_runtime_info
 from .errors import DockerExecError, GitlabEmulatorError
+from .dockerapi import DockerApiClient, DockerApiError, get_docker_api
+from .imagecache import ImageInfo, get_image_info, image_pulled, pull_digest, set_image_has_bash, forget_image_info
+from .servicenet import ServiceNetwork, create_service_network
+from .serviceprobe import PROBE_NONE, parse_readiness, wait_until_ready
 from .userconfigdata import GleRunnerConfig
 from .variables import expand_variable, truth_string
 
@@ -21,6 +32,16 @@ PULL_POLICY_ALWAYS = "always"
 PULL_POLICY_IF_NOT_PRESENT = "if-not-present"
 PULL_POLICY_NEVER = "never"
 
+# save the script sent to stdin and run it with stdin closed, the same as a shell job
+STREAM_SCRIPT = "cat > {script} && {command} </dev/null; rc=$?; rm -f {script}; exit $rc"
+
+BOOTSTRAP_HAS_BASH = "gle-has-bash"
+BOOTSTRAP_USER_FAILED = "gle-user-setup-failed"
+
+# threads removing the services of finished jobs
+_teardown_threads: List[threading.Thread] = []
+_teardown_lock = threading.Lock()
+
 
 class DockerToolError(GitlabEmulatorError):
     """An error using docker"""
@@ -57,20 +78,154 @@ class DockerTool(object):
         self.network = None
         self._client = None
         self._is_hyerv = None
+        self._env_file: Optional[str] = None
+        self._api: Optional[DockerApiClient] = None
+        self._api_checked = False
         self.tool = "docker"
 
+    @property
+    def api(self) -> Optional[DockerApiClient]:
+        """The docker engine API client, or None to use the docker command line tool"""
+        if not self._api_checked:
+            self._api = get_docker_api(self.tool)
+            self._api_checked = True
+        return self._api
+
+    def api_call(self, method, *args, **kwargs):
+        """Call a docker engine API method, raising DockerToolFailed if it fails"""
+        try:
+            return method(*args, **kwargs)
+        except DockerApiError as err:
+            raise DockerToolFailed(f"{method.__name__} failed", "", err.message)
+        except OSError as err:
+            raise DockerToolError(f"could not call {method.__name__}, {err}")
+
     @property
     def containers(self) -> List[str]:
         try:
+            if self.api:
+                return self.api_call(self.api.container_list)
             output = self.docker_call("container", "ps", "-q").stdout.strip()
             return output.splitlines(keepends=False)
         except DockerToolError:
             return []
 
     def container_name(self, containerid: str) -> str:
-        output = self.docker_call("container", "inspect", containerid).stdout.strip()
-        data = json.loads(output)[0]
-        return data["Name"][1:]
+        return self.container_inspect(containerid)["Name"][1:]
+
+    def container_inspect(self, container: str) -> Dict[str, Any]:
+        """Get the state of a container"""
+        if self.api:
+            return self.api_call(self.api.container_inspect, container)
+        output = self.docker_call("container", "inspect", container).stdout
+        return json.loads(output)[0]
+
+    def container_logs(self, container: str) -> str:
+        """Get the output of a container"""
+        if self.api:
+            return self.api_call(self.api.container_logs, container).decode("utf-8", errors="replace")
+        proc = self.docker_call("logs", container)
+        return proc.stdout + proc.stderr
+
+    def container_exec(self, container: str, cmd: List[str]) -> str:
+        """Run a command in a container (eg, a service) and return its output"""
+        if self.api:
+            exec_id = self.api_call(self.api.exec_create, container, cmd)
+            proc = self.api_call(self.api.exec_start, exec_id)
+            proc.stdin.close()
+            output = proc.stdout.read().decode("utf-8", errors="replace")
+            proc.stdout.close()
+            if proc.wait():
+                raise DockerToolFailed(f"exec in {container} failed", output, "")
+            return output
+        return self.docker_call("exec", container, *cmd).stdout
+
+    def kill_container(self, container: str, signal: Optional[str] = None) -> None:
+        """Kill a container"""
+        if self.api:
+            self.api_call(self.api.container_kill, container, signal or "KILL")
+        elif signal:
+            self.docker_call("kill", "-s", signal, container)
+        else:
+            self.docker_call("kill", container)
+
+    def network_exists(self, network: str) -> bool:
+        try:
+            if self.api:
+                self.api_call(self.api.network_inspect, network)
+            else:
+                self.docker_call("network", "inspect", network)
+            return True
+        except DockerToolFailed:
+            return False
+
+    @property
+    def networks(self) -> List[str]:
+        try:
+            if self.api:
+                return self.api_call(self.api.network_list)
+            output = self.docker_call("network", "ls", "--format", "{{.Name}}").stdout.strip()
+            return output.splitlines(keepends=False)
+        except DockerToolError:
+            return []
+
+    def create_network(self, network: str, subnet: Optional[str] = None) -> None:
+        if self.api:
+            self.api_call(self.api.network_create, network, subnet=subnet)
+        else:
+            cmdline = ["network", "create", "--driver", "bridge"]
+            if subnet:
+                cmdline.extend(["--subnet", subnet])
+            cmdline.append(network)
+            self.docker_call(*cmdline)
+
+    def remove_network(self, network: str) -> None:
+        if self.api:
+            self.api_call(self.api.network_remove, network)
+        else:
+            self.docker_call("network", "rm", network)
+
+    def connect_network(self, network: str, container: str, aliases: List[str]) -> None:
+        if self.api:
+            self.api_call(self.api.network_connect, network, container, aliases=aliases)
+        else:
+            cmdline = ["network", "connect"]
+            for alias in aliases:
+                cmdline.extend(["--alias", alias])
+            cmdline.extend([network, container])
+            self.docker_call(*cmdline)
+
+    def pull_image(self, image: str) -> None:
+        """Pull an image"""
+        if self.api:
+            output = self.api_call(self.api.image_pull, image)
+        else:
+            output = self.docker_call("pull", image).stdout
+        image_pulled(self.tool, image, pull_digest(output))
+
+    def run_service(self, image: str, variables: Dict[str, str], privileged: bool) -> str:
+        """
+        Start a detached service container
+        :param image: the service image
+        :param variables: environment variables for the service
+        :param privileged: run a privileged container
+        :return: the container id
+        """
+        if self.api:
+            container = self.api_call(self.api.container_create, {
+                "Image": image,
+                "Env": [f"{name}={value}" for name, value in variables.items()],
+                "HostConfig": {"AutoRemove": True, "Privileged": privileged},
+            })
+            self.api_call(self.api.container_start, container)
+            return container
+        cmdline = ["run", "--rm", "-d"]
+        if privileged:
+            cmdline.append("--privileged")
+        for envname, value in variables.items():
+            cmdline.extend(["-e", f"{envname}={value}"])
+        cmdline.append(image)
+        return self.docker_call(*cmdline).stdout.strip()
 
     def docker_call(self, *args, cwd: Optional[Path] = None) -> subprocess.CompletedProcess:
         """Run the docker command line tool"""
@@ -92,9 +247,7 @@ class DockerTool(object):
         if self._is_hyerv is None:
             self._is_hyerv = False
             if is_windows():  # pramga: cover if windows
-                output = self.docker_call("info", "-f", "{{.Isolation}}").stdout.strip()
-                if output == "hyperv":  # pragma: no cover
-                    self._is_hyerv = True
+                self._is_hyerv = get_runtime_info(self.tool).is_windows_hyperv
         return self._is_hyerv
 
     @property
@@ -126,11 +279,20 @@ class DockerTool(object):
 
     @property
     def image_present(self) -> bool:
+        return get_image_info(self.tool, self.image, self.inspect_image) is not None
+
+    def inspect_image(self) -> Optional[Dict[str, Any]]:
+        """
+        Inspect the image
+        :return: the image details or None if it is not present
+        """
         try:
-            self.docker_call("image", "inspect", self.image)
-            return True
-        except DockerToolFailed:
-            return False
+            if self.api:
+                return self.api_call(self.api.image_inspect, self.image)
+            output = self.docker_call("image", "inspect", self.image).stdout
+            return json.loads(output)[0]
+        except DockerToolError:
+            return None
 
     def inspect(self):
         """
@@ -138,14 +300,24 @@ class DockerTool(object):
         :return:
         """
         if self.image:
-            if not self.image_present:
-                if self.can_pull:
-                    self.pull()
-            try:
-                output = self.docker_call("image", "inspect", self.image).stdout
-                return json.loads(output)[0]
-            except DockerToolError:
-                pass
+            data = self.inspect_image()
+            if data is None and self.can_pull:
+                self.pull()
+                data = self.inspect_image()
+            return data
+        return None
+
+    def image_info(self) -> Optional[ImageInfo]:
+        """
+        Get the cached details of the image, pulling it if it is missing
+        :return:
+        """
+        if self.image:
+            found = get_image_info(self.tool, self.image, self.inspect_image)
+            if found is None and self.can_pull:
+                self.pull()
+                found = get_image_info(self.tool, self.image, self.inspect_image)
+            return found
         return None
 
     def add_file(self, src, dest):
@@ -169,10 +341,28 @@ class DockerTool(object):
             info(f"Resume hyperv container {self.name} after file copy..")
             self.docker_call("start", self.name)
 
+    def write_file(self, path: str, content: str, user=None):
+        """
+        Write a file in the container
+        :param path: the file to write
+        :param content: the text to write
+        :param user: write the file as this user
+        :return:
+        """
+        if self.api:
+            self.api_check_call(["sh", "-c", f"cat > {shlex.quote(path)}"],
+                                user=user, stdin=content.encode("utf-8"))
+            return
+        cmdline = [self.tool, "exec", "-i"]
+        if user is not None:
+            cmdline.extend(["-u", str(user)])
+        cmdline.extend([self.container, "sh", "-c", f"cat > {shlex.quote(path)}"])
+        subprocess.run(cmdline, input=content.encode("utf-8"), check=True)
+
     def get_user(self):
-        image = self.inspect()
-        if image and len(image) > 0:
-            return image.get("Config", {}).get("User", None)
+        image = self.image_info()
+        if image:
+            return image.user
         return None
 
     def pull(self):
@@ -181,23 +371,45 @@ class DockerTool(object):
             sys.stdout.write("Pulling {}...\n".format(self.image))
             sys.stdout.flush()
             try:
-                self.docker_call("pull", self.image)
+                self.pull_image(self.image)
                 self.pulled = True
             except DockerToolFailed as err:
                 info(f"error pulling image: {err}")
                 fatal(f"cannot pull image: {self.image} - image not found")
 
     def get_envs(self):
+        """
+        Get the docker arguments to set the environment. Values go in an --env-file except multi-line
+        values which the env file format cannot hold.
+        :return:
+        """
         cmdline = []
+        lines = []
         for name in self.env:
             value = self.env.get(name)
-            if value is not None:
+            if value is None:
+                lines.append(name)
+            elif "\n" in str(value) or "\r" in str(value):
                 cmdline.extend(["-e", "{}={}".format(name, value)])
             else:
-                cmdline.extend(["-e", name])
+                lines.append("{}={}".format(name, value))
+        if lines:
+            if self._env_file is None:
+                fd, self._env_file = tempfile.mkstemp(prefix="gle-", suffix=".env")
+                os.close(fd)
+            with open(self._env_file, "w", encoding="utf-8") as envfile:
+                envfile.write("\n".join(lines) + "\n")
+            cmdline = ["--env-file", self._env_file] + cmdline
         return cmdline
 
-    def run(self, detached=True, args: Optional[List[str]] = None):
+    def cleanup(self):
+        """Remove any temporary files"""
+        if self._env_file is not None:
+            if os.path.exists(self._env_file):
+                os.unlink(self._env_file)
+            self._env_file = None
+
+    def run(self, detached=True, args: Optional[List[str]] = None, with_env=True):
         priv = self.privileged and not is_windows()
         if self.is_windows_hyperv():  # pragma: cover if windows
             warning("windows hyperv container support is very experimental, YMMV")
@@ -208,13 +420,17 @@ class DockerTool(object):
                 entry += ":rw"
             volumes.append(entry)
         try:
-            image = self.inspect()
+            image = self.image_info()
             if self.entrypoint == ['']:
-                if image.get("Os") == "linux":  # pragma: cover if not windows
+                if image and image.os == "linux":  # pragma: cover if not windows
                     self.entrypoint = "/bin/sh"
                 else:
                     self.entrypoint = None
             info(f"launching image {self.image} as container {self.name} ..")
+            if self.api:
+                self.run_api(volumes, priv, args, with_env)
+                info(f"started container {self.container}")
+                return
 
             cmdline = ["run"]
             if detached:
@@ -232,8 +448,8 @@ class DockerTool(object):
                 cmdline.append("--rm")
             for volume in volumes:
                 cmdline.extend(["-v", volume])
-            for name, value in self.env.items():
-                cmdline.extend(["-e", f"{name}={value}"])
+            if with_env:
+                cmdline.extend(self.get_envs())
             cmdline.extend(["-i", self.image])
 
             if not is_windows():
@@ -247,23 +463,99 @@ class DockerTool(object):
             self.container = proc.stdout.strip()
             info(f"started container {self.container}")
         except DockerToolFailed:  # pragma: no cover
+            # the image may have been removed since we saw it
+            forget_image_info(self.tool, self.image)
             if not self.image_present:
                 fatal(f"Docker image {self.image} does not exist, (pull_policy={self.pull_policy})")
             warning(f"problem running {self.image}")
             raise
 
+    def run_api(self, volumes: List[str], privileged: bool, args: Optional[List[str]], with_env: bool):
+        """Create and start the container using the docker engine API"""
+        config: Dict[str, Any] = {
+            "Image": self.image,
+            "OpenStdin": True,
+            "HostConfig": {
+                "Binds": volumes,
+                "Privileged": privileged,
+                "AutoRemove": True,
+            },
+        }
+        if self.entrypoint is not None:
+            config["Entrypoint"] = [str(self.entrypoint)]
+        cmd = []
+        if self.entrypoint == "":
+            cmd.append("/bin/sh")
+        if args:
+            cmd.extend(args)
+        if cmd:
+            config["Cmd"] = cmd
+        if self.network is not None:
+            config["HostConfig"]["NetworkMode"] = self.network
+        if with_env:
+            config["Env"] = self.get_api_envs()
+        self.container = self.api_call(self.api.container_create, config, name=self.name)
+        self.api_call(self.api.container_start, self.container)
+
+    def get_api_envs(self) -> List[str]:
+        """Get the environment as a list for the docker engine API"""
+        envs = []
+        for name, value in self.env.items():
+            if value is None:
+                envs.append(name)
+            else:
+                envs.append(f"{name}={value}")
+        return envs
+
     def kill(self):
         if self.container:
-            self.docker_call("kill", "-s", "9", self.container)
+            self.kill_container(self.container, "9")
 
-    def check_call(self, cwd: str, cmd: List[str], stdout=None, stderr=None, capture=False):
-        cmdline = [self.tool, "exec", "-w", cwd, self.container] + cmd
+    def signal_processes(self, signal: str) -> None:
+        """Send a signal to every process in the container except its init process"""
+        try:
+            self.check_call("/", ["sh", "-c", f"kill -{signal} -1"], capture=True, user="0", stderr=subprocess.DEVNULL)
+        except (subprocess.CalledProcessError, GitlabEmulatorError) as err:
+            warning(f"could not signal processes in {self.container}: {err}")
+
+    def api_exec(self, cwd: Optional[str], cmd: List[str], user=None, with_env=False):
+        """Start a process in the container using the docker engine API"""
+        env = self.get_api_envs() if with_env else None
+        exec_id = self.api_call(self.api.exec_create, self.container, cmd, workdir=cwd, env=env, user=user)
+        return self.api_call(self.api.exec_start, exec_id)
+
+    def api_check_call(self, cmd: List[str], cwd: Optional[str] = None, user=None, stdin: Optional[bytes] = None) -> bytes:
+        """Run a process in the container using the docker engine API, return the output"""
+        proc = self.api_exec(cwd, cmd, user=user)
+        if stdin:
+            proc.stdin.write(stdin)
+        proc.stdin.close()
+        output = proc.stdout.read()
+        proc.stdout.close()
+        if proc.wait():
+            raise subprocess.CalledProcessError(proc.returncode, cmd, output=output)
+        return output
+
+    def check_call(self, cwd: str, cmd: List[str], stdout=None, stderr=None, capture=False, user=None):
+        if self.api:
+            output = self.api_check_call(cmd, cwd=cwd, user=user)
+            if capture:
+                return output
+            if stdout is None:
+                sys.stdout.write(output.decode("utf-8", errors="replace"))
+            return 0
+        cmdline = [self.tool, "exec", "-w", cwd]
+        if user is not None:
+            cmdline.extend(["-u", str(user)])
+        cmdline += [self.container] + cmd
         if capture:
             return subprocess.check_output(cmdline, stderr=stderr)
         else:
             return subprocess.check_call(cmdline, stdout=stdout, stderr=stderr)
 
     def exec(self, cwd: str, shell: List[str], tty=False, user=None, pipe=True):
+        if self.api and pipe and not tty:
+            return self.api_exec(cwd, shell, user=user, with_env=True)
         cmdline = [self.tool, "exec", "-w", cwd]
         cmdline.extend(self.get_envs())
         if user is not None:
@@ -274,6 +566,8 @@ class DockerTool(object):
         cmdline.extend(["-i", self.container])
         cmdline.extend(shell)
 
+        if pipe and async_runner_enabled():
+            return popen(cmdline, stdin=subprocess.PIPE)
         if pipe:
             proc = subprocess.Popen(cmdline,
                                     shell=False,
@@ -301,6 +595,10 @@ class DockerJob(Job):
         self._has_bash = None
         self._shell_uid = 0
         self._shell_gid = 0
+        self._pooled: Optional[PooledContainer] = None
+        self._pulling: Optional[Future] = None
+        # the docker exec running a script right now
+        self.script_process = None
 
     @property
     def shell_is_user(self):
@@ -373,7 +671,7 @@ class DockerJob(Job):
 
     def load(self, name, config, overrides: Optional[Dict[str, Any]] = None):
         super(DockerJob, self).load(name, config, overrides=overrides)
-        self.services = get_services(config, name)
+        self.services = get_services(self._config, name)
         pull_policy = self.docker_pull_policy
         if pull_policy is not None:
             self.docker.pull_policy = pull_policy
@@ -404,6 +702,13 @@ class DockerJob(Job):
             time.sleep(1)
 
         if self.container and self.docker.container:
+            script = self.script_process
+            grace = get_abort_grace()
+            if grace and script is not None and script.poll() is None and not is_windows():
+                # give the script (and anything it started) a chance to exit cleanly
+                info("stopping processes in container {}".format(self.name))
+                self.docker.signal_processes("TERM")
+                wait_for_exit(script, grace)
             info("kill container {}".format(self.name))
             self.docker.kill()
         if self.build_process is not None:
@@ -430,35 +735,54 @@ class DockerJob(Job):
             if self.shell_is_user:  # pragma: cover if posix
                 user = self._shell_uid
 
-        filename = "generated-gitlab-script" + self.get_script_fileext()
-        temp = os.path.join(tempfile.gettempdir(), filename)
+        interactive = bool(self.enter_shell or self.error_shell)
+        if interactive:  # pragma: no cover
+            try:
+                if not os.isatty(sys.stdin.fileno()):
+                    interactive = False
+            except OSError:
+                # probably under pycharm pytest
+                interactive = False
+
+        # each script gets its own name so that concurrent jobs do not overwrite each other
+        filename = f"gle-script-{uuid.uuid4().hex[:12]}{self.get_script_fileext()}"
+        temp = None
+        script = None
         try:
-            with open(temp, "w") as fd:
-                print(lines, file=fd)
-            # copy it to the container
-            dest = "/tmp"
             if is_windows():  # pragma: cover if windows
+                temp = tempfile.mkdtemp()
+                generated = os.path.join(temp, filename)
+                with open(generated, "w") as fd:
+                    print(lines, file=fd)
                 dest = "c:\\windows\\temp"
-            target_script = os.path.join(dest, filename)
-            info("Copying {} to container as {} ..".format(temp, target_script))
-            self.docker.add_file(temp, dest)
+                target_script = os.path.join(dest, filename)
+                info("Copying {} to container as {} ..".format(generated, target_script))
+                self.docker.add_file(generated, dest)
+                cmdline = self.shell_command(target_script)
+            else:  # pragma: cover if not windows
+                target_script = f"/tmp/{filename}"
+                if interactive:  # pragma: no cover
+                    # stdin is the terminal, so save the script first
+                    self.docker.write_file(target_script, lines + "\n", user=user)
+                    cmdline = self.shell_command(target_script)
+                else:
+                    # send the script to the exec's stdin
+                    command = " ".join(shlex.quote(x) for x in self.shell_command(target_script))
+                    cmdline = ["/bin/sh", "-c", STREAM_SCRIPT.format(script=shlex.quote(target_script),
+                                                                     command=command)]
+                    script = (lines + "\n").encode("utf-8")
 
             while attempts > 0:
                 try:
-                    interactive = bool(self.enter_shell or self.error_shell)
-                    if interactive:  # pragma: no cover
-                        try:
-                            if not os.isatty(sys.stdin.fileno()):
-                                interactive = False
-                        except OSError:
-                            # probably under pycharm pytest
-                            interactive = False
-                    cmdline = self.shell_command(target_script)
                     task = self.docker.exec(self.inside_workspace,
                                             cmdline,
                                             tty=interactive,
                                             user=user)
-                    self.communicate(task, script=None)
+                    self.script_process = task
+                    try:
+                        self.communicate(task, script=script)
+                    finally:
+                        self.script_process = None
                     break
                 except DockerExecError:  # pragma: no cover
                     self.stdout.write(
@@ -470,26 +794,21 @@ class DockerJob(Job):
                         time.sleep(2)
             return task
         finally:
-            if os.path.exists(temp):
-                os.unlink(temp)
+            if temp is not None:  # pragma: cover if windows
+                shutil.rmtree(temp)
 
-    def check_docker_exec_failed(self, line):
+    def check_docker_exec_failed(self, lines):
         """
         Raise an error if the build script has returned "No such exec instance"
-        :param line:
+        :param lines: complete lines of output, as bytes
         :return:
         """
-        if line:
-            try:
-                decoded = line.decode()
-            except Exception:
-                return
-            if decoded:
-                if "No such exec instance" in decoded:
-                    raise DockerExecError()
+        # search the bytes, so that output that is not utf-8 cannot hide the error
+        if lines and b"No such exec instance" in lines:
+            raise DockerExecError()
 
     def communicate(self, process, script=None):
-        comm(process, self.stdout, script=script, linehandler=self.check_docker_exec_failed)
+        comm(process, self.stdout, script=script, linehandler=self.check_docker_exec_failed, joblog=self.joblog)
 
     def has_bash(self):
         """
@@ -498,7 +817,10 @@ class DockerJob(Job):
         """
         if self._has_bash is None:
             self._has_bash = False
-            if not is_windows():
+            image = self.docker.image_info()
+            if image and image.has_bash is not None:
+                self._has_bash = image.has_bash
+            elif not is_windows():
                 info("checking container for bash")
                 try:
                     self.docker.check_call(
@@ -509,6 +831,8 @@ class DockerJob(Job):
                     info("bash found")
                 except subprocess.CalledProcessError as cpe:
                     assert cpe
+                if image:
+                    set_image_has_bash(image, self._has_bash)
         return self._has_bash
 
     def shell_on_error(self):
@@ -520,6 +844,90 @@ class DockerJob(Job):
         lines = "\n".join(self.error_shell)
         self.run_script(lines)
 
+    def bootstrap_script(self) -> str:
+        """
+        Get a script that does all the setup a job needs in the container in one docker exec
+        :return:
+        """
+        lines = []
+        image = self.docker.image_info()
+        if image is None or image.has_bash is None:
+            lines.append(f"command -v bash >/dev/null 2>&1 && echo {BOOTSTRAP_HAS_BASH}")
+        # work out default USER from the image
+        docker_user_cfg = self.docker.get_user()
+        if docker_user_cfg and ":" in docker_user_cfg:
+            info(f"Container image defines USER: {docker_user_cfg}")
+            docker_user, docker_grp = docker_user_cfg.split(":", 1)
+            info(f"Setting ownership to {docker_user}:{docker_grp}")
+            lines.append(f"chown -R {shlex.quote(docker_user)}.{shlex.quote(docker_grp)} .")
+
+        if self.shell_is_user:
+            # try to make a more functional user account inside the container, this may not always
+            # work due to missing tools, but it's worth a try
+            username = "gle"
+            groupname = username
+            # try to get the running user's name
+            try:
+                username = getpass.getuser()
+            except:
+                pass
+
+            _homedir = "/gle-tmp-home"
+            _passwd = f"{username}:x:{self._shell_uid}:{self._shell_gid}:gitlab-emulator:{_homedir}:/bin/sh"
+            _group = f"{groupname}:x:{self._shell_gid}:"
+            _shadow = f"{username}:!:{self._shell_uid}::::::"
+            _sudoers = f"{username} ALL=(ALL) NOPASSWD: ALL"
+            info(f"setting up interactive user with uid={self._shell_uid}..")
+            setup = [
+                f"echo {shlex.quote(_passwd)} >> /etc/passwd",
+                f"echo {shlex.quote(_group)} >> /etc/group",
+                f"echo {shlex.quote(_shadow)} >> /etc/shadow",
+                f"mkdir {_homedir}",
+                f"chown {self._shell_uid} {_homedir}",
+                f"chgrp {self._shell_gid} {_homedir}",
+                # append this user to the sudoers file
+                f"echo {shlex.quote(_sudoers)} >> /etc/sudoers",
+            ]
+            lines.append("{ " + " && ".join(setup) + f"; }} || echo {BOOTSTRAP_USER_FAILED}")
+
+        if self._pooled is None or "git_safe_dir" not in self._pooled.prepared:
+            info("attempting to set git safe.directory..")
+            folder = shlex.quote(self.inside_workspace)
+            lines.append(f"command -v git >/dev/null 2>&1 && git config --system --add safe.directory {folder}")
+        lines.append("exit 0")
+        return "\n".join(lines)
+
+    def prepare_container(self):
+        """Run the bootstrap script as root in the container"""
+        info("preparing container..")
+        output = ""
+        completed = False
+        try:
+            output = self.docker.check_call(self.inside_workspace, ["sh", "-c", self.bootstrap_script()],
+                                            capture=True,
+                                            stderr=subprocess.STDOUT,
+                                            user="0").decode("utf-8", errors="replace")
+            completed = True
+        except subprocess.CalledProcessError as cpe:
+            warning(f"container setup failed: {cpe}")
+        found = output.splitlines()
+        image = self.docker.image_info()
+        if image and image.has_bash is not None:
+            self._has_bash = image.has_bash
+        else:
+            self._has_bash = BOOTSTRAP_HAS_BASH in found
+            if completed and image:
+                set_image_has_bash(image, self._has_bash)
+        if self._has_bash:
+            info("bash found")
+        if self.shell_is_user:
+            if BOOTSTRAP_USER_FAILED in found:
+                warning("interactive user setup failed, some features may not work fully.")
+            else:
+                info("interactive user setup completed.")
+        if self._pooled is not None:
+            self._pooled.prepared.add("git_safe_dir")
+
     def git_safe_dir(self):
         """Configure git safe.directory if possible"""
         info("attempting to set git safe.directory..")
@@ -531,6 +939,63 @@ class DockerJob(Job):
         info(f"running {cmdline}")
         self.run_script(cmdline)
 
+    def can_pool_container(self) -> bool:
+        """Return True if this job can use a container from the pool and return it afterwards"""
+        if is_windows() or self.services:
+            return False
+        return not (self.enter_shell or self.error_shell or self.shell_is_user)
+
+    def pull_image(self):
+        if self._pulling is not None:
+            # wait for the pull started by start_pulling_image()
+            pulling = self._pulling
+            self._pulling = None
+            pulling.result()
+        elif self.docker.pull_always or (self.docker.pull_if_not_present and not self.docker.image_present):
+            self.docker.pull()
+
+    def start_pulling_image(self):
+        """Pull the job image in the background while other things start"""
+        executor = ThreadPoolExecutor(max_workers=1)
+        self._pulling = executor.submit(self.pull_image)
+        executor.shutdown(wait=False)
+
+    def start_container(self, pool: Optional[ContainerPool]):
+        """Start the container for this job or take one from the pool"""
+        if pool is not None:
+            key = pool_key(self.docker.tool, self.docker.image, self.docker.entrypoint,
+                           self.docker.volumes, self.docker.privileged)
+            self._pooled = pool.acquire(key)
+            if self._pooled is not None:
+                self.container = self._pooled.name
+                self.docker.name = self._pooled.name
+                self.docker.container = self._pooled.container
+                return
+            self.pull_image()
+            # pooled containers get the job environment from each exec so the next job starts clean
+            self.docker.run(with_env=False)
+            self._pooled = PooledContainer(key, self.docker.container, self.container)
+        else:
+            self.pull_image()
+            self.docker.run()
+
+    def stop_container(self, pool: Optional[ContainerPool]):
+        """Kill the container, or return it to the pool if the job passed"""
+        self.docker.cleanup()
+        if pool is not None and self._pooled is not None:
+            if self.build_process and self.build_process.returncode == 0 and not self.timed_out:
+                pool.release(self._pooled)
+                return
+        if self.docker.api:
+            try:
+                self.docker.kill_container(self.container)
+            except DockerToolError as err:
+                info(f"could not kill {self.container}: {err}")
+        else:
+            subprocess.call([self.docker.tool, "kill", self.container], stderr=subprocess.STDOUT)
+        if self.docker.is_windows_hyperv():  # pragma: no cover
+            subprocess.call([self.docker.tool, "rm", self.container])
+
     def run_impl(self):
         info(f"running docker job {self.name}")
         info(f"runner = {self.runner}")
@@ -554,105 +1019,63 @@ class DockerJob(Job):
                 if self.error_shell or self.enter_shell:
                     self.docker.add_env("PS1", f"[{self.name}] \\u@{image_name}:$PWD $ ")
 
-            if self.docker.pull_always or (self.docker.pull_if_not_present and not self.docker.image_present):
-                self.docker.pull()
+            pool = None
+            if self.can_pool_container():
+                pool = get_container_pool()
 
             environ = self.get_envs(expand_only_ci=False)
-            with docker_services(self, environ) as network:
-                if network:
-                    self.docker.network = network
-                for envname in environ:
-                    self.docker.add_env(envname, environ[envname])
-
-                if self.docker_entrypoint is not None:
-                    # can't have multiple args
-                    args = self.docker_entrypoint
-                    if len(args) > 0:
-                        if len(args) > 1:
-                            warning("windows docker entrypoint override may fail with several args")
-                        self.docker.entrypoint = args[0]
-                volumes = self.runner.docker.runtime_volumes()
-                if volumes:
-                    info("Extra docker volumes registered:")
-                    for item in volumes:
-                        info("- {}".format(item))
-
-                self.docker.volumes = volumes + [f"{self.workspace}:{self.inside_workspace}:rw"]
-
-                self.docker.run()
-
-                if not is_windows():  # pragma: cover if not windows
-                    # work out default USER from the image
-                    docker_user_cfg = self.docker.get_user()
-                    if docker_user_cfg and ":" in docker_user_cfg:
-                        info(f"Container image defines USER: {docker_user_cfg}")
-                        docker_user, docker_grp = docker_user_cfg.split(":", 1)
-                        info(f"Setting ownership to {docker_user}:{docker_grp}")
-                        self._run_script(f"chown -R {docker_user}.{docker_grp} .", attempts=1, user="0")
-
-                if self.shell_is_user:
-                    if not is_windows():  # pragma: cover if not windows
-                        # try to make a more functional user account inside the container, this may not always
-                        # work due to missing tools, but it's worth a try
-                        username = "gle"
-                        groupname = username
-                        if not is_windows():
-                            # try to get the running user's name
-                            try:
-                                username = getpass.getuser()
-                            except:
-                                pass
-
-                        _homedir = "/gle-tmp-home"
-                        _passwd = f"{username}:x:{self._shell_uid}:{self._shell_gid}:gitlab-emulator:{_homedir}:/bin/sh"
-                        _group = f"{groupname}:x:{self._shell_gid}:"
-                        _shadow = f"{username}:!:{self._shell_uid}::::::"
-                        try:
-                            info(f"setting up interactive user with uid={self._shell_uid}..")
-                            self.docker.check_call("/",
-                                                   ["sh", "-c", f"echo {_passwd} >> /etc/passwd"], capture=True)
-                            self.docker.check_call("/",
-                                                   ["sh", "-c", f"echo {_group} >> /etc/group"], capture=True)
-                            self.docker.check_call("/",
-                                                   ["sh", "-c", f"echo {_shadow} >> /etc/shadow"], capture=True)
-                            self.docker.check_call("/",
-                                                   ["mkdir", _homedir], capture=True)
-                            self.docker.check_call("/",
-                                                   ["chown", str(self._shell_uid), _homedir], capture=True)
-                            self.docker.check_call("/",
-                                                   ["chgrp", str(self._shell_gid), _homedir], capture=True)
-                            # append this user to the sudoers file
-                            info(f"granting sudo inside container..")
-                            self.docker.check_call("/",
-                                                   [
-                                                       "sh", "-c",
-                                                       f"echo '{username} ALL=(ALL) NOPASSWD: ALL' >> /etc/sudoers"])
-                            info("interactive user setup completed.")
-                        except subprocess.CalledProcessError:
-                            warning("interactive user setup failed, some features may not work fully.")
-
-                self.git_safe_dir()
-
-                try:
-                    lines = self.before_script + self.script
-                    if self.enter_shell:
-                        lines.extend(self.get_interactive_shell_command())
+            if self.services:
+                self.start_pulling_image()
+            try:
+                with docker_services(self, environ) as network:
+                    if network:
+                        self.docker.network = network
+                    for envname in environ:
+                        self.docker.add_env(envname, environ[envname])
+
+                    if self.docker_entrypoint is not None:
+                        # can't have multiple args
+                        args = self.docker_entrypoint
+                        if len(args) > 0:
+                            if len(args) > 1:
+                                warning("windows docker entrypoint override may fail with several args")
+                            self.docker.entrypoint = args[0]
+                    volumes = self.runner.docker.runtime_volumes()
+                    if volumes:
+                        info("Extra docker volumes registered:")
+                        for item in volumes:
+                            info("- {}".format(item))
+
+                    self.docker.volumes = volumes + [f"{self.workspace}:{self.inside_workspace}:rw"]
+
+                    self.start_container(pool)
+
+                    if is_windows():  # pragma: cover if windows
+                        self.git_safe_dir()
+                    else:  # pragma: cover if not windows
+                        self.prepare_container()
 
-                    self.build_process = self.run_script(make_script(lines, powershell=self.is_powershell()))
-                finally:
                     try:
-                        if self.error_shell:  # pragma: no cover
-                            if not self.build_process or self.build_process.returncode:
-                                self.shell_on_error()
-                        if self.after_script:
-                            info("Running after_script..")
-                            self.run_script(make_script(self.after_script, powershell=self.is_powershell()))
-                    except subprocess.CalledProcessError:  # pragma: no cover
-                        pass
+                        lines = self.before_script + self.script
+                        if self.enter_shell:
+                            lines.extend(self.get_interactive_shell_command())
+
+                        self.build_process = self.run_script(make_script(lines, powershell=self.is_powershell()))
                     finally:
-                        subprocess.call([self.docker.tool, "kill", self.container], stderr=subprocess.STDOUT)
-                        if self.docker.is_windows_hyperv():  # pragma: no cover
-                            subprocess.call([self.docker.tool, "rm", self.container])
+                        try:
+                            if self.error_shell:  # pragma: no cover
+                                if not self.build_process or self.build_process.returncode:
+                                    self.shell_on_error()
+                            if self.after_script:
+                                info("Running after_script..")
+                                self.run_script(make_script(self.after_script, powershell=self.is_powershell()))
+                        except subprocess.CalledProcessError:  # pragma: no cover
+                            pass
+                        finally:
+                            self.stop_container(pool)
+            finally:
+                # the env file holds every job variable, remove it even if the container did not start
+                self.docker.cleanup()
 
         result = self.build_process.returncode
         if result:
@@ -696,85 +1119,124 @@ def get_services(config, jobname):
     return service_defs
 
 
+def service_settings(service) -> Dict[str, Any]:
+    """
+    Get the image, aliases and variables of a service
+    :param service: a service name or definition
+    :return:
+    """
+    if isinstance(service, str):
+        service = {"name": service}
+    image = service["name"]
+    name = image
+    if ":" in name:
+        name = image.split(":", 1)[0]
+    aliases = [name.replace("/", "-")]
+    if "alias" in service:
+        aliases.append(service["alias"])
+    return {
+        "image": image,
+        "name": name,
+        "aliases": aliases,
+        "variables": dict(service.get("variables", None) or {}),
+    }
+
+
+def start_service(job: DockerJob,
+                  settings: Dict[str, Any],
+                  variables: Dict[str, str],
+                  network: ServiceNetwork,
+                  started: List[str]) -> None:
+    """
+    Pull, start and connect a service container then wait for it to be ready
+    :param job: the job using the service
+    :param settings: from service_settings()
+    :param variables: the job variables
+    :param network: the service network
+    :param started: append the container to this list as soon as it has started
+    :return:
+    """
+    image = settings["image"]
+    name = settings["name"]
+    aliases = settings["aliases"]
+    probe = settings["probe"]
+    job.stdout.write(f"create docker service : {name} ({aliases})\n")
+    if job.docker.can_pull:
+        try:
+            job.stdout.write(f"pulling {image} ..\n")
+            job.docker.pull_image(image)
+        except DockerToolFailed:  # pragma: no cover
+            fatal(f"No such image {image}")
+    envs = dict(variables)
+    envs.update(settings["variables"])
+    container = job.docker.run_service(image, envs, not is_windows())
+    network.acquire()
+    started.append(container)
+    info(f"service {name} is container {container}")
+    info(f"connect {name} to service network")
+    job.docker.connect_network(network.name, container, aliases)
+    if probe.kind != PROBE_NONE:
+        info(f"waiting for service {name} ({probe})")
+        if wait_until_ready(job.docker, container, probe, network.name):
+            info(f"service {name} is ready")
+        else:
+            warning(f"service {name} was not ready after {probe.timeout}s ({probe}), continuing anyway")
+
+
+def stop_services(tool: DockerTool, containers: List[str], network: Optional[ServiceNetwork]) -> None:
+    """Kill service containers and let go of their network"""
+    for container in containers:
+        info(f"clean up docker service {container}")
+        try:
+            tool.kill_container(container, "9")
+        except DockerToolError as err:  # pragma: no cover
+            info(f"could not kill service {container}: {err}")
+        if network is not None:
+            network.release()
+
+
+def wait_for_service_teardown() -> None:
+    """Wait for services of finished jobs to be removed"""
+    with _teardown_lock:
+        pending = list(_teardown_threads)
+        _teardown_threads.clear()
+    for thread in pending:
+        thread.join()
+
+
 @contextmanager
 def docker_services(job: DockerJob, variables: Dict[str, str]):
     """
-    Setup docker services required by the given job
+    Setup docker services required by the given job, the services are started at the same time and
+    removed in the background after the job
     :param job:
     :param variables: dict of env vars to set in the service container
     :return:
     """
-    services = job.services
-    service_network = None
+    services = [service_settings(x) for x in job.services]
+    for settings in services:
+        settings["probe"] = parse_readiness(settings["variables"])
+    network = None
     containers = []
     try:
         if services:
-            net_name = "gle-service-network"
-            try:
-                job.docker.docker_call("network", "inspect", net_name)
-            except DockerToolFailed:
-                job.docker.docker_call(
-                    "network", "create",
-                    "--driver", "bridge",
-                    "--subnet", "192.168.94.0/24",
-                    net_name
-                )
-
-            for service in services:
-                aliases = []
-                if isinstance(service, str):
-                    image = service
-                    service = {
-                        "name": image
-                    }
-                else:
-                    image = service["name"]
-                name = image
-                if ":" in name:
-                    name = image.split(":", 1)[0]
-                aliases.append(name.replace("/", "-"))
-                if "alias" in service:
-                    aliases.append(service["alias"])
-
-                job.stdout.write(f"create docker service : {name} ({aliases})\n")
-                if job.docker.can_pull:
-                    try:
-                        job.stdout.write(f"pulling {image} ..\n")
-                        job.docker.docker_call("pull", image)
-                    except DockerToolFailed:  # pragma: no cover
-                        fatal(f"No such image {image}")
-                priv = not is_windows()
-                service_cmdline = [
-                    "run",
-                    "--rm",
-                    "-d",
-                ]
-                if priv:  # pragma: cover if not windows
-                    service_cmdline.append("--privileged")
-                for envname, value in variables.items():
-                    service_cmdline.extend(["-e", f"{envname}={value}"])
-                service_cmdline.append(image)
-
-                container = job.docker.docker_call(
-                    *service_cmdline
-                ).stdout.strip()
-
-                info(f"creating docker service {name} ({aliases})")
-                info(f"service {name} is container {container}")
-                containers.append(container)
-                info(f"connect {name} to service network")
-                connect_cmdline = [
-                    "network", "connect"
-                ]
-                for alias in aliases:
-                    connect_cmdline.extend(["--alias", alias])
-                connect_cmdline.extend([net_name, container])
-                job.docker.docker_call(*connect_cmdline)
-                service_network = net_name
-
-        yield service_network
+            # each job gets its own network so concurrent jobs and gle processes can use the same aliases
+            network = create_service_network(job.docker)
+
+            with ThreadPoolExecutor(max_workers=len(services)) as executor:
+                starting = [executor.submit(start_service, job, x, variables, network, containers)
+                            for x in services]
+            for item in starting:
+                item.result()
+
+        yield network.name if network else None
     finally:
-        for container in containers:
-            info(f"clean up docker service {container}")
-            job.docker.docker_call("kill", "-s", "9", container)
-        time.sleep(1)
+        if network is not None:
+            # non-daemon, so gle waits for the services to be removed before it exits
+            thread = threading.Thread(target=stop_services, args=(job.docker, list(containers), network),
+                                      name=f"{job.name}-services")
+            with _teardown_lock:
+                _teardown_threads.append(thread)
+            thread.start()
+            # the job container has gone
+            network.release()
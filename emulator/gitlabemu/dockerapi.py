@@ -0,0 +1,422 @@
+"""
+Talk to the docker engine API over its unix socket instead of running the docker command line tool
+"""
+import http.client
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import urllib.parse
+from typing import Dict, Any, Optional, List, Tuple
+
+from .errors import GitlabEmulatorError
+from .logmsg import debug, warning
+
+DOCKER_BACKEND_ENV = "GLE_DOCKER_BACKEND"
+DOCKER_BACKEND_CLI = "cli"
+DOCKER_BACKEND_API = "api"
+DOCKER_BACKENDS = [DOCKER_BACKEND_CLI, DOCKER_BACKEND_API]
+DEFAULT_DOCKER_SOCKET = "/var/run/docker.sock"
+# requests that can be sent again if the engine may or may not have seen them
+IDEMPOTENT_METHODS = ["GET", "HEAD"]
+# idle connections kept open for later requests, requests made at the same time each get their own connection
+API_IDLE_CONNECTIONS = 4
+# exec_inspect calls to make when an exec's output has ended but the engine still shows it running
+EXEC_EXIT_CHECKS = 50
+
+_clients: Dict[str, "DockerApiClient"] = {}
+_clients_lock = threading.Lock()
+
+
+class DockerApiError(GitlabEmulatorError):
+    """The docker engine returned an error"""
+    def __init__(self, status: int, message: str):
+        super().__init__(f"docker api error {status}: {message}")
+        self.status = status
+        self.message = message
+
+
+def docker_socket_path() -> Optional[str]:
+    """
+    Get the path of the docker engine unix socket from DOCKER_HOST or the default location
+    :return: None if the engine is not listening on a local unix socket
+    """
+    host = os.getenv("DOCKER_HOST", "")
+    if host:
+        if host.startswith("unix://"):
+            return host[len("unix://"):]
+        return None
+    if os.path.exists(DEFAULT_DOCKER_SOCKET):
+        return DEFAULT_DOCKER_SOCKET
+    return None
+
+
+def split_image_tag(image: str) -> Tuple[str, str]:
+    """Split an image name into the name and tag (or digest) the engine expects when pulling"""
+    if "@" in image:
+        name, digest = image.split("@", 1)
+        return name, digest
+    slash = image.rfind("/")
+    colon = image.rfind(":")
+    if colon > slash:
+        return image[:colon], image[colon + 1:]
+    return image, "latest"
+
+
+def demux_frame_header(header: bytes) -> int:
+    """Get the payload size from the header of a multiplexed stdout/stderr frame"""
+    _, size = struct.unpack(">BxxxL", header)
+    return size
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """An HTTP connection to a unix socket"""
+
+    def __init__(self, socket_path: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class ApiExecInput:
+    """The stdin of an exec, closing it tells the process there is no more input"""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.closed = False
+
+    def write(self, data: bytes) -> int:
+        self.sock.sendall(data)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            try:
+                self.sock.shutdown(socket.SHUT_WR)
+            except OSError:  # pragma: no cover
+                pass
+
+
+class ApiExecProcess:
+    """
+    A Popen-like view of a process started with the exec API, stdout and stderr are read from
+    the hijacked connection and merged into stdout.
+    """
+
+    def __init__(self, client: "DockerApiClient", exec_id: str, sock: socket.socket, pending: bytes):
+        self.client = client
+        self.exec_id = exec_id
+        self.pid = None
+        self.args = ["exec", exec_id]
+        self.stderr = None
+        self.returncode: Optional[int] = None
+        self.sock = sock
+        self.stdin = ApiExecInput(sock)
+        read_fd, self._write_fd = os.pipe()
+        self.stdout = os.fdopen(read_fd, "rb")
+        self._done = threading.Event()
+        self._pump = threading.Thread(target=self._demux, args=(pending,), daemon=True)
+        self._pump.start()
+
+    def _demux(self, pending: bytes) -> None:
+        buffer = pending
+        try:
+            while True:
+                while len(buffer) >= 8:
+                    size = demux_frame_header(buffer[:8])
+                    if len(buffer) < 8 + size:
+                        break
+                    os.write(self._write_fd, buffer[8:8 + size])
+                    buffer = buffer[8 + size:]
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                buffer += data
+        except OSError as err:  # pragma: no cover
+            debug(f"exec {self.exec_id} stream ended: {err}")
+        finally:
+            os.close(self._write_fd)
+            self.sock.close()
+            self._done.set()
+
+    def poll(self) -> Optional[int]:
+        if self.returncode is None and self._done.is_set():
+            for _ in range(EXEC_EXIT_CHECKS):
+                info = self.client.exec_inspect(self.exec_id)
+                if not info.get("Running", False):
+                    self.returncode = int(info.get("ExitCode") or 0)
+                    break
+                time.sleep(0.1)  # pragma: no cover
+            else:
+                # the output has ended but the engine never reported an exit status, so it did not pass
+                warning(f"exec {self.exec_id} did not report an exit status, treating it as failed")
+                self.returncode = -1
+        return self.returncode
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[int]:
+        self._done.wait(timeout)
+        return self.poll()
+
+    def terminate(self) -> None:
+        # the API can't signal an exec, so stop reading from it
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:  # pragma: no cover
+            pass
+
+    kill = terminate
+
+
+class DockerApiClient:
+    """Make requests to the docker engine over a few persistent connections"""
+
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self._idle: List[UnixHTTPConnection] = []
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for conn in idle:
+            conn.close()
+
+    def take_connection(self) -> Tuple[UnixHTTPConnection, bool]:
+        """
+        Get a connection that no other request is using
+        :return: the connection and True if it has been used before
+        """
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return UnixHTTPConnection(self.socket_path), False
+
+    def give_back(self, conn: UnixHTTPConnection) -> None:
+        """Keep a connection for later requests, or close it if enough are kept already"""
+        with self._lock:
+            if len(self._idle) < API_IDLE_CONNECTIONS:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def request(self,
+                method: str,
+                path: str,
+                query: Optional[Dict[str, Any]] = None,
+                body: Optional[Any] = None,
+                data: Optional[bytes] = None,
+                content_type: str = "application/json") -> bytes:
+        """
+        Make a request and return the response body
+        :param method: GET, POST etc
+        :param path: the API path
+        :param query: query string parameters
+        :param body: send this as json
+        :param data: send these bytes
+        :param content_type: the type of data
+        :return:
+        """
+        url = path
+        if query:
+            url += "?" + urllib.parse.urlencode(query)
+        headers = {"Host": "docker"}
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+        if data is not None:
+            headers["Content-Type"] = content_type
+        # long requests (eg, pulls) do not hold up other requests, each request has a connection to itself
+        for attempt in range(2):
+            if attempt:
+                conn, reused = UnixHTTPConnection(self.socket_path), False
+            else:
+                conn, reused = self.take_connection()
+            sent = False
+            try:
+                conn.request(method, url, body=data, headers=headers)
+                sent = True
+                response = conn.getresponse()
+                payload = response.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                # the engine may have closed an idle connection, try once more with a new one, but only if the
+                # request could not have been carried out already
+                if attempt or not reused or (sent and method not in IDEMPOTENT_METHODS):
+                    raise
+                debug(f"retrying {method} {path} on a new connection")
+                continue
+            if response.will_close:
+                conn.close()
+            else:
+                self.give_back(conn)
+            break
+        if response.status >= 400:
+            message = payload.decode("utf-8", errors="replace")
+            try:
+                message = json.loads(message).get("message", message)
+            except ValueError:
+                pass
+            raise DockerApiError(response.status, message)
+        return payload
+
+    def get_json(self, path: str, query: Optional[Dict[str, Any]] = None) -> Any:
+        return json.loads(self.request("GET", path, query=query))
+
+    def post_json(self, path: str, body: Optional[Any] = None, query: Optional[Dict[str, Any]] = None) -> Any:
+        payload = self.request("POST", path, query=query, body=body)
+        if payload:
+            return json.loads(payload)
+        return None
+
+    def image_inspect(self, image: str) -> Dict[str, Any]:
+        return self.get_json(f"/images/{urllib.parse.quote(image, safe='/:@')}/json")
+
+    def image_pull(self, image: str) -> str:
+        """Pull an image and return the progress messages"""
+        name, tag = split_image_tag(image)
+        payload = self.request("POST", "/images/create", query={"fromImage": name, "tag": tag})
+        # the engine streams progress messages, errors are reported in the stream
+        status = []
+        for line in payload.decode("utf-8", errors="replace").splitlines():
+            if line.strip():
+                message = json.loads(line)
+                if "error" in message:
+                    raise DockerApiError(500, message["error"])
+                status.append(message.get("status", ""))
+        return "\n".join(status)
+
+    def container_list(self) -> List[str]:
+        return [x["Id"] for x in self.get_json("/containers/json")]
+
+    def container_inspect(self, container: str) -> Dict[str, Any]:
+        return self.get_json(f"/containers/{container}/json")
+
+    def container_logs(self, container: str) -> bytes:
+        """Get the stdout and stderr of a container"""
+        payload = self.request("GET", f"/containers/{container}/logs", query={"stdout": 1, "stderr": 1})
+        output = []
+        while len(payload) >= 8:
+            size = demux_frame_header(payload[:8])
+            output.append(payload[8:8 + size])
+            payload = payload[8 + size:]
+        return b"".join(output)
+
+    def container_create(self, config: Dict[str, Any], name: Optional[str] = None) -> str:
+        query = {"name": name} if name else None
+        return self.post_json("/containers/create", body=config, query=query)["Id"]
+
+    def container_start(self, container: str) -> None:
+        self.request("POST", f"/containers/{container}/start")
+
+    def container_kill(self, container: str, signal: str = "KILL") -> None:
+        self.request("POST", f"/containers/{container}/kill", query={"signal": signal})
+
+    def network_list(self) -> List[str]:
+        return [x["Name"] for x in self.get_json("/networks")]
+
+    def network_inspect(self, network: str) -> Dict[str, Any]:
+        return self.get_json(f"/networks/{network}")
+
+    def network_create(self, network: str, subnet: Optional[str] = None, driver: str = "bridge") -> str:
+        config: Dict[str, Any] = {"Name": network, "Driver": driver}
+        if subnet:
+            config["IPAM"] = {"Config": [{"Subnet": subnet}]}
+        return self.post_json("/networks/create", body=config)["Id"]
+
+    def network_connect(self, network: str, container: str, aliases: Optional[List[str]] = None) -> None:
+        self.post_json(f"/networks/{network}/connect", body={
+            "Container": container,
+            "EndpointConfig": {"Aliases": aliases or []},
+        })
+
+    def network_remove(self, network: str) -> None:
+        self.request("DELETE", f"/networks/{network}")
+
+    def exec_create(self,
+                    container: str,
+                    cmd: List[str],
+                    workdir: Optional[str] = None,
+                    env: Optional[List[str]] = None,
+                    user: Optional[str] = None) -> str:
+        config: Dict[str, Any] = {
+            "AttachStdin": True,
+            "AttachStdout": True,
+            "AttachStderr": True,
+            "Tty": False,
+            "Cmd": cmd,
+        }
+        if workdir:
+            config["WorkingDir"] = workdir
+        if env:
+            config["Env"] = env
+        if user is not None:
+            config["User"] = str(user)
+        return self.post_json(f"/containers/{container}/exec", body=config)["Id"]
+
+    def exec_start(self, exec_id: str) -> ApiExecProcess:
+        """Start an exec and take over its connection to stream stdin and output"""
+        body = json.dumps({"Detach": False, "Tty": False}).encode("utf-8")
+        request = (f"POST /exec/{exec_id}/start HTTP/1.1\r\n"
+                   "Host: docker\r\n"
+                   "Content-Type: application/json\r\n"
+                   "Connection: Upgrade\r\n"
+                   "Upgrade: tcp\r\n"
+                   f"Content-Length: {len(body)}\r\n"
+                   "\r\n").encode("utf-8") + body
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        sock.sendall(request)
+        response = b""
+        while b"\r\n\r\n" not in response:
+            data = sock.recv(4096)
+            if not data:
+                sock.close()
+                raise DockerApiError(500, f"exec {exec_id} closed before starting")
+            response += data
+        header, pending = response.split(b"\r\n\r\n", 1)
+        status = int(header.split(b" ", 2)[1])
+        if status not in [101, 200]:
+            sock.close()
+            raise DockerApiError(status, header.decode("utf-8", errors="replace"))
+        return ApiExecProcess(self, exec_id, sock, pending)
+
+    def exec_inspect(self, exec_id: str) -> Dict[str, Any]:
+        return self.get_json(f"/exec/{exec_id}/json")
+
+
+def get_docker_backend() -> str:
+    """Get the docker backend chosen by GLE_DOCKER_BACKEND"""
+    backend = os.getenv(DOCKER_BACKEND_ENV, DOCKER_BACKEND_CLI) or DOCKER_BACKEND_CLI
+    if backend not in DOCKER_BACKENDS:
+        raise GitlabEmulatorError(f"{DOCKER_BACKEND_ENV} must be one of {DOCKER_BACKENDS}")
+    return backend
+
+
+def get_docker_api(docker_cli: str) -> Optional[DockerApiClient]:
+    """
+    Get a client for the docker engine API if the api backend is selected, the docker cli is docker and the
+    engine is on a local unix socket, else None to use the cli
+    :param docker_cli: the docker cli the job would use
+    :return:
+    """
+    from .userconfigdata import DEFAULT_DOCKER_CLI
+    if get_docker_backend() != DOCKER_BACKEND_API or docker_cli != DEFAULT_DOCKER_CLI:
+        return None
+    path = docker_socket_path()
+    if path is None:
+        return None
+    with _clients_lock:
+        if path not in _clients:
+            _clients[path] = DockerApiClient(path)
+        return _clients[path]
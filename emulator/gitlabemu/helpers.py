@@ -3,17 +3,19 @@ Various useful common funcs
 """
 from __future__ import print_function
 
+import codecs
+import io
 import os.path
 import time
 from select import select
-from threading import Thread, Lock
+from threading import Thread, Lock, Event
 import sys
 import re
 import platform
 import subprocess
 from prompt_toolkit import print_formatted_text, HTML
 
-from typing import Optional, List, Dict, Union, Tuple
+from typing import Optional, List, Dict, Union, Tuple, Any
 from urllib.parse import urlparse
 
 from .errors import DockerExecError
@@ -22,6 +24,25 @@ from .logmsg import info, debug
 from .localstats import get_duration
 
 
+OUTPUT_CHUNK_SIZE = 65536
+OUTPUT_BATCH_ENV = "GLE_OUTPUT_BATCH"
+DEFAULT_OUTPUT_BATCH = 262144
+
+
+def get_output_batch_size() -> int:
+    """
+    Get the most job output to hold before writing it, set by GLE_OUTPUT_BATCH. While a batch is being
+    written no more output is read, so a job printing faster than we can write waits on its pipe.
+    :return:
+    """
+    value = os.environ.get(OUTPUT_BATCH_ENV, "")
+    try:
+        size = int(value) if value else DEFAULT_OUTPUT_BATCH
+    except ValueError:
+        size = DEFAULT_OUTPUT_BATCH
+    return max(size, 1)
+
+
 class ProcessLineProxyThread(Thread):
     def __init__(self, process, stdout, linehandler=None):
         super(ProcessLineProxyThread, self).__init__()
@@ -30,52 +51,119 @@ class ProcessLineProxyThread(Thread):
         self.stdout = stdout
         self.linehandler = linehandler
         self.daemon = True
+        self.batch_size = get_output_batch_size()
+        self.encoding = getattr(self.stdout, "encoding", None) or "utf-8"
+        try:
+            self.decoder = codecs.getincrementaldecoder(self.encoding)("replace")
+        except LookupError:  # pragma: no cover
+            self.encoding = "utf-8"
+            self.decoder = codecs.getincrementaldecoder(self.encoding)("replace")
+        # the end of output that has not yet been passed to linehandler
+        self.partial = b""
+        # a joblogs.JobLog to save the output in
+        self.joblog = None
+
+    def write_text(self, text: str) -> str:
+        """Write decoded output to stdout"""
+        try:
+            self.stdout.write(text)
+        except UnicodeError:
+            # stdout cant represent some of this, replace those chars with '?'
+            text = text.encode(self.encoding, "replace").decode(self.encoding)
+            self.stdout.write(text)
+        return text
+
+    def flush_text(self, text: str) -> None:
+        """Write decoded output to stdout and flush it"""
+        self.write_text(text)
+        if hasattr(self.stdout, "flush"):
+            self.stdout.flush()
+
+    def log_output(self, data) -> None:
+        """Queue output for the job log"""
+        if self.joblog is not None:
+            self.joblog.write(data)
+
+    def call_linehandler(self, data) -> None:
+        if self.linehandler:
+            try:
+                self.linehandler(data)
+            except DockerExecError as err:
+                self.errors.append(err)
+
+    def handle_lines(self, data, final=False) -> None:
+        """Pass complete lines of output to linehandler"""
+        data = self.partial + data
+        end = len(data) if final else data.rfind(b"\n") + 1
+        self.partial = data[end:]
+        if end:
+            self.call_linehandler(data[:end])
 
     def writeout(self, data):
         retval = None
         if self.stdout and data:
-            encoding = "ascii"
-            if hasattr(self.stdout, "encoding"):
-                encoding = self.stdout.encoding
-            try:
-                decoded = data.decode(encoding, "namereplace")
-                self.stdout.write(decoded)
-                retval = decoded
-            except (TypeError, UnicodeError):
-                # codec cant handle namereplace or the codec cant represent this.
-                # decode it to utf-8 and replace non-printable ascii with
-                # chars with '?'
-                decoded = data.decode("utf-8", "replace")
-                text = re.sub(r'[^\x00-\x7F]', "?", decoded)
-                self.stdout.write(text)
-                retval = text
-
-            if self.linehandler:
-                try:
-                    self.linehandler(data)
-                except DockerExecError as err:
-                    self.errors.append(err)
+            retval = self.write_text(self.decoder.decode(data))
+            self.log_output(data)
+            self.call_linehandler(data)
         return retval
 
+    def pump(self) -> None:
+        """Copy output from the process to stdout a chunk at a time until the end of the output"""
+        stream = self.process.stdout
+        try:
+            fd = stream.fileno()
+        except (AttributeError, OSError, ValueError):
+            fd = None
+        if fd is None:
+            # not a real file, read whatever it gives us
+            while True:
+                data = stream.read(OUTPUT_CHUNK_SIZE)
+                if not data:
+                    break
+                self.writeout(data)
+            return
+        raw = io.FileIO(fd, closefd=False)
+        buffer = bytearray(min(OUTPUT_CHUNK_SIZE, self.batch_size))
+        view = memoryview(buffer)
+        batch = []
+        batched = 0
+        while True:
+            if batch and (is_windows() or batched >= self.batch_size or not select([fd], [], [], 0)[0]):
+                # write once the batch is full or the job has stopped printing for now
+                self.flush_text("".join(batch))
+                batch.clear()
+                batched = 0
+            try:
+                size = raw.readinto(view)
+            except ValueError:  # pragma: no cover
+                # closed
+                break
+            if not size:
+                break
+            chunk = view[:size]
+            batch.append(self.decoder.decode(chunk))
+            batched += size
+            if self.joblog is not None or self.linehandler:
+                data = bytes(chunk)
+                self.log_output(data)
+                if self.linehandler:
+                    self.handle_lines(data)
+        batch.append(self.decoder.decode(b"", True))
+        text = "".join(batch)
+        if text:
+            self.write_text(text)
+        if self.linehandler:
+            self.handle_lines(b"", final=True)
+
     def run(self):
-        """Pump stdout Wait for a job to end """
+        """Pump stdout until the job closes it"""
         # do nothing for interactive jobs
-        while self.process.stdout is not None:
-            data = None
-            if not is_windows():
-                select([self.process.stdout], [], [], 1)
+        if self.process.stdout is not None and self.stdout:
             try:
-                data = self.process.stdout.readline()
-            except ValueError:  # pragma: no cover
-                pass
+                self.pump()
             except Exception as err:  # pragma: no cover
                 self.errors.append(err)
                 raise
-            finally:
-                if data:
-                    self.writeout(data)
-            if self.process.poll() is not None:
-                break
 
         if hasattr(self.stdout, "flush"):
             self.stdout.flush()
@@ -91,6 +179,7 @@ class PrettyProcessLineProxyThread(ProcessLineProxyThread):
         self.lock = Lock()
         self.last_msg = None
         self.frontend = Thread(target=self.frontend_thread, daemon=True)
+        self.finished = Event()
         self.timings = {}
 
     @staticmethod
@@ -116,7 +205,10 @@ class PrettyProcessLineProxyThread(ProcessLineProxyThread):
 
     def run(self):
         self.frontend.start()
-        super().run()
+        try:
+            super().run()
+        finally:
+            self.finished.set()
         self.frontend.join()
 
     def print_last_frontend(self):
@@ -125,56 +217,62 @@ class PrettyProcessLineProxyThread(ProcessLineProxyThread):
             print_formatted_text(HTML(self.last_msg), end="")
 
     def frontend_thread(self):
-        while self.process.returncode is None:
-            time.sleep(0.5)
-            progress = ""
-            total = self.get_estimated_job_duration()
-            elapsed = self.get_current_job_elapsed()
-            remaining = max(total - elapsed, 0)
-            if total > 10:
-                fraction = min(elapsed / total, 1)
-                progress = f"({fraction:4.0%}) "
-                if remaining > 0:
-                    if remaining > 100:
-                        # report mins
-                        progress += f"{int(remaining / 60)} mins"
-                    else:
-                        # report in seconds
-                        progress += f"{int(remaining)} sec"
-                    progress += " remaining"
-
-            msg = (f"<b bg='ansiblue'>GLE {GLE_RUNTIME_GLOBALS.current_job.name} "
-                   + f"{self.spinner()} {progress} </b>  ")
-            with self.lock:
-                print("\r" + len(msg) * " " + " \r", end="")
-                self.last_msg = msg
-                self.print_last_frontend()
+        while not self.finished.wait(0.5):
+            self.frontend_once()
+
+    def frontend_once(self):
+        """Redraw the status line"""
+        progress = ""
+        total = self.get_estimated_job_duration()
+        elapsed = self.get_current_job_elapsed()
+        remaining = max(total - elapsed, 0)
+        if total > 10:
+            fraction = min(elapsed / total, 1)
+            progress = f"({fraction:4.0%}) "
+            if remaining > 0:
+                if remaining > 100:
+                    # report mins
+                    progress += f"{int(remaining / 60)} mins"
+                else:
+                    # report in seconds
+                    progress += f"{int(remaining)} sec"
+                progress += " remaining"
+
+        msg = (f"<b bg='ansiblue'>GLE {GLE_RUNTIME_GLOBALS.current_job.name} "
+               + f"{self.spinner()} {progress} </b>  ")
+        with self.lock:
+            print("\r" + len(msg) * " " + " \r", end="")
+            self.last_msg = msg
+            self.print_last_frontend()
 
     def spinner(self) -> str:
         text = self.spinner_chars[self.spinner_state]
         self.spinner_state = (1 + self.spinner_state) % len(self.spinner_chars)
         return text
 
-    def writeout(self, data):
+    def write_text(self, text: str) -> str:
         with self.lock:
             if self.last_msg:
                 print("\r" + len(self.last_msg) * " " + " \r", end="")
-            super(PrettyProcessLineProxyThread, self).writeout(data)
+            retval = super(PrettyProcessLineProxyThread, self).write_text(text)
             self.print_last_frontend()
+            return retval
 
 
 def communicate(process,
                 stdout=sys.stdout,
                 script=None,
                 throw=False,
-                linehandler=None):
+                linehandler=None,
+                joblog=None):
     """
     Write output incrementally to stdout, waits for process to end
-    :param process: a Popened child process
+    :param process: a Popened child process or an aiorunner.AsyncProcess
     :param stdout: a file-like object to write to
     :param script: a script (ie, bytes) to stream to stdin
     :param throw: raise an exception if the process exits non-zero
-    :param linehandler: if set, pass the line to this callable
+    :param linehandler: if set, pass complete lines of output (bytes, one or more lines at a time) to this callable
+    :param joblog: if set, a joblogs.JobLog to save the output in
     :return:
     """
     linethread_factory = GLE_RUNTIME_GLOBALS.output_thread_type
@@ -184,54 +282,24 @@ def communicate(process,
         process.wait()
         return
 
-    data = None
-    if script is not None:
-        process.stdin.write(script)
-        process.stdin.flush()
-        process.stdin.close()
-
     comm_thread = linethread_factory(process, stdout, linehandler=linehandler)
-    thread_started = False
-    try:
-        comm_thread.start()
-        thread_started = True
-    except RuntimeError:  # pragma: no cover
-        # could not create the thread, so use a loop
-        pass
-
-    # use a thread to stream build output if we can (hpux can't)
-    if comm_thread and thread_started:
-        while process.poll() is None:
-            if comm_thread.is_alive():
-                comm_thread.join(timeout=5)
-
-        if comm_thread.is_alive():
-            comm_thread.join()
-
-    # either the task has ended or we could not create a thread, either way,
-    # stream the remaining stdout data
-    while True:
+    comm_thread.joblog = joblog
+    from .aiorunner import AsyncProcess
+    if isinstance(process, AsyncProcess):
+        # the output is read by the shared event loop instead of a thread
+        process.communicate(comm_thread, script=script)
+    else:
+        if script is not None:
+            process.stdin.write(script)
+            process.stdin.flush()
+            process.stdin.close()
         try:
-            if process.stdout is not None:
-                data = process.stdout.readline()
-        except ValueError:  # pragma: no cover
-            pass
-        if data:
-            # we can still use our proxy object to decode and write the data
-            comm_thread.writeout(data)
-
-        if process.poll() is not None:
-            break
-
-    # process has definitely already ended, read all the lines, this wont deadlock
-    while True:
-        line = None
-        if process.stdout is not None:
-            line = process.stdout.readline()
-        if line:
-            comm_thread.writeout(line)
-        else:
-            break
+            comm_thread.start()
+            comm_thread.join()
+        except RuntimeError:  # pragma: no cover
+            # could not create the thread (hpux can't), so pump the output here
+            comm_thread.run()
+    process.wait()
 
     if throw:
         if process.returncode != 0:
@@ -250,6 +318,19 @@ def is_windows():
     return platform.system() == "Windows"
 
 
+def new_process_group() -> Dict[str, Any]:
+    """
+    Get the Popen arguments that start a process in its own process group, so that it and its children can be
+    stopped together. Unlike start_new_session this keeps the controlling terminal, so /dev/tty still works.
+    :return:
+    """
+    if not hasattr(os, "setpgrp"):  # pragma: cover if windows
+        return {}
+    if sys.version_info >= (3, 11):
+        return {"process_group": 0}
+    return {"preexec_fn": os.setpgrp}  # pragma: no cover
+
+
 def is_linux():
     return platform.system() == "Linux"
 
@@ -336,7 +417,8 @@ def make_path_slug(text: str) -> str:
 
 def clean_leftovers():
     """Clean up any unused leftover docker containers or networks"""
-    from .docker import DockerTool, DockerToolFailed
+    from .docker import DockerTool
+    from .servicenet import remove_leftover_networks
     tool = DockerTool()
     for container in tool.containers:  # pragma: no cover
         name = tool.container_name(container)
@@ -345,11 +427,8 @@ def clean_leftovers():
             if not resource_owner_alive(name):
                 # kill this container
                 info(f"Killing leftover docker container: {name}")
-                tool.docker_call("kill", container)
-    try:
-        tool.docker_call("network", "rm", "gle-service-network")
-    except DockerToolFailed:
-        pass
+                tool.kill_container(container)
+    remove_leftover_networks(tool)
 
 
 class DockerVolume:
@@ -527,19 +606,14 @@ def remote_servers(remotes: Dict[str, str]) -> Dict[str, str]:
     return servers
 
 
-def has_docker() -> bool:
+def has_docker(docker_cli: Optional[str] = None) -> bool:
     """
     Return True if this system can run docker containers
+    :param docker_cli: the docker command to use, defaults to "docker"
     :return:
     """
-    # noinspection PyBroadException
-    try:
-        subprocess.check_output(["docker", "info"], stderr=subprocess.STDOUT)
-        debug("docker detected")
-        return True
-    except Exception as err:  # pragma: no cover
-        pass
-    return False  # pragma: no cover
+    from .runtimeprobe import get_runtime_info
+    return get_runtime_info(docker_cli).present
 
 
 def warning(text: str) -> None:
@@ -0,0 +1,190 @@
+"""
+Remember what we know about docker images so that jobs do not have to inspect or probe them again
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+from typing import Dict, Optional, Any, Callable, List, Tuple
+
+from .configcache import get_cache_dir, atomic_write
+from .logmsg import debug
+
+IMAGE_CACHE_FORMAT = 1
+PULL_DIGEST_RE = re.compile(r"^Digest: (sha256:[0-9a-f]+)\s*$", re.MULTILINE)
+
+# (docker_cli, image name) -> details, for this process
+_images: Dict[Tuple[str, str], "ImageInfo"] = {}
+# (docker_cli, image name) -> digest reported by a pull in this process
+_pulled: Dict[Tuple[str, str], str] = {}
+_images_lock = threading.Lock()
+
+
+class ImageInfo:
+    """The details of an image that jobs need"""
+
+    def __init__(self, image_id: str = ""):
+        self.image_id = image_id
+        self.os = ""
+        self.user: Optional[str] = None
+        self.entrypoint: Optional[List[str]] = None
+        # None until a container of this image has been checked for bash
+        self.has_bash: Optional[bool] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "format": IMAGE_CACHE_FORMAT,
+            "image_id": self.image_id,
+            "os": self.os,
+            "user": self.user,
+            "entrypoint": self.entrypoint,
+            "has_bash": self.has_bash,
+        }
+
+    def populate(self, data: Dict[str, Any]) -> "ImageInfo":
+        self.image_id = str(data.get("image_id", ""))
+        self.os = str(data.get("os", ""))
+        self.user = data.get("user", None)
+        self.entrypoint = data.get("entrypoint", None)
+        self.has_bash = data.get("has_bash", None)
+        return self
+
+
+def image_info_from_inspect(data: Dict[str, Any]) -> ImageInfo:
+    """Get the image details from the output of docker image inspect"""
+    found = ImageInfo(data["Id"])
+    found.os = data.get("Os", "")
+    config = data.get("Config", None) or {}
+    found.user = config.get("User", None)
+    found.entrypoint = config.get("Entrypoint", None)
+    return found
+
+
+def pull_digest(output: str) -> Optional[str]:
+    """Get the repo digest from the output of docker pull"""
+    found = PULL_DIGEST_RE.search(output)
+    if found:
+        return found.group(1)
+    return None
+
+
+def image_cache_path(kind: str, key: str) -> str:
+    name = hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+    return os.path.join(get_cache_dir(), "images", kind, name + ".json")
+
+
+def load_cached(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, "r", encoding="utf-8") as fd:
+            data = json.load(fd)
+    except FileNotFoundError:
+        return None
+    except Exception as err:
+        debug(f"ignoring unreadable image cache {path}: {err}")
+        return None
+    if data.get("format", None) != IMAGE_CACHE_FORMAT:
+        return None
+    return data
+
+
+def save_cached(path: str, data: Dict[str, Any]) -> None:
+    try:
+        atomic_write(path, json.dumps(data).encode("utf-8"))
+    except OSError as err:
+        debug(f"could not save image cache {path}: {err}")
+
+
+def load_image_info(image_id: str) -> Optional[ImageInfo]:
+    """Read the saved details of an image ID"""
+    data = load_cached(image_cache_path("id", image_id))
+    if data is None:
+        return None
+    return ImageInfo().populate(data)
+
+
+def save_image_info(found: ImageInfo) -> None:
+    save_cached(image_cache_path("id", found.image_id), found.to_dict())
+
+
+def pulled_key(docker_cli: str, image: str) -> str:
+    return f"{docker_cli}|{image}"
+
+
+def get_image_info(docker_cli: str,
+                   image: str,
+                   inspect: Callable[[], Optional[Dict[str, Any]]]) -> Optional[ImageInfo]:
+    """
+    Get the details of an image, each image is inspected at most once per process and not at all if a pull
+    has confirmed it is the same image we saw in an earlier run
+    :param docker_cli: the docker command used
+    :param image: the image name
+    :param inspect: called to inspect the image, returns None if the image is not present
+    :return: None if the image is not present
+    """
+    key = (docker_cli, image)
+    with _images_lock:
+        found = _images.get(key, None)
+        digest = _pulled.get(key, None)
+    if found is not None:
+        return found
+
+    path = image_cache_path("pulled", pulled_key(docker_cli, image))
+    if digest is not None:
+        # a pull said the image has this digest, if we saw the same digest before we know the image ID
+        pulled = load_cached(path)
+        if pulled is not None and pulled.get("digest") == digest:
+            found = load_image_info(pulled.get("image_id", ""))
+            if found is not None:
+                debug(f"image {image} is unchanged since it was last pulled")
+
+    if found is None:
+        data = inspect()
+        if data is None:
+            return None
+        found = image_info_from_inspect(data)
+        cached = load_image_info(found.image_id)
+        if cached is not None:
+            found.has_bash = cached.has_bash
+        save_image_info(found)
+        if digest is not None:
+            save_cached(path, {"format": IMAGE_CACHE_FORMAT, "digest": digest, "image_id": found.image_id})
+
+    with _images_lock:
+        _images[key] = found
+    return found
+
+
+def image_pulled(docker_cli: str, image: str, digest: Optional[str]) -> None:
+    """
+    Record that an image has been pulled, the details are kept only if the image digest is unchanged
+    :param docker_cli: the docker command used
+    :param image: the image name
+    :param digest: the digest reported by the pull or None if it is not known
+    :return:
+    """
+    key = (docker_cli, image)
+    with _images_lock:
+        previous = _pulled.pop(key, None)
+        if digest is None or digest != previous:
+            _images.pop(key, None)
+        if digest is not None:
+            _pulled[key] = digest
+
+
+def set_image_has_bash(found: ImageInfo, has_bash: bool) -> None:
+    """Save whether containers of this image have bash"""
+    if found.has_bash != has_bash:
+        found.has_bash = has_bash
+        save_image_info(found)
+
+
+def forget_image_info(docker_cli: Optional[str] = None, image: Optional[str] = None) -> None:
+    """Forget the details of an image, or of all images, for this process"""
+    with _images_lock:
+        if image is None:
+            _images.clear()
+            _pulled.clear()
+        else:
+            _images.pop((docker_cli, image), None)
+            _pulled.pop((docker_cli, image), None)
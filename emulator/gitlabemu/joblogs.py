@@ -0,0 +1,302 @@
+"""
+Save the output of each job as a gzip log in the run folder. The log is compressed in blocks that start on a
+line boundary, and a sidecar index records where each block starts in the file, its first line number and when it
+was written, so the end or a time range of a large log can be read without decompressing all of it.
+"""
+import bisect
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from typing import Iterator, List, NamedTuple, Optional, Set
+
+from .helpers import make_path_slug
+from .logmsg import warning
+from .rundir import get_run_dir
+from .variables import truth_string
+
+JOB_LOGS_ENV = "GLE_JOB_LOGS"
+LOG_SUFFIX = ".log.gz"
+INDEX_SUFFIX = ".idx"
+# start a new block after this much output or this many seconds
+LOG_BLOCK_SIZE = 65536
+LOG_BLOCK_SECONDS = 1.0
+# compress quickly so the writer keeps up with jobs that print a lot
+LOG_COMPRESS_LEVEL = 1
+# chunks waiting for the writer, the output pump waits when this is full
+WRITER_QUEUE_SIZE = 256
+READ_SIZE = 65536
+
+# magic, deflate, no flags, no mtime, no extra flags, unknown OS
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+INDEX_RECORD = struct.Struct("<QQQd")
+
+
+class IndexEntry(NamedTuple):
+    """Where a block of the log starts"""
+    compressed: int
+    offset: int
+    line: int
+    timestamp: float
+
+
+def job_logs_enabled() -> bool:
+    """Return True unless GLE_JOB_LOGS is set to something false"""
+    value = os.environ.get(JOB_LOGS_ENV, "")
+    return not value or truth_string(value)
+
+
+def log_path(run_dir: str, name: str) -> str:
+    """Get the log file of a job in a run folder"""
+    return os.path.join(run_dir, "logs", make_path_slug(name) + LOG_SUFFIX)
+
+
+def index_path(path: str) -> str:
+    """Get the index file of a log"""
+    return path[:-len(LOG_SUFFIX)] + INDEX_SUFFIX
+
+
+class JobLogWriter:
+    """Compress output into a log file and its index, used only by the writer thread once created"""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.fd = open(path, "wb")
+        self.fd.write(GZIP_HEADER)
+        self.index = open(index_path(path), "wb")
+        self.compressor = zlib.compressobj(LOG_COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.crc = 0
+        self.size = 0
+        self.lines = 0
+        self.in_block = False
+        self.block_size = 0
+        self.block_time = 0.0
+        self.at_line_start = True
+
+    def start_block(self, timestamp: float) -> None:
+        self.index.write(INDEX_RECORD.pack(self.fd.tell(), self.size, self.lines, timestamp))
+        self.index.flush()
+        self.in_block = True
+        self.block_size = 0
+        self.block_time = timestamp
+
+    def end_block(self) -> None:
+        """Flush the compressor so that the next block can be decompressed on its own"""
+        if self.in_block:
+            self.fd.write(self.compressor.flush(zlib.Z_FULL_FLUSH))
+            self.fd.flush()
+            self.in_block = False
+
+    def block_due(self, timestamp: float) -> bool:
+        return self.block_size >= LOG_BLOCK_SIZE or timestamp - self.block_time >= LOG_BLOCK_SECONDS
+
+    def compress(self, data: bytes) -> None:
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.lines += data.count(b"\n")
+        self.block_size += len(data)
+        self.at_line_start = data.endswith(b"\n")
+        self.fd.write(self.compressor.compress(data))
+
+    def append(self, data: bytes, timestamp: float) -> None:
+        """Add output to the log, starting a new block at the first line break once the current one is due"""
+        while data:
+            if self.in_block and self.block_due(timestamp):
+                if self.at_line_start:
+                    self.end_block()
+                else:
+                    end = data.find(b"\n") + 1
+                    if end:
+                        self.compress(data[:end])
+                        data = data[end:]
+                        self.end_block()
+                        continue
+            if not self.in_block:
+                self.start_block(timestamp)
+            self.compress(data)
+            break
+
+    def finish(self) -> None:
+        """Write the gzip trailer and close the files"""
+        self.fd.write(self.compressor.flush(zlib.Z_FINISH))
+        self.fd.write(struct.pack("<II", self.crc & 0xffffffff, self.size & 0xffffffff))
+        self.fd.close()
+        self.index.close()
+
+
+class LogWriterThread(threading.Thread):
+    """Compress the output of every running job away from the output pumps"""
+
+    def __init__(self):
+        super().__init__(name="gle-logwriter", daemon=True)
+        self.queue = queue.Queue(WRITER_QUEUE_SIZE)
+
+    def run(self) -> None:
+        dirty: Set[JobLogWriter] = set()
+        while True:
+            try:
+                item = self.queue.get(timeout=LOG_BLOCK_SECONDS if dirty else None)
+            except queue.Empty:
+                # nothing new for a while, make what we have readable
+                for writer in dirty:
+                    writer.end_block()
+                dirty.clear()
+                continue
+            writer, data, timestamp, finished = item
+            try:
+                if finished is None:
+                    writer.append(data, timestamp)
+                    dirty.add(writer)
+                else:
+                    dirty.discard(writer)
+                    writer.finish()
+            except OSError as err:  # pragma: no cover
+                warning(f"could not write {writer.path}: {err}")
+            finally:
+                if finished is not None:
+                    finished.set()
+
+
+_log_writer: Optional[LogWriterThread] = None
+_log_writer_lock = threading.Lock()
+
+
+def get_log_writer() -> LogWriterThread:
+    global _log_writer
+    with _log_writer_lock:
+        if _log_writer is None or not _log_writer.is_alive():
+            _log_writer = LogWriterThread()
+            _log_writer.start()
+        return _log_writer
+
+
+class JobLog:
+    """The log of a running job, written by the background writer"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.writer = JobLogWriter(path)
+        self.thread = get_log_writer()
+
+    def write(self, data: bytes) -> None:
+        """Queue output for the log"""
+        if data:
+            self.thread.queue.put((self.writer, bytes(data), time.time(), None))
+
+    def close(self) -> None:
+        """Finish the log, waiting for everything queued to be written"""
+        finished = threading.Event()
+        self.thread.queue.put((self.writer, None, time.time(), finished))
+        finished.wait()
+
+
+def open_job_log(name: str) -> Optional[JobLog]:
+    """
+    Start the log of a job in the folder of this run
+    :param name: the job name
+    :return: None if job logs are turned off or can't be written
+    """
+    if not job_logs_enabled():
+        return None
+    try:
+        return JobLog(log_path(get_run_dir(), name))
+    except OSError as err:
+        warning(f"could not save the log of {name}: {err}")
+        return None
+
+
+class JobLogReader:
+    """Read a saved job log using its index"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index: List[IndexEntry] = []
+        with open(index_path(path), "rb") as fd:
+            data = fd.read()
+        usable = len(data) - len(data) % INDEX_RECORD.size
+        for item in INDEX_RECORD.iter_unpack(data[:usable]):
+            self.index.append(IndexEntry(*item))
+
+    @property
+    def started(self) -> float:
+        return self.index[0].timestamp if self.index else 0
+
+    def read_from(self, entry: IndexEntry) -> Iterator[bytes]:
+        """Decompress the log from the start of a block to the end of what has been written"""
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        with open(self.path, "rb") as fd:
+            fd.seek(entry.compressed)
+            while not decompressor.eof:
+                chunk = fd.read(READ_SIZE)
+                if not chunk:
+                    break
+                data = decompressor.decompress(chunk)
+                if data:
+                    yield data
+
+    def lines_from(self, entry: IndexEntry) -> Iterator[bytes]:
+        """Get each line from the start of a block to the end of the log"""
+        partial = b""
+        for data in self.read_from(entry):
+            lines = (partial + data).split(b"\n")
+            partial = lines.pop()
+            for line in lines:
+                yield line + b"\n"
+        if partial:
+            yield partial
+
+    def tail(self, count: int) -> Iterator[bytes]:
+        """Get the last count lines"""
+        if not self.index or count < 1:
+            return
+        last = self.index[-1]
+        total = last.line + sum(1 for _ in self.lines_from(last))
+        first = max(total - count, 0)
+        pos = bisect.bisect_right([x.line for x in self.index], first) - 1
+        entry = self.index[pos]
+        for number, line in enumerate(self.lines_from(entry), start=entry.line):
+            if number >= first:
+                yield line
+
+    def between(self, since: Optional[float] = None, until: Optional[float] = None) -> Iterator[bytes]:
+        """
+        Get the lines written between two times
+        :param since: seconds after the job started
+        :param until: seconds after the job started
+        :return: lines, to the nearest block
+        """
+        if not self.index:
+            return
+        times = [x.timestamp - self.started for x in self.index]
+        pos = 0
+        if since is not None:
+            pos = max(bisect.bisect_right(times, since) - 1, 0)
+        end = None
+        if until is not None:
+            following = bisect.bisect_right(times, until)
+            if following < len(self.index):
+                end = self.index[following].offset
+        entry = self.index[pos]
+        offset = entry.offset
+        for line in self.lines_from(entry):
+            if end is not None and offset >= end:
+                break
+            offset += len(line)
+            yield line
+
+
+def find_job_log(runs: List[str], name: str) -> Optional[str]:
+    """
+    Find the newest log of a job
+    :param runs: run folders, newest first
+    :param name: the job
+    :return:
+    """
+    for run in runs:
+        path = log_path(run, name)
+        if os.path.exists(path) and os.path.exists(index_path(path)):
+            return path
+    return None
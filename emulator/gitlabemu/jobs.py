@@ -7,17 +7,23 @@ import signal
 
 import sys
 import subprocess
+import tarfile
 import tempfile
-import threading
 import time
 from typing import Optional, Dict, List, Any
 
+from .aiorunner import async_runner_enabled, popen, stop_process
 from .artifacts import GitlabArtifacts
 from .logmsg import info, fatal, debugrule, warning, debug
 from .errors import GitlabEmulatorError
-from .helpers import communicate as comm, is_windows, is_apple, is_linux, parse_timeout, powershell_escape
+from .helpers import communicate as comm, is_windows, is_apple, is_linux, parse_timeout, powershell_escape, \
+    new_process_group
+from .joblogs import open_job_log
+from .localartifacts import ArtifactError, collect_artifacts, local_artifacts_enabled, restore_artifacts
+from .localcache import JobCache, load_job_caches, local_cache_enabled, restore_caches, save_caches
+from .supervisor import get_supervisor
 from .ansi import ANSI_GREEN, ANSI_RESET
-from .ruleparser import evaluate_rule
+from .ruleengine import evaluate_rule
 from .userconfig import get_user_config_context
 from .userconfigdata import GleRunnerConfig, SHELL_BASH
 from .variables import expand_variable
@@ -42,6 +48,7 @@ class Job(object):
     def __init__(self):
         self.name = None
         self.build_process = None
+        self.joblog = None
         self.before_script = []
         self.script = []
         self.after_script = []
@@ -50,12 +57,15 @@ class Job(object):
         self.before_script_enter_shell = False
         self.tags = []
         self.stage = "test"
+        self.when = "on_success"
+        self.allow_failure = False
         self.variables = {}
         self.extra_variables = {}
         self.allow_add_variables = True
         self.dependencies = []
         self.needed_artifacts = []
         self.artifacts = GitlabArtifacts()
+        self.caches: List[JobCache] = []
         self._shell = None
         self._runner: Optional[GleRunnerConfig] = None
         self._parallel = None
@@ -72,8 +82,7 @@ class Job(object):
         self.ended_time = 0
         self.timeout_seconds = 0
         self.timed_out = False
-        self.monitor_thread = None
-        self.exit_monitor = False
+        self.timeout_token: Optional[int] = None
         self.skipped_reason = None
         self.rules = None
         self.configloader = None
@@ -113,31 +122,13 @@ class Job(object):
             return ended - self.started_time
         return 0
 
-    def monitor_thread_loop_once(self):
+    def job_timed_out(self):
         """
-        Execute each time around the monitor loop
+        Called by the timeout supervisor when the job has run for longer than its timeout
         """
-        # check for timeout
-        if self.timeout_seconds:
-            duration = self.duration()
-            if duration > self.timeout_seconds:
-                info(f"Job exceeded {int(self.timeout_seconds)} sec timeout")
-                self.timed_out = True
-                self.abort()
-                self.exit_monitor = True
-
-    def monitor_thread_loop(self):
-        """
-        Executed by the monitor thread when a job is started
-        and exits when it finishes
-        """
-        while not self.exit_monitor:
-            try:
-                self.monitor_thread_loop_once()
-            except Exception as err:  # pragma: no cover
-                info(f"timeout monitor thread error: {err}")
-                break
-            time.sleep(2)
+        info(f"Job exceeded {int(self.timeout_seconds)} sec timeout")
+        self.timed_out = True
+        self.abort()
 
     def is_powershell(self) -> bool:
         return "powershell" == self.shell
@@ -198,13 +189,16 @@ class Job(object):
         self.name = name
         job = config[name]
         if overrides is not None:
-            # set/unset things in the job
+            # set/unset things in a copy of the job, the loaded pipeline is shared and left unchanged
+            job = dict(job)
             for ov_name, ov_value in overrides.items():
                 if ov_value is None:
                     if ov_name in job:
                         del job[ov_name]
                 else:
                     job[ov_name] = ov_value
+            config = dict(config)
+            config[name] = job
 
         self.shell = config.get(".gitlabemu-windows-shell", self.shell)
 
@@ -217,6 +211,9 @@ class Job(object):
 
         all_after = config.get("after_script", [])
         self.after_script = job.get("after_script", all_after)
+        self.stage = job.get("stage", "test")
+        self.when = job.get("when", "on_success")
+        self.allow_failure = bool(job.get("allow_failure", False))
         self.variables = dict(job.get("variables", {}))
         self.extra_variables = dict(config.get(".gle-extra_variables", {}))
         self.tags = job.get("tags", [])
@@ -244,6 +241,7 @@ class Job(object):
 
         self.set_job_variables()
         self.artifacts.load(dict(job.get("artifacts", {})))
+        self.caches = load_job_caches(job.get("cache", config.get("cache", None)))
 
         # load and match the rules
         if self.configloader:
@@ -264,10 +262,16 @@ class Job(object):
                         debugrule(f"job={self.name}: rule matched")
                         when = rule_item.get("when", "on_success")
                         if when:
+                            self.when = when
                             if when == "never":
                                 self.skipped_reason = f"matched {rule_item}"
+                        if "allow_failure" in rule_item:
+                            self.allow_failure = bool(rule_item["allow_failure"])
                         # take the first hit
                         break
+                else:
+                    # no rules matched, gitlab would not add this job to the pipeline
+                    self.when = "never"
 
     @property
     def runner(self) -> GleRunnerConfig:
@@ -328,12 +332,7 @@ class Job(object):
         info("aborting job {}".format(self.name))
         if self.build_process and self.build_process.poll() is None:
             info("killing child build process..")
-            os.kill(self.build_process.pid, signal.SIGTERM)
-            killing = time.monotonic()
-            while self.build_process.poll() is None: # pragma: no cover
-                time.sleep(1)
-                if time.monotonic() - killing > 10:
-                    os.kill(self.build_process.pid, signal.SIGKILL)
+            stop_process(self.build_process)
 
     def communicate(self, process, script=None):
         """
@@ -342,7 +341,7 @@ class Job(object):
         :param script: script (eg bytes) to pipe into stdin
         :return:
         """
-        comm(process, stdout=self.stdout, script=script)
+        comm(process, stdout=self.stdout, script=script, joblog=self.joblog)
 
     def has_bash(self):
         """
@@ -429,6 +428,8 @@ class Job(object):
                                           env=envs,
                                           shell=False,
                                           cwd=self.workspace)
+            elif async_runner_enabled():
+                opened = popen(cmdline, env=envs, cwd=self.workspace, new_group=True)
             else:
                 opened = subprocess.Popen(cmdline,
                                           env=envs,
@@ -436,7 +437,8 @@ class Job(object):
                                           cwd=self.workspace,
                                           stdin=subprocess.DEVNULL,
                                           stdout=subprocess.PIPE,
-                                          stderr=subprocess.STDOUT)
+                                          stderr=subprocess.STDOUT,
+                                          **new_process_group())
             self.build_process = opened
             self.communicate(opened, script=None)
         finally:
@@ -477,20 +479,20 @@ class Job(object):
         """
         self.allocate_runner()
         self.started_time = time.monotonic()
-        self.monitor_thread = None
+        self.timeout_token = None
+        supervisor = None
 
         if self.timeout_seconds and not self.interactive_mode():
-            self.monitor_thread = threading.Thread(target=self.monitor_thread_loop, daemon=True)
             try:
-                self.monitor_thread.start()
-            except RuntimeError as err:
+                supervisor = get_supervisor()
+                self.timeout_token = supervisor.watch(self.started_time + self.timeout_seconds, self.job_timed_out)
+            except RuntimeError as err:  # pragma: no cover
                 # funky hpux special case
-                # pragma: no cover
-                info("could not create a monitor thread, job timeouts may not work: {}".format(err))
-                self.monitor_thread = None
+                info("could not start the event loop, job timeouts may not work: {}".format(err))
+                supervisor = None
 
             info("job {} timeout set to {} mins".format(self.name, int(self.timeout_seconds/60)))
-            if not self.monitor_thread:  # pragma: no cover
+            if not supervisor:  # pragma: no cover
                 # funky hpux special case
                 def alarm_handler(x, y):
                     info("Got SIGALRM, aborting build..")
@@ -499,13 +501,77 @@ class Job(object):
                 signal.signal(signal.SIGALRM, alarm_handler)
                 signal.alarm(self.timeout_seconds)
 
+        if not self.interactive_mode():
+            self.joblog = open_job_log(self.name)
+
+        passed = False
+        interrupted = False
         try:
+            self.restore_caches()
+            self.restore_artifacts()
             self.run_impl()
+            passed = True
+        except KeyboardInterrupt:
+            # scripts run in their own process group so they do not get the terminal's SIGINT
+            interrupted = True
+            self.abort()
+            raise
         finally:
             self.ended_time = time.monotonic()
-            self.exit_monitor = True
-            if self.monitor_thread and self.timeout_seconds:
-                self.monitor_thread.join(timeout=5)
+            if supervisor:
+                supervisor.unwatch(self.timeout_token)
+            if not interrupted and not self.interactive_mode():
+                self.save_caches(passed)
+                self.save_artifacts(passed)
+            if self.joblog is not None:
+                self.joblog.close()
+                self.joblog = None
+
+    def restore_caches(self):
+        """
+        Restore the caches this job pulls into the workspace
+        :return:
+        """
+        if self.caches and self.workspace and local_cache_enabled():
+            try:
+                restore_caches(self.workspace, self.caches, self.get_envs())
+            except (OSError, tarfile.TarError, GitlabEmulatorError) as err:
+                warning(f"could not restore the cache of {self.name}: {err}")
+
+    def save_caches(self, passed: bool):
+        """
+        Save the caches this job pushes
+        :param passed: True if the job passed
+        :return:
+        """
+        if self.caches and self.workspace and local_cache_enabled():
+            try:
+                save_caches(self.workspace, self.caches, self.get_envs(), passed)
+            except (OSError, tarfile.TarError, GitlabEmulatorError) as err:
+                warning(f"could not save the cache of {self.name}: {err}")
+
+    def restore_artifacts(self):
+        """
+        Put the artifacts of the jobs this job needs into the workspace
+        :return:
+        """
+        if self.needed_artifacts and self.workspace and local_artifacts_enabled():
+            try:
+                restore_artifacts(self.workspace, self.needed_artifacts)
+            except OSError as err:
+                warning(f"could not restore the artifacts needed by {self.name}: {err}")
+
+    def save_artifacts(self, passed: bool):
+        """
+        Collect the artifacts of this job from the workspace
+        :param passed: True if the job passed
+        :return:
+        """
+        if self.artifacts.paths and self.workspace and local_artifacts_enabled():
+            try:
+                collect_artifacts(self.name, self.workspace, self.artifacts, passed, self.get_envs())
+            except (OSError, ArtifactError) as err:
+                warning(f"could not save the artifacts of {self.name}: {err}")
 
     def run_impl(self):
         info(f"running shell job {self.name}")
@@ -0,0 +1,361 @@
+"""
+Collect job artifacts into a content-addressed store and put them into the workspaces of the jobs that need them
+"""
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import stat
+import tempfile
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .artifacts import GitlabArtifacts
+from .configcache import atomic_write, file_digest
+from .errors import GitlabEmulatorError
+from .helpers import is_linux, make_path_slug
+from .logmsg import debug, info, warning
+from .rundir import get_run_dir, get_runs_dir, list_runs
+from .variables import expand_variable, truth_string
+
+LOCAL_ARTIFACTS_ENV = "GLE_LOCAL_ARTIFACTS"
+ARTIFACT_LINKS_ENV = "GLE_ARTIFACT_LINKS"
+# GLE_LOCAL_ARTIFACTS value that also restores artifacts saved by earlier runs
+LOCAL_ARTIFACTS_ALL = "all"
+OBJECTS_DIR = ".objects"
+MANIFEST_FORMAT = 1
+# objects newer than this are not removed, they may belong to a job that is still saving its artifacts
+OBJECT_GC_GRACE = 3600
+COPY_CHUNK_SIZE = 1048576
+# linux ioctl to share the blocks of one file with another on filesystems that support it (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+class ArtifactError(GitlabEmulatorError):
+    """Artifact paths are not valid"""
+
+
+def local_artifacts_enabled() -> bool:
+    """Return True unless GLE_LOCAL_ARTIFACTS is set to something false"""
+    value = os.environ.get(LOCAL_ARTIFACTS_ENV, "")
+    return not value or value.lower() == LOCAL_ARTIFACTS_ALL or truth_string(value)
+
+
+def earlier_artifacts_enabled() -> bool:
+    """
+    Return True if GLE_LOCAL_ARTIFACTS=all. Restoring a job's artifacts from an earlier run can replace newer files
+    in a workspace that is the project folder, so by default only artifacts from this run are restored.
+    """
+    return os.environ.get(LOCAL_ARTIFACTS_ENV, "").lower() == LOCAL_ARTIFACTS_ALL
+
+
+def artifact_links_enabled() -> bool:
+    """
+    Return True if GLE_ARTIFACT_LINKS is set to something true. A hardlinked artifact shares the store's file, so
+    a job that writes to it (or changes its owner or mode) changes the stored copy too, read-only modes do not
+    stop root.
+    """
+    return truth_string(os.environ.get(ARTIFACT_LINKS_ENV, ""))
+
+
+def get_objects_dir(runs_dir: Optional[str] = None) -> str:
+    """Get the object store shared by every run of the project"""
+    if runs_dir is None:
+        runs_dir = get_runs_dir()
+    return os.path.join(runs_dir, OBJECTS_DIR)
+
+
+def manifest_path(run_dir: str, name: str) -> str:
+    """Get the artifact manifest of a job in a run folder"""
+    return os.path.join(run_dir, "artifacts", make_path_slug(name) + ".json")
+
+
+def clone_file(src: str, dest: str) -> None:
+    """Copy a file, sharing its blocks instead if the filesystem can"""
+    if is_linux():  # pragma: cover if linux
+        import fcntl
+        with open(src, "rb") as infile, open(dest, "wb") as outfile:
+            try:
+                fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+                return
+            except OSError:
+                pass
+    shutil.copyfile(src, dest)
+
+
+class ArtifactStore:
+    """Files kept by their sha256 digest, read-only to guard against accidental changes"""
+
+    def __init__(self, folder: Optional[str] = None):
+        if folder is None:
+            folder = get_objects_dir()
+        self.folder = folder
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.folder, digest[:2], digest)
+
+    def add(self, path: str) -> str:
+        """
+        Put a file into the store
+        :param path: the file
+        :return: the digest of the file
+        """
+        executable = bool(os.stat(path).st_mode & stat.S_IXUSR)
+        digest = file_digest(path)
+        if digest is not None and os.path.exists(self.object_path(digest)):
+            # already stored, mark it as in use so it is not collected
+            os.utime(self.object_path(digest))
+            return digest
+
+        os.makedirs(self.folder, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+        try:
+            # hash what we store in case the file changed since we read it
+            hasher = hashlib.sha256()
+            with open(path, "rb") as infile, os.fdopen(fd, "wb") as outfile:
+                while True:
+                    chunk = infile.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    outfile.write(chunk)
+            digest = hasher.hexdigest()
+            os.chmod(temp, 0o555 if executable else 0o444)
+            target = self.object_path(digest)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if not os.path.exists(target):
+                os.replace(temp, target)
+        finally:
+            if os.path.exists(temp):
+                os.unlink(temp)
+        return digest
+
+    def materialize(self, digest: str, dest: str, mode: int) -> str:
+        """
+        Put a copy of a stored file at dest, a copy-on-write clone where the filesystem can, or a hardlink if
+        GLE_ARTIFACT_LINKS is set
+        :param digest: the stored file
+        :param dest: where to put it
+        :param mode: the permissions dest should have
+        :return: "same" if dest already had this content, else "linked" or "copied"
+        """
+        source = self.object_path(digest)
+        source_stat = os.stat(source)
+        try:
+            existing = os.lstat(dest)
+        except FileNotFoundError:
+            existing = None
+        if existing is not None:
+            if stat.S_ISDIR(existing.st_mode):
+                raise ArtifactError(f"{dest} is a folder")
+            same = os.path.samestat(existing, source_stat)
+            if not same and stat.S_ISREG(existing.st_mode) and existing.st_size == source_stat.st_size:
+                same = file_digest(dest) == digest
+            if same:
+                if stat.S_IMODE(existing.st_mode) != mode:
+                    os.chmod(dest, mode)
+                return "same"
+
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        temp = f"{dest}.gle-{os.getpid()}.tmp"
+        result = "copied"
+        try:
+            if artifact_links_enabled():
+                try:
+                    os.link(source, temp)
+                    result = "linked"
+                except OSError as err:
+                    # EXDEV if the store is on another filesystem
+                    debug(f"cannot link {source}: {err}")
+            if result == "copied":
+                clone_file(source, temp)
+            os.chmod(temp, mode)
+            os.replace(temp, dest)
+        finally:
+            if os.path.lexists(temp):
+                os.unlink(temp)
+        return result
+
+    def collect_garbage(self, referenced: Set[str], grace: Optional[float] = None) -> int:
+        """
+        Remove objects that are not referenced
+        :param referenced: digests still in use
+        :param grace: keep unreferenced objects newer than this many seconds, default OBJECT_GC_GRACE
+        :return: the number of objects removed
+        """
+        if grace is None:
+            grace = OBJECT_GC_GRACE
+        removed = 0
+        oldest = time.time() - grace
+        for path in glob.glob(os.path.join(self.folder, "*")) + glob.glob(os.path.join(self.folder, "*", "*")):
+            if os.path.isdir(path) or os.path.basename(path) in referenced:
+                continue
+            try:
+                if os.stat(path).st_mtime < oldest:
+                    os.unlink(path)
+                    removed += 1
+            except OSError:  # pragma: no cover
+                pass
+        return removed
+
+
+def expand_paths(workspace: str, patterns: Iterable[str], variables: Dict[str, str]) -> Set[str]:
+    """
+    Find the files matching some artifact paths
+    :param workspace: the job workspace
+    :param patterns: paths or globs relative to the workspace, folders include everything in them
+    :param variables: used to expand $NAME in the paths
+    :return: paths relative to the workspace, using /
+    """
+    found = set()
+    root = os.path.realpath(workspace)
+    for pattern in patterns:
+        pattern = expand_variable(variables, str(pattern))
+        if os.path.isabs(pattern) or ".." in re.split(r"[\\/]", pattern):
+            raise ArtifactError(f"artifact path {pattern} is outside the project folder")
+        for match in glob.glob(os.path.join(root, pattern), recursive=True):
+            if os.path.isdir(match) and not os.path.islink(match):
+                for folder, dirs, files in os.walk(match):
+                    # links to folders are kept as links
+                    items = files + [x for x in dirs if os.path.islink(os.path.join(folder, x))]
+                    for item in items:
+                        found.add(os.path.relpath(os.path.join(folder, item), root))
+            elif os.path.lexists(match):
+                found.add(os.path.relpath(match, root))
+    return {x.replace(os.sep, "/") for x in found}
+
+
+def select_files(workspace: str, artifacts: GitlabArtifacts, variables: Dict[str, str]) -> List[str]:
+    """Get the files in the workspace to save as artifacts"""
+    included = expand_paths(workspace, artifacts.paths, variables)
+    if included and artifacts.exclude:
+        included -= expand_paths(workspace, artifacts.exclude, variables)
+    return sorted(included)
+
+
+def should_collect(artifacts: GitlabArtifacts, passed: bool) -> bool:
+    """Return True if artifacts:when says to keep the artifacts of a job that passed or failed"""
+    when = artifacts.when or "on_success"
+    if when == "always":
+        return True
+    return passed == (when == "on_success")
+
+
+def collect_artifacts(name: str,
+                      workspace: str,
+                      artifacts: GitlabArtifacts,
+                      passed: bool,
+                      variables: Dict[str, str]) -> Optional[str]:
+    """
+    Save the artifacts of a job that has finished
+    :param name: the job
+    :param workspace: the job workspace
+    :param artifacts: the job artifacts config
+    :param passed: True if the job passed
+    :param variables: the job variables
+    :return: the manifest, or None if the job has no artifacts
+    """
+    if not artifacts.paths:
+        return None
+    manifest = {"format": MANIFEST_FORMAT, "job": name, "passed": passed, "files": {}, "links": {}}
+    total = 0
+    if should_collect(artifacts, passed):
+        store = ArtifactStore()
+        for relpath in select_files(workspace, artifacts, variables):
+            path = os.path.join(workspace, *relpath.split("/"))
+            if os.path.islink(path):
+                manifest["links"][relpath] = os.readlink(path)
+                continue
+            try:
+                manifest["files"][relpath] = [store.add(path), stat.S_IMODE(os.stat(path).st_mode)]
+                total += os.path.getsize(path)
+            except OSError as err:
+                warning(f"could not save artifact {relpath}: {err}")
+        info(f"saved {len(manifest['files'])} artifact files ({total} bytes) from {name}")
+    else:
+        debug(f"not saving artifacts of {name}, when: {artifacts.when}")
+    path = manifest_path(get_run_dir(), name)
+    atomic_write(path, json.dumps(manifest, indent=1).encode("utf-8"))
+    return path
+
+
+def load_manifests(run_dir: str) -> Dict[str, dict]:
+    """Get the artifact manifests in a run folder by job name"""
+    manifests = {}
+    for path in glob.glob(os.path.join(run_dir, "artifacts", "*.json")):
+        try:
+            with open(path, "r") as fd:
+                data = json.load(fd)
+        except (OSError, ValueError):  # pragma: no cover
+            continue
+        if data.get("format") == MANIFEST_FORMAT:
+            manifests[data["job"]] = data
+    return manifests
+
+
+def find_manifests(runs: List[str], name: str) -> List[dict]:
+    """
+    Find the newest artifacts of a job, or of every copy of a parallel job
+    :param runs: run folders, newest first
+    :param name: the job
+    :return:
+    """
+    instance = re.compile(re.escape(name) + r" \d+/\d+")
+    for run in runs:
+        found = [data for job, data in load_manifests(run).items() if job == name or instance.fullmatch(job)]
+        if found:
+            return sorted(found, key=lambda x: x["job"])
+    return []
+
+
+def restore_artifacts(workspace: str, needed: List[str]) -> Tuple[int, int]:
+    """
+    Put the artifacts of the needed jobs in the workspace from this run, or with GLE_LOCAL_ARTIFACTS=all from the
+    newest run that has them
+    :param workspace: the job workspace
+    :param needed: jobs whose artifacts this job uses
+    :return: the number of files linked and copied
+    """
+    store = ArtifactStore()
+    current = get_run_dir()
+    runs = [current]
+    if earlier_artifacts_enabled():
+        runs.extend(x for x in list_runs() if x != current)
+    counts = {"same": 0, "linked": 0, "copied": 0}
+    for name in needed:
+        manifests = find_manifests(runs, name)
+        if not manifests:
+            debug(f"no local artifacts found for {name}")
+            continue
+        for manifest in manifests:
+            for relpath, (digest, mode) in manifest["files"].items():
+                dest = os.path.join(workspace, *relpath.split("/"))
+                try:
+                    counts[store.materialize(digest, dest, mode)] += 1
+                except (OSError, ArtifactError) as err:
+                    warning(f"could not restore artifact {relpath} from {manifest['job']}: {err}")
+            for relpath, target in manifest["links"].items():
+                dest = os.path.join(workspace, *relpath.split("/"))
+                if os.path.islink(dest) and os.readlink(dest) == target:
+                    continue
+                try:
+                    if os.path.lexists(dest):
+                        os.unlink(dest)
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    os.symlink(target, dest)
+                except OSError as err:
+                    warning(f"could not restore artifact {relpath} from {manifest['job']}: {err}")
+        info(f"restored artifacts of {name}")
+    debug(f"artifact files unchanged: {counts['same']}, linked: {counts['linked']}, copied: {counts['copied']}")
+    return counts["linked"], counts["copied"]
+
+
+def collect_garbage(project_dir: Optional[str] = None) -> int:
+    """Remove objects that no run of the project refers to any more"""
+    referenced = set()
+    for run in list_runs(project_dir):
+        for manifest in load_manifests(run).values():
+            referenced.update(digest for digest, _ in manifest["files"].values())
+    return ArtifactStore(get_objects_dir(get_runs_dir(project_dir))).collect_garbage(referenced)
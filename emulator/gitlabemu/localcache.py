@@ -0,0 +1,368 @@
+"""
+Save and restore job `cache:` paths using a local store of tar archives, removing the least recently used
+"""
+import hashlib
+import json
+import os
+import tarfile
+import tempfile
+from typing import Any, Dict, List, Optional
+
+from .configcache import atomic_write, file_digest, get_cache_dir
+from .errors import BadSyntaxError, GitlabEmulatorError
+from .localartifacts import expand_paths
+from .logmsg import debug, info, warning
+from .rundir import get_project_id
+from .variables import expand_variable, truth_string
+
+LOCAL_CACHE_ENV = "GLE_LOCAL_CACHE"
+JOB_CACHE_DIR_ENV = "GLE_JOB_CACHE_DIR"
+JOB_CACHE_SIZE_ENV = "GLE_JOB_CACHE_SIZE"
+# megabytes
+DEFAULT_JOB_CACHE_SIZE = 5120
+CACHE_POLICIES = ["pull", "push", "pull-push"]
+CACHE_WHEN = ["on_success", "on_failure", "always"]
+DEFAULT_CACHE_KEY = "default"
+COPY_CHUNK_SIZE = 1048576
+
+
+class CacheError(GitlabEmulatorError):
+    """A cache could not be saved or restored"""
+
+
+def local_cache_enabled() -> bool:
+    """Return True unless GLE_LOCAL_CACHE is set to something false"""
+    value = os.environ.get(LOCAL_CACHE_ENV, "")
+    return not value or truth_string(value)
+
+
+def get_job_cache_dir(project_dir: Optional[str] = None) -> str:
+    """Get the cache store of a project, set by GLE_JOB_CACHE_DIR or else a folder in the cache"""
+    folder = os.environ.get(JOB_CACHE_DIR_ENV, None)
+    if folder:
+        return folder
+    return os.path.join(get_cache_dir(), "jobcache", get_project_id(project_dir))
+
+
+def get_job_cache_size() -> int:
+    """Get the most the cache store should hold in bytes, set in megabytes by GLE_JOB_CACHE_SIZE"""
+    try:
+        megabytes = float(os.environ.get(JOB_CACHE_SIZE_ENV, DEFAULT_JOB_CACHE_SIZE))
+    except ValueError:
+        megabytes = DEFAULT_JOB_CACHE_SIZE
+    return int(max(megabytes, 0) * 1048576)
+
+
+class JobCache:
+    """One item of a job's cache: config"""
+
+    def __init__(self):
+        self.key = DEFAULT_CACHE_KEY
+        self.key_files: List[str] = []
+        self.key_prefix: Optional[str] = None
+        self.paths: List[str] = []
+        self.policy = "pull-push"
+        self.when = "on_success"
+        self.fallback_keys: List[str] = []
+
+    def load(self, data: Dict[str, Any]):
+        key = data.get("key", DEFAULT_CACHE_KEY)
+        if isinstance(key, dict):
+            self.key_files = [str(x) for x in key.get("files", [])]
+            self.key_prefix = key.get("prefix", None)
+            if not self.key_files:
+                raise BadSyntaxError("cache:key:files must list at least one file")
+        else:
+            self.key = str(key)
+        self.paths = data.get("paths", [])
+        if isinstance(self.paths, str):
+            self.paths = [self.paths]
+        if not isinstance(self.paths, list):
+            raise BadSyntaxError(f"cache:paths must be a list of paths, got {self.paths}")
+        self.policy = str(data.get("policy", self.policy))
+        self.when = str(data.get("when", self.when))
+        self.fallback_keys = [str(x) for x in data.get("fallback_keys", [])]
+
+    def resolve_key(self, workspace: str, variables: Dict[str, str]) -> str:
+        """
+        Get the cache key for the job
+        :param workspace: the job workspace, key:files are read from here
+        :param variables: used to expand $NAME in the key
+        :return:
+        """
+        if not self.key_files:
+            return expand_variable(variables, self.key) or DEFAULT_CACHE_KEY
+        hasher = hashlib.sha256()
+        found = False
+        for filename in self.key_files:
+            filename = expand_variable(variables, filename)
+            digest = file_digest(os.path.join(workspace, filename))
+            if digest is not None:
+                found = True
+                hasher.update(f"{filename}\0{digest}\0".encode("utf-8"))
+        key = hasher.hexdigest() if found else DEFAULT_CACHE_KEY
+        if self.key_prefix:
+            key = f"{expand_variable(variables, str(self.key_prefix))}-{key}"
+        return key
+
+    def get_policy(self, variables: Dict[str, str]) -> str:
+        policy = expand_variable(variables, self.policy)
+        if policy not in CACHE_POLICIES:
+            raise CacheError(f"unknown cache:policy {policy}, expected one of {CACHE_POLICIES}")
+        return policy
+
+    def should_save(self, passed: bool) -> bool:
+        """Return True if cache:when says to save the cache of a job that passed or failed"""
+        if self.when == "always":
+            return True
+        return passed == (self.when == "on_success")
+
+
+def load_job_caches(data: Any) -> List[JobCache]:
+    """
+    Get the caches of a job
+    :param data: the job cache: config, a dict or a list of them
+    :return:
+    """
+    if not data:
+        return []
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list):
+        raise BadSyntaxError(f"cache must be a map or a list of maps, got {data}")
+    caches = []
+    for item in data:
+        cache = JobCache()
+        cache.load(dict(item))
+        if cache.paths:
+            caches.append(cache)
+    return caches
+
+
+def tree_fingerprint(workspace: str, paths: List[str], variables: Dict[str, str]) -> str:
+    """Summarise the names, sizes and times of the files matching some cache paths"""
+    hasher = hashlib.sha256()
+    for relpath in sorted(expand_paths(workspace, paths, variables)):
+        try:
+            st = os.lstat(os.path.join(workspace, *relpath.split("/")))
+        except OSError:  # pragma: no cover
+            continue
+        hasher.update(f"{relpath}\0{st.st_size}\0{st.st_mtime_ns}\0{st.st_mode}\0".encode("utf-8"))
+    return hasher.hexdigest()
+
+
+class HashingWriter:
+    """Write to a file and hash what was written"""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.hasher = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data) -> int:
+        self.hasher.update(data)
+        self.size += len(data)
+        return self.fd.write(data)
+
+
+class CacheStore:
+    """
+    Tar archives named by their sha256 digest, and a small file for each cache key naming the archive it uses.
+    The key files are touched when used so the least recently used keys can be removed first.
+    """
+
+    def __init__(self, folder: Optional[str] = None):
+        if folder is None:
+            folder = get_job_cache_dir()
+        self.folder = folder
+
+    def key_path(self, key: str) -> str:
+        return os.path.join(self.folder, "keys", hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json")
+
+    def archive_path(self, digest: str) -> str:
+        return os.path.join(self.folder, "archives", digest + ".tar")
+
+    def state_path(self, workspace: str, paths: List[str]) -> str:
+        name = json.dumps([os.path.realpath(workspace), paths])
+        return os.path.join(self.folder, "workspaces", hashlib.sha256(name.encode("utf-8")).hexdigest() + ".json")
+
+    def read_json(self, path: str) -> Optional[dict]:
+        try:
+            with open(path, "r") as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return None
+
+    def lookup(self, key: str) -> Optional[str]:
+        """
+        Find the archive of a cache key and mark the key as used
+        :param key:
+        :return: the archive digest
+        """
+        path = self.key_path(key)
+        data = self.read_json(path)
+        if data is None or not os.path.exists(self.archive_path(data["archive"])):
+            return None
+        try:
+            os.utime(path)
+        except OSError:  # pragma: no cover
+            pass
+        return data["archive"]
+
+    def save(self, key: str, workspace: str, paths: List[str], variables: Dict[str, str]) -> Optional[str]:
+        """
+        Archive the cache paths in the workspace
+        :param key: the cache key
+        :param workspace: the job workspace
+        :param paths: the cache paths
+        :param variables: used to expand $NAME in the paths
+        :return: the archive digest, None if nothing matched the paths
+        """
+        files = sorted(expand_paths(workspace, paths, variables))
+        if not files:
+            return None
+        folder = os.path.join(self.folder, "archives")
+        os.makedirs(folder, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as outfile:
+                writer = HashingWriter(outfile)
+                with tarfile.open(fileobj=writer, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+                    for relpath in files:
+                        tar.add(os.path.join(workspace, *relpath.split("/")), arcname=relpath, recursive=False)
+            digest = writer.hasher.hexdigest()
+            target = self.archive_path(digest)
+            if os.path.exists(target):
+                os.utime(target)
+            else:
+                os.replace(temp, target)
+        finally:
+            if os.path.exists(temp):
+                os.unlink(temp)
+        atomic_write(self.key_path(key), json.dumps({"key": key, "archive": digest}).encode("utf-8"))
+        self.remember(workspace, paths, digest, variables)
+        info(f"saved cache {key} ({writer.size} bytes)")
+        self.evict(keep=key)
+        return digest
+
+    def remember(self, workspace: str, paths: List[str], digest: str, variables: Dict[str, str]) -> None:
+        """Note which archive the workspace now has"""
+        state = {"archive": digest, "fingerprint": tree_fingerprint(workspace, paths, variables)}
+        atomic_write(self.state_path(workspace, paths), json.dumps(state).encode("utf-8"))
+
+    def restore(self, digest: str, workspace: str, paths: List[str], variables: Dict[str, str]) -> bool:
+        """
+        Extract an archive into the workspace
+        :param digest: the archive
+        :param workspace: the job workspace
+        :param paths: the cache paths
+        :param variables: used to expand $NAME in the paths
+        :return: False if the workspace already had this archive
+        """
+        state = self.read_json(self.state_path(workspace, paths))
+        if state and state.get("archive") == digest:
+            if state.get("fingerprint") == tree_fingerprint(workspace, paths, variables):
+                return False
+        root = os.path.realpath(workspace)
+        with open(self.archive_path(digest), "rb") as infile:
+            # read the archive as a stream, without seeking
+            with tarfile.open(fileobj=infile, mode="r|") as tar:
+                for member in tar:
+                    dest = os.path.realpath(os.path.join(root, member.name))
+                    if os.path.isabs(member.name) or not dest.startswith(root + os.sep):
+                        raise CacheError(f"cache archive {digest} contains {member.name}")
+                    if member.isfile() and os.path.islink(dest):
+                        # don't write through a link
+                        os.unlink(dest)
+                    if hasattr(tarfile, "tar_filter"):
+                        tar.extract(member, root, filter="tar")
+                    else:  # pragma: no cover
+                        tar.extract(member, root)
+        self.remember(workspace, paths, digest, variables)
+        return True
+
+    def evict(self, limit: Optional[int] = None, keep: Optional[str] = None) -> int:
+        """
+        Remove the least recently used keys until the archives they use fit in the limit
+        :param limit: bytes, default GLE_JOB_CACHE_SIZE
+        :param keep: never remove this key
+        :return: the number of keys removed
+        """
+        if limit is None:
+            limit = get_job_cache_size()
+        keys = []
+        folder = os.path.join(self.folder, "keys")
+        for name in os.listdir(folder) if os.path.isdir(folder) else []:
+            path = os.path.join(folder, name)
+            data = self.read_json(path)
+            if data is not None:
+                keys.append((os.path.getmtime(path), path, data))
+        sizes = {}
+        for _, _, data in keys:
+            try:
+                sizes[data["archive"]] = os.path.getsize(self.archive_path(data["archive"]))
+            except OSError:
+                sizes[data["archive"]] = 0
+        # the archive of the kept key stays even if older keys use it too
+        kept = set(x[2]["archive"] for x in keys if x[2]["key"] == keep)
+        keys = [x for x in keys if x[2]["key"] != keep]
+        keys.sort(key=lambda x: x[0])
+        removed = 0
+        while sum(sizes.values()) > limit and keys:
+            _, path, data = keys.pop(0)
+            debug(f"removing cache {data['key']}")
+            os.unlink(path)
+            removed += 1
+            if data["archive"] not in kept and not any(x[2]["archive"] == data["archive"] for x in keys):
+                sizes.pop(data["archive"], None)
+                try:
+                    os.unlink(self.archive_path(data["archive"]))
+                except FileNotFoundError:  # pragma: no cover
+                    pass
+        return removed
+
+
+def restore_caches(workspace: str, caches: List[JobCache], variables: Dict[str, str]) -> None:
+    """
+    Restore each cache of a job that pulls, trying its key, then its fallback keys and CACHE_FALLBACK_KEY
+    :param workspace: the job workspace
+    :param caches: the job caches
+    :param variables: the job variables
+    :return:
+    """
+    store = CacheStore()
+    for cache in caches:
+        if cache.get_policy(variables) == "push":
+            continue
+        keys = [cache.resolve_key(workspace, variables)]
+        keys.extend(expand_variable(variables, x) for x in cache.fallback_keys)
+        if variables.get("CACHE_FALLBACK_KEY"):
+            keys.append(variables["CACHE_FALLBACK_KEY"])
+        for key in keys:
+            digest = store.lookup(key)
+            if digest is not None:
+                if store.restore(digest, workspace, cache.paths, variables):
+                    info(f"restored cache {key}")
+                else:
+                    info(f"cache {key} is already in the workspace")
+                break
+        else:
+            info(f"no cache found for {keys[0]}")
+
+
+def save_caches(workspace: str, caches: List[JobCache], variables: Dict[str, str], passed: bool) -> None:
+    """
+    Save each cache of a job that pushes
+    :param workspace: the job workspace
+    :param caches: the job caches
+    :param variables: the job variables
+    :param passed: True if the job passed
+    :return:
+    """
+    store = CacheStore()
+    for cache in caches:
+        if cache.get_policy(variables) == "pull" or not cache.should_save(passed):
+            continue
+        key = cache.resolve_key(workspace, variables)
+        if store.save(key, workspace, cache.paths, variables) is None:
+            warning(f"no files matched the paths of cache {key}")
@@ -1,5 +1,5 @@
 """Expand !reference tags to values"""
-from typing import Dict, Any, Union
+from typing import Dict, Any, Union, Set
 from .gitlab.types import RESERVED_TOP_KEYS, DEFAULT_JOB_KEYS
 
 from .yamlloader import GitlabReference, GitlabReferenceError
@@ -13,6 +13,20 @@ def process_references(baseobj: dict) -> dict:
     return baseobj
 
 
+def reference_targets(value: Any) -> Set[str]:
+    """Get the names of the jobs referred to by references in a job or value"""
+    found = set()
+    if isinstance(value, GitlabReference):
+        found.add(value.job)
+    elif isinstance(value, list):
+        for item in value:
+            found.update(reference_targets(item))
+    elif isinstance(value, dict):
+        for item in value.values():
+            found.update(reference_targets(item))
+    return found
+
+
 def process_reference_value(baseobj: dict, item: Union[GitlabReference, int, str], depth: int = 0) -> Union[str, int, list]:
     """Process a reference"""
     if isinstance(item, GitlabReference):
@@ -20,7 +20,7 @@ def is_gle_resource(name: str) -> Optional[int]:
         parts = name.split("-")
         if len(parts) == 4:
             prefix = parts[0]
-            if prefix == "gle":
+            if prefix == "gle" and parts[2].isdigit():
                 pid = int(parts[2])
                 return pid
     return None
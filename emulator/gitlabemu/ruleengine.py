@@ -0,0 +1,270 @@
+"""
+Evaluate gitlab rule expressions without the antlr4 runtime
+
+The parser implements the same grammar as rules/GitlabRule.g4:
+
+    expr : '(' expr ')'
+         | VARIABLE
+         | REGEX
+         | VARIABLE (== | !=) STRING
+         | STRING (== | !=) VARIABLE
+         | VARIABLE (=~ | !~) (REGEX | VARIABLE)
+         | expr && expr
+         | expr || expr
+
+&& binds more tightly than ||, both are left associative.
+"""
+import os
+import re
+from functools import lru_cache
+from typing import Dict, Optional, Callable, Any, Pattern, List, Tuple
+
+from .errors import GitlabEmulatorError
+
+RULE_ENGINE_ENV = "GLE_RULE_ENGINE"
+RULE_ENGINE_NATIVE = "native"
+RULE_ENGINE_ANTLR = "antlr"
+RULE_ENGINES = [RULE_ENGINE_NATIVE, RULE_ENGINE_ANTLR]
+RULE_CACHE_SIZE = 1024
+
+CompiledRule = Callable[[Dict[str, str]], Any]
+
+OR = "||"
+AND = "&&"
+EQ = "=="
+NE = "!="
+MATCH = "=~"
+NMATCH = "!~"
+OPAR = "("
+CPAR = ")"
+STRING = "STRING"
+REGEX = "REGEX"
+VARIABLE = "VARIABLE"
+END = "END"
+
+TOKEN_PATTERN = re.compile(r"""
+    (?P<WHITESPACE>[\t\r\n ]+)
+  | (?P<OPERATOR>\|\||&&|==|!=|=~|!~)
+  | (?P<PAREN>[()])
+  | (?P<STRING>"[^"]*")
+  | (?P<REGEX>/[^/]*/)
+  | (?P<VARIABLE>\$[0-9a-zA-Z_]+)
+""", re.VERBOSE)
+
+Token = Tuple[str, str]
+
+
+class RuleSyntaxError(GitlabEmulatorError):
+    """
+    A rule expression could not be parsed
+    """
+    pass
+
+
+@lru_cache(RULE_CACHE_SIZE)
+def compile_regex(text: str) -> Pattern:
+    """Compile the body of a /regex/ literal"""
+    return re.compile(text[1:-1])
+
+
+def tokenize(rule: str) -> List[Token]:
+    """
+    Split a rule expression into (type, text) tokens
+    :param rule:
+    :return:
+    """
+    tokens = []
+    pos = 0
+    while pos < len(rule):
+        matched = TOKEN_PATTERN.match(rule, pos)
+        if not matched:
+            raise RuleSyntaxError(f"unexpected character '{rule[pos]}' at {pos} in: {rule}")
+        kind = matched.lastgroup
+        text = matched.group()
+        pos = matched.end()
+        if kind == "WHITESPACE":
+            continue
+        if kind in ["OPERATOR", "PAREN"]:
+            kind = text
+        tokens.append((kind, text))
+    tokens.append((END, ""))
+    return tokens
+
+
+def compile_operand(token: Token) -> CompiledRule:
+    kind, text = token
+    if kind == VARIABLE:
+        name = text[1:]
+        return lambda variables: variables.get(name, "")
+    # strip quotes
+    if kind == STRING:
+        text = text[1:-1]
+    return lambda variables: text
+
+
+def compile_defined(token: Token) -> CompiledRule:
+    """Return True if VARNAME is set to anything except the empty string"""
+    name = token[1][1:]
+    return lambda variables: variables.get(name, "") != ""
+
+
+def compile_compare(left: Token, op: str, right: Token) -> CompiledRule:
+    """Compare strings/variables for equality"""
+    get_left = compile_operand(left)
+    get_right = compile_operand(right)
+    if op == EQ:
+        return lambda variables: get_left(variables) == get_right(variables)
+    return lambda variables: get_left(variables) != get_right(variables)
+
+
+def compile_match(left: Token, op: str, right: Token) -> CompiledRule:
+    """Match a variable with a regex literal or a variable containing a regex"""
+    get_left = compile_operand(left)
+    negate = op == NMATCH
+    if right[0] == REGEX:
+        # regex literals are compiled now
+        patt = compile_regex(right[1])
+
+        def match_literal(variables: Dict[str, str]) -> bool:
+            return (patt.search(get_left(variables)) is None) == negate
+        return match_literal
+
+    get_right = compile_operand(right)
+
+    def match_variable(variables: Dict[str, str]) -> bool:
+        value = get_right(variables)
+        if value.startswith("/") and value.endswith("/"):
+            # is a regex
+            return (compile_regex(value).search(get_left(variables)) is None) == negate
+        return False
+    return match_variable
+
+
+def compile_and(left: CompiledRule, right: CompiledRule) -> CompiledRule:
+    return lambda variables: left(variables) and right(variables)
+
+
+def compile_or(left: CompiledRule, right: CompiledRule) -> CompiledRule:
+    return lambda variables: left(variables) or right(variables)
+
+
+class RuleParser:
+    """Recursive descent parser that compiles a rule expression into a function taking a map of variables"""
+
+    def __init__(self, rule: str):
+        self.rule = rule
+        self.tokens = tokenize(rule)
+        self.pos = 0
+
+    def peek(self) -> str:
+        return self.tokens[self.pos][0]
+
+    def take(self, *kinds: str) -> Token:
+        token = self.tokens[self.pos]
+        if token[0] not in kinds:
+            found = token[1] or "end of expression"
+            raise RuleSyntaxError(f"expected {' or '.join(kinds)} but found {found} in: {self.rule}")
+        self.pos += 1
+        return token
+
+    def parse(self) -> CompiledRule:
+        compiled = self.parse_or()
+        self.take(END)
+        return compiled
+
+    def parse_or(self) -> CompiledRule:
+        compiled = self.parse_and()
+        while self.peek() == OR:
+            self.take(OR)
+            compiled = compile_or(compiled, self.parse_and())
+        return compiled
+
+    def parse_and(self) -> CompiledRule:
+        compiled = self.parse_primary()
+        while self.peek() == AND:
+            self.take(AND)
+            compiled = compile_and(compiled, self.parse_primary())
+        return compiled
+
+    def parse_primary(self) -> CompiledRule:
+        kind = self.peek()
+        if kind == OPAR:
+            self.take(OPAR)
+            compiled = self.parse_or()
+            self.take(CPAR)
+            return compiled
+        if kind == REGEX:
+            text = self.take(REGEX)[1]
+            return lambda variables: text
+        if kind == STRING:
+            left = self.take(STRING)
+            op = self.take(EQ, NE)[0]
+            return compile_compare(left, op, self.take(VARIABLE))
+        left = self.take(VARIABLE)
+        op = self.peek()
+        if op in [EQ, NE]:
+            self.take(op)
+            return compile_compare(left, op, self.take(STRING))
+        if op in [MATCH, NMATCH]:
+            self.take(op)
+            return compile_match(left, op, self.take(REGEX, VARIABLE))
+        return compile_defined(left)
+
+
+def get_rule_engine() -> str:
+    """Get the name of the engine used to evaluate rules"""
+    engine = os.environ.get(RULE_ENGINE_ENV, RULE_ENGINE_NATIVE)
+    if engine not in RULE_ENGINES:
+        raise GitlabEmulatorError(f"{RULE_ENGINE_ENV} must be one of {RULE_ENGINES}")
+    return engine
+
+
+def compile_antlr_rule(rule: str) -> CompiledRule:
+    # only import the antlr runtime if it is used
+    from .ruleparser import compile_rule as antlr_compile_rule
+    return antlr_compile_rule(rule)
+
+
+@lru_cache(RULE_CACHE_SIZE)
+def compile_native_rule(rule: str) -> CompiledRule:
+    """
+    Parse a rule expression into a function taking a map of variables
+    :param rule:
+    :return:
+    """
+    try:
+        return RuleParser(rule).parse()
+    except RuleSyntaxError as err:
+        syntax_error = err
+    # the antlr parser recovers from some errors, use it if we have it
+    try:
+        return compile_antlr_rule(rule)
+    except ImportError:
+        raise syntax_error
+
+
+def compile_rule(rule: str, engine: Optional[str] = None) -> CompiledRule:
+    """
+    Compile a rule expression with the selected engine
+    :param rule:
+    :param engine: "native" or "antlr", defaults to the value of GLE_RULE_ENGINE or "native"
+    :return:
+    """
+    if engine is None:
+        engine = get_rule_engine()
+    if engine == RULE_ENGINE_ANTLR:
+        return compile_antlr_rule(rule)
+    return compile_native_rule(rule)
+
+
+def evaluate_rule(rule: str, variables: Optional[Dict[str, str]], engine: Optional[str] = None):
+    """
+    Evaluate a rule expression
+    :param rule:
+    :param variables:
+    :param engine: "native" or "antlr", defaults to the value of GLE_RULE_ENGINE or "native"
+    :return:
+    """
+    if variables is None:
+        variables = {}
+    return compile_rule(rule, engine)(variables)
@@ -1,4 +1,4 @@
-import re
+from functools import lru_cache
 from typing import Dict, Optional
 
 from antlr4 import InputStream, CommonTokenStream
@@ -7,83 +7,78 @@ from antlr4.Token import CommonToken
 from gitlabemu.rules.GitlabRuleParser import GitlabRuleParser
 from gitlabemu.rules.GitlabRuleLexer import GitlabRuleLexer
 from gitlabemu.rules.GitlabRuleVisitor import GitlabRuleVisitor
+from gitlabemu.ruleengine import (RULE_CACHE_SIZE, CompiledRule, Token, STRING, REGEX, VARIABLE,
+                                  compile_defined, compile_compare, compile_match, compile_and, compile_or)
 
+RULE_TOKEN_TYPES = {
+    GitlabRuleLexer.STRING: STRING,
+    GitlabRuleLexer.REGEX: REGEX,
+    GitlabRuleLexer.VARIABLE: VARIABLE,
+}
 
-class RuleVisitor(GitlabRuleVisitor):
-    def __init__(self, variables: Optional[Dict[str, str]] = None):
-        self.variables: Dict[str, str] = {}
-        if variables:
-            self.variables.update(variables)
-
-    def get_variable_name(self, symbol: CommonToken):
-        if symbol.type == GitlabRuleLexer.VARIABLE:
-            name = symbol.text[1:]
-            return name
-        return ""
-
-    def resolve_variable(self, symbol: CommonToken):
-        text = symbol.text
-        name = self.get_variable_name(symbol)
-        if name:
-            return self.variables.get(name, "")
-        # strip quotes
-        if text[0] == '"':
-            return text[1:-1]
-        return text
+
+class RuleCompiler(GitlabRuleVisitor):
+    """Turn a parsed rule expression into a function that evaluates it against a map of variables"""
+
+    @staticmethod
+    def token(symbol: CommonToken) -> Token:
+        return RULE_TOKEN_TYPES.get(symbol.type, symbol.text), symbol.text
 
     def visitRegex(self, ctx: GitlabRuleParser.RegexContext):
         assert len(ctx.children) == 1
-        return ctx.children[0].symbol.text
+        text = ctx.children[0].symbol.text
+        return lambda variables: text
 
     def visitVariable(self, ctx: GitlabRuleParser.VariableContext):
-        """Return True if VARNAME is set to anything except the empty string"""
         assert len(ctx.children) == 1
-        name = self.get_variable_name(ctx.children[0].symbol)
-        return self.variables.get(name, "") != ""
+        return compile_defined(self.token(ctx.children[0].symbol))
 
     def visitCompare(self, ctx: GitlabRuleParser.CompareContext):
-        """Compare strings/variables for equality"""
         assert len(ctx.children) == 3
         assert ctx.op.type in [GitlabRuleLexer.EQ, GitlabRuleLexer.NE]
-        left = self.resolve_variable(ctx.children[0].symbol)
-        right = self.resolve_variable(ctx.children[2].symbol)
-
-        if ctx.op.type == GitlabRuleLexer.EQ:
-            return left == right
-        return left != right
+        return compile_compare(self.token(ctx.children[0].symbol),
+                               ctx.op.text,
+                               self.token(ctx.children[2].symbol))
 
     def visitMatch(self, ctx: GitlabRuleParser.MatchContext):
         assert len(ctx.children) == 3
         assert ctx.op.type in [GitlabRuleLexer.MATCH, GitlabRuleLexer.NMATCH]
-        left = self.resolve_variable(ctx.children[0].symbol)
-        right = self.resolve_variable(ctx.children[2].symbol)
-        if right.startswith("/") and right.endswith("/"):
-            # is a regex
-            patt = re.compile(right[1:-1])
-            matched = patt.search(left)
-            if ctx.op.type == GitlabRuleLexer.MATCH:
-                return matched is not None
-            return matched is None
-        return False
+        return compile_match(self.token(ctx.children[0].symbol),
+                             ctx.op.text,
+                             self.token(ctx.children[2].symbol))
 
     def visitBoolAnd(self, ctx: GitlabRuleParser.BoolAndContext):
-        left = self.visit(ctx.expr(0))
-        right = self.visit(ctx.expr(1))
-        return left and right
+        return compile_and(self.compile(ctx.expr(0)), self.compile(ctx.expr(1)))
 
-    def visitBoolOr(self, ctx:GitlabRuleParser.BoolOrContext):
-        left = self.visit(ctx.expr(0))
-        right = self.visit(ctx.expr(1))
-        return left or right
+    def visitBoolOr(self, ctx: GitlabRuleParser.BoolOrContext):
+        return compile_or(self.compile(ctx.expr(0)), self.compile(ctx.expr(1)))
 
     def visitParens(self, ctx: GitlabRuleParser.ParensContext):
-        return self.visit(ctx.expr())
-
-
-def evaluate_rule(rule: str, variables: Dict[str, str]):
+        return self.compile(ctx.expr())
+
+    def compile(self, tree) -> CompiledRule:
+        result = self.visit(tree)
+        if not callable(result):
+            # parts of the tree that could not be parsed
+            return lambda variables: result
+        return result
+
+
+@lru_cache(RULE_CACHE_SIZE)
+def compile_rule(rule: str) -> CompiledRule:
+    """
+    Parse a rule expression into a function taking a map of variables
+    :param rule:
+    :return:
+    """
     lexer = GitlabRuleLexer(InputStream(rule))
     stream = CommonTokenStream(lexer)
     parser = GitlabRuleParser(stream)
     tree = parser.expr()
-    visitor = RuleVisitor(variables)
-    return visitor.visit(tree)
+    return RuleCompiler().compile(tree)
+
+
+def evaluate_rule(rule: str, variables: Optional[Dict[str, str]]):
+    if variables is None:
+        variables = {}
+    return compile_rule(rule)(variables)
@@ -0,0 +1,99 @@
+"""
+Give each gle run a folder to keep job logs and artifacts in, and remove old runs
+"""
+import hashlib
+import os
+import shutil
+import threading
+import time
+from typing import List, Optional
+
+from .configcache import get_cache_dir
+from .helpers import make_path_slug
+from .logmsg import debug
+
+RUN_DIR_ENV = "GLE_RUN_DIR"
+KEEP_RUNS_ENV = "GLE_KEEP_RUNS"
+DEFAULT_KEEP_RUNS = 10
+
+_run_dir: Optional[str] = None
+_run_dir_lock = threading.Lock()
+
+
+def get_project_id(project_dir: Optional[str] = None) -> str:
+    """
+    Get a folder name for a project that is unique to where it is
+    :param project_dir: the folder with the pipeline, defaults to the current folder
+    :return:
+    """
+    if project_dir is None:
+        project_dir = os.getcwd()
+    project_dir = os.path.abspath(project_dir)
+    digest = hashlib.sha256(project_dir.encode("utf-8")).hexdigest()[:8]
+    return f"{make_path_slug(os.path.basename(project_dir))}-{digest}"
+
+
+def get_runs_dir(project_dir: Optional[str] = None) -> str:
+    """
+    Get the folder holding the runs of a project, set by GLE_RUN_DIR or else a folder in the cache
+    :param project_dir: the folder with the pipeline, defaults to the current folder
+    :return:
+    """
+    folder = os.environ.get(RUN_DIR_ENV, None)
+    if folder:
+        return folder
+    return os.path.join(get_cache_dir(), "runs", get_project_id(project_dir))
+
+
+def list_runs(project_dir: Optional[str] = None) -> List[str]:
+    """Get the run folders of a project, newest first"""
+    folder = get_runs_dir(project_dir)
+    try:
+        # skip the artifact store
+        names = [x for x in os.listdir(folder) if not x.startswith(".") and os.path.isdir(os.path.join(folder, x))]
+    except FileNotFoundError:
+        return []
+    return [os.path.join(folder, x) for x in sorted(names, reverse=True)]
+
+
+def get_keep_runs() -> int:
+    """Get how many runs to keep, set by GLE_KEEP_RUNS"""
+    try:
+        return max(int(os.environ.get(KEEP_RUNS_ENV, DEFAULT_KEEP_RUNS)), 1)
+    except ValueError:
+        return DEFAULT_KEEP_RUNS
+
+
+def prune_runs(project_dir: Optional[str] = None) -> None:
+    """Remove all but the newest GLE_KEEP_RUNS runs, and the artifacts only they used"""
+    old = list_runs(project_dir)[get_keep_runs():]
+    for folder in old:
+        debug(f"removing old run {folder}")
+        shutil.rmtree(folder, ignore_errors=True)
+    if old:
+        from .localartifacts import collect_garbage
+        collect_garbage(project_dir)
+
+
+def get_run_dir() -> str:
+    """
+    Get the folder for this gle process, creating it (and removing old runs) the first time
+    :return:
+    """
+    global _run_dir
+    with _run_dir_lock:
+        runs = get_runs_dir()
+        if _run_dir is None or not os.path.isdir(_run_dir) or os.path.dirname(_run_dir) != runs:
+            name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+            folder = os.path.join(runs, name)
+            os.makedirs(folder, exist_ok=True)
+            _run_dir = folder
+            prune_runs()
+        return _run_dir
+
+
+def reset_run_dir() -> None:
+    """Start a new run folder the next time one is needed"""
+    global _run_dir
+    with _run_dir_lock:
+        _run_dir = None
@@ -11,6 +11,7 @@ from . import configloader
 from .docker import DockerJob
 from .gitlab_client_api import PipelineError, PipelineInvalid, PipelineNotFound, posix_cert_fixup
 from .jobs import Job
+from .joblogs import LOG_SUFFIX, JobLogReader, find_job_log
 from .jobtypes import JobFactory, ScriptJobFactory
 from .localfiles import restore_path_ownership
 from .helpers import (is_linux, is_windows,
@@ -20,6 +21,8 @@ from .helpers import (is_linux, is_windows,
 from .localstats import put_duration
 from .logmsg import debugrule, enable_rule_debug, info
 from .pipelines import pipelines_cmd, generate_pipeline, print_pipeline_jobs, export_cmd
+from .rundir import list_runs
+from .scheduler import DagExecutor, PipelineExecutor, ParallelExecutor, JOB_FAILED
 from .userconfig import USER_CFG_ENV, get_user_config_context
 from .userconfigdata import UserContext
 from .glp.types import Match
@@ -40,11 +43,20 @@ parser.add_argument("--noop", "-n", default=False, action="store_true",
 list_mutex.add_argument("--full", "-r", dest="FULL", default=False,
                         action="store_true",
                         help="Run any jobs that are dependencies")
+list_mutex.add_argument("--pipeline-local", dest="pipeline_local", default=False, action="store_true",
+                        help="Run every job in the pipeline locally, a stage at a time")
+parser.add_argument("--jobs", "-j", dest="max_jobs", type=int, default=None, metavar="N",
+                    help="With --full or --pipeline-local, run up to N jobs at the same time "
+                         "(default 1 with --full, the number of CPUs with --pipeline-local)")
+parser.add_argument("--keep-going", dest="keep_going", default=False, action="store_true",
+                    help="With --full, keep running jobs that do not need a failed job")
 parser.add_argument("--config", "-c", dest="CONFIG", default=CONFIG_DEFAULT,
                     type=str,
                     help="Use an alternative gitlab yaml file")
 parser.add_argument("--settings", "-s", dest="USER_SETTINGS", type=str, default=None,
                     help="Load gitlab emulator settings from a file")
+parser.add_argument("--no-cache", dest="no_cache", default=False, action="store_true",
+                    help="Do not use or update the cache of previously loaded pipeline files")
 parser.add_argument("--chdir", "-C", dest="chdir", default=None, type=str, metavar="DIR",
                     help="Change to this directory before running")
 
@@ -93,7 +105,8 @@ parser.add_argument("--revar", dest="revars", metavar="REGEX", type=str, default
                     help="Set pipeline variables that match the given regex")
 
 parser.add_argument("--parallel", type=str,
-                    help="Run JOB as one part of a parallel axis (eg 2/4 runs job 2 in a 4 parallel matrix)")
+                    help="Run JOB as one part of a parallel axis (eg 2/4 runs job 2 in a 4 parallel matrix), "
+                         "or 'all' to run every part at the same time")
 
 parser.add_argument("--pipeline", default=False, action="store_true",
                     help="Run JOB on or list pipelines from a gitlab server")
@@ -125,6 +138,15 @@ list_mutex.add_argument("--clean", dest="clean", default=False, action="store_tr
                         help="Clean up any leftover docker containers or networks")
 list_mutex.add_argument("--cancel", default=False, action="store_true",
                         help="Cancel pipelines that match --match x=y, (requires --pipeline)")
+list_mutex.add_argument("--logs", default=False, action="store_true",
+                        help="Instead of building JOB, print the log of its latest local run, "
+                             "or list the logs of the latest run")
+parser.add_argument("--tail", type=int, default=None, metavar="N",
+                    help="with --logs, print only the last N lines")
+parser.add_argument("--since", type=float, default=None, metavar="SECONDS",
+                    help="with --logs, print output from this many seconds after the job started")
+parser.add_argument("--until", type=float, default=None, metavar="SECONDS",
+                    help="with --logs, print output up to this many seconds after the job started")
 
 
 if is_windows():  # pragma: cover if windows
@@ -262,32 +284,219 @@ def execute_job(config: Dict[str, Any],
         if recurse:
             for need in jobobj.dependencies:
                 execute_job(config, need, seen=seen, recurse=True, noop=noop, jobfactory=jobfactory, chown=chown)
-        print(f">>> execute {jobobj.name}:", file=sys.stderr)
+        execute_loaded_job(jobobj, use_runner=use_runner, noop=noop, chown=chown)
+        seen.add(jobname)
 
-        if noop:
-            if isinstance(jobobj, DockerJob):
-                print(f"image: {jobobj.docker_image}")
-            for envname, envvalue in jobobj.get_envs().items():
-                print(f"setenv {envname}={envvalue}")
 
-            for line in jobobj.before_script + jobobj.script:
-                print(f"script {line}")
-        else:
-            started_time = time.monotonic()
-            GLE_RUNTIME_GLOBALS.current_job = jobobj
-            GLE_RUNTIME_GLOBALS.job_start_time = started_time
+def execute_loaded_job(jobobj: Job,
+                       use_runner=False,
+                       noop=False,
+                       chown=True,
+                       ):
+    """
+    Run a job that has already been loaded
+    :param jobobj: the job to run
+    :param use_runner: if True, execute using "gitlab-runner exec"
+    :param noop: if True, print instead of execute commands
+    :param chown: If True and if using docker, attempt to restore the folder ownership.
+    :return:
+    """
+    print(f">>> execute {jobobj.name}:", file=sys.stderr)
 
-            try:
-                if use_runner:
-                    gitlab_runner_exec(jobobj)
-                else:
-                    jobobj.run()
-            finally:
-                if chown:
-                    restore_path_ownership(os.getcwd())
+    if noop:
+        if isinstance(jobobj, DockerJob):
+            print(f"image: {jobobj.docker_image}", file=jobobj.stdout)
+        for envname, envvalue in jobobj.get_envs().items():
+            print(f"setenv {envname}={envvalue}", file=jobobj.stdout)
 
-            put_duration(jobname, int(time.monotonic() - started_time))
-        seen.add(jobname)
+        for line in jobobj.before_script + jobobj.script:
+            print(f"script {line}", file=jobobj.stdout)
+    else:
+        started_time = time.monotonic()
+        GLE_RUNTIME_GLOBALS.current_job = jobobj
+        GLE_RUNTIME_GLOBALS.job_start_time = started_time
+
+        try:
+            if use_runner:
+                gitlab_runner_exec(jobobj)
+            else:
+                jobobj.run()
+        finally:
+            if chown:
+                restore_path_ownership(os.getcwd())
+
+        put_duration(jobobj.name, int(time.monotonic() - started_time))
+
+
+def execute_dag(config: Dict[str, Any],
+                jobname: str,
+                max_jobs=1,
+                keep_going=False,
+                use_runner=False,
+                noop=False,
+                options: Optional[Dict[str, Any]] = None,
+                overrides: Optional[Dict[str, Any]] = None,
+                jobfactory: Optional[JobFactory] = None,
+                chown=True,
+                pretty=False,
+                ) -> DagExecutor:
+    """
+    Run a job after the jobs it needs, running up to max_jobs independent jobs at once
+    :param config: the config dictionary
+    :param jobname: the job to finish with
+    :param max_jobs: run at most this many jobs at the same time
+    :param keep_going: if True, keep running jobs that do not need a failed job
+    :param use_runner: if True, execute using "gitlab-runner exec"
+    :param noop: if True, print instead of execute commands
+    :param options: If given, set attributes on the job before use.
+    :param overrides: If given, replace properties in the top level of a job dictionary.
+    :param jobfactory:
+    :param chown: If True and if using docker, attempt to restore the folder ownership once all jobs have finished.
+    :param pretty: If True, print output in a more visually friendly way
+    :return: the executor holding the state of each job
+    """
+    if pretty and not use_runner:
+        GLE_RUNTIME_GLOBALS.output_thread_type = PrettyProcessLineProxyThread
+
+    def runjob(jobobj: Job) -> None:
+        execute_loaded_job(jobobj, use_runner=use_runner, noop=noop, chown=False)
+
+    executor = DagExecutor(config, jobname, runjob,
+                           max_jobs=max_jobs,
+                           keep_going=keep_going,
+                           jobfactory=jobfactory,
+                           overrides=overrides,
+                           options=options)
+    run_executor(executor, chown=chown and not noop)
+    return executor
+
+
+def execute_pipeline(loader: configloader.Loader,
+                     max_jobs=1,
+                     use_runner=False,
+                     noop=False,
+                     options: Optional[Dict[str, Any]] = None,
+                     overrides: Optional[Dict[str, Any]] = None,
+                     jobfactory: Optional[JobFactory] = None,
+                     chown=True,
+                     ) -> PipelineExecutor:
+    """
+    Run every job in the pipeline in stage order, running up to max_jobs jobs at once
+    :param loader: the loaded pipeline
+    :param max_jobs: run at most this many jobs at the same time
+    :param use_runner: if True, execute using "gitlab-runner exec"
+    :param noop: if True, print instead of execute commands
+    :param options: If given, set attributes on each job before use.
+    :param overrides: If given, replace properties in the top level of each job dictionary.
+    :param jobfactory:
+    :param chown: If True and if using docker, attempt to restore the folder ownership once all jobs have finished.
+    :return: the executor holding the state of each job
+    """
+    def runjob(jobobj: Job) -> None:
+        execute_loaded_job(jobobj, use_runner=use_runner, noop=noop, chown=False)
+
+    executor = PipelineExecutor(loader, runjob,
+                                max_jobs=max_jobs,
+                                jobfactory=jobfactory,
+                                overrides=overrides,
+                                options=options)
+    run_executor(executor, chown=chown and not noop)
+    return executor
+
+
+def execute_parallel(config: Dict[str, Any],
+                     jobname: str,
+                     total: int,
+                     max_jobs: Optional[int] = None,
+                     use_runner=False,
+                     noop=False,
+                     options: Optional[Dict[str, Any]] = None,
+                     overrides: Optional[Dict[str, Any]] = None,
+                     jobfactory: Optional[JobFactory] = None,
+                     chown=True,
+                     pretty=False,
+                     ) -> ParallelExecutor:
+    """
+    Run every index of a parallel job at the same time
+    :param config: the config dictionary
+    :param jobname: the parallel job
+    :param total: the number of parallel jobs
+    :param max_jobs: run at most this many jobs at the same time, defaults to total
+    :param use_runner: if True, execute using "gitlab-runner exec"
+    :param noop: if True, print instead of execute commands
+    :param options: If given, set attributes on each job before use.
+    :param overrides: If given, replace properties in the top level of each job dictionary.
+    :param jobfactory:
+    :param chown: If True and if using docker, attempt to restore the folder ownership once all jobs have finished.
+    :param pretty: If True, print output in a more visually friendly way
+    :return: the executor holding the state of each job
+    """
+    if pretty and not use_runner:
+        GLE_RUNTIME_GLOBALS.output_thread_type = PrettyProcessLineProxyThread
+
+    def runjob(jobobj: Job) -> None:
+        execute_loaded_job(jobobj, use_runner=use_runner, noop=noop, chown=False)
+
+    executor = ParallelExecutor(config, jobname, runjob, total,
+                                max_jobs=max_jobs,
+                                jobfactory=jobfactory,
+                                overrides=overrides,
+                                options=options)
+    run_executor(executor, chown=chown and not noop)
+    return executor
+
+
+def run_executor(executor: DagExecutor, chown=True) -> None:
+    """Run the jobs in an executor and then restore the folder ownership"""
+    try:
+        executor.run()
+    finally:
+        if chown:
+            restore_path_ownership(os.getcwd())
+
+
+def do_pipeline_local(options: argparse.Namespace, loader: configloader.Loader):
+    """Run every job in the pipeline on this machine"""
+    for name, value in [("-i", options.enter_shell),
+                        ("--before-script", options.only_before_script),
+                        ("--shell-on-error", options.error_shell),
+                        ("--gen-script", options.gen_script),
+                        ("--parallel", options.parallel)]:
+        if value:
+            die(f"{name} is not compatible with --pipeline-local")
+
+    fix_ownership = has_docker() and is_linux()
+    if options.no_docker:
+        loader.config["hide_docker"] = True
+        fix_ownership = False
+
+    job_options = {}
+    if options.docker_pull is not None:
+        job_options["docker_pull_policy"] = options.docker_pull
+    overrides = {}
+    if options.image:
+        overrides["image"] = options.image
+    if options.timeout is not None:
+        overrides["timeout"] = options.timeout or None
+    apply_user_config(loader, is_docker=not options.no_docker)
+
+    GLE_RUNTIME_GLOBALS.reset()
+    try:
+        executor = execute_pipeline(loader,
+                                    max_jobs=options.max_jobs or os.cpu_count() or 1,
+                                    use_runner=options.exec,
+                                    noop=options.noop,
+                                    options=job_options,
+                                    overrides=overrides,
+                                    jobfactory=JobFactory(),
+                                    chown=fix_ownership,
+                                    )
+    except gitlabemu.errors.GitlabEmulatorError as err:
+        die(f"Config error: {err}")
+    print(executor.summary(), file=sys.stderr)
+    if executor.failed:
+        die("pipeline failed")
+    print("Pipeline complete!")
 
 
 def do_pipeline(options: argparse.Namespace, loader):
@@ -370,6 +579,35 @@ def do_gitlab_from(options: argparse.Namespace, loader):
             die(str(error))
 
 
+def do_logs(options: argparse.Namespace):
+    """Print a saved job log, or list the logs of the latest run"""
+    runs = list_runs()
+    if not options.JOB:
+        if not runs:
+            die("No local runs found")
+        logs = os.path.join(runs[0], "logs")
+        if os.path.isdir(logs):
+            for name in sorted(os.listdir(logs)):
+                if name.endswith(LOG_SUFFIX):
+                    print(name[:-len(LOG_SUFFIX)])
+        return
+
+    path = find_job_log(runs, options.JOB)
+    if not path:
+        die(f"No log found for {options.JOB}")
+    reader = JobLogReader(path)
+    if options.tail is not None:
+        if options.since is not None or options.until is not None:
+            die("--tail cannot be used with --since or --until")
+        lines = reader.tail(options.tail)
+    else:
+        lines = reader.between(options.since, options.until)
+    output = sys.stdout.buffer
+    for line in lines:
+        output.write(line)
+    output.flush()
+
+
 def get_version():
     import pkg_resources
     try:
@@ -410,6 +648,12 @@ def run(args=None):
         clean_leftovers()
         sys.exit()
 
+    if options.max_jobs is not None:
+        if options.max_jobs < 1:
+            die("--jobs must be at least 1")
+        if options.max_jobs > 1 and options.pretty:
+            die("--pretty cannot be used with --jobs")
+
     if options.chdir:
         if not os.path.exists(options.chdir):
             die(f"Cannot change to {options.chdir}, no such directory")
@@ -448,11 +692,16 @@ def run(args=None):
     fullpath = os.path.abspath(yamlfile)
     rootdir = os.path.dirname(fullpath)
     os.chdir(rootdir)
-    loader = get_loader(variables)
+    if options.logs:
+        do_logs(options)
+        return
+    # when running a single job, only resolve that job and the jobs it needs
+    lazy = bool(jobname) and not options.LIST
+    loader = get_loader(variables, use_cache=not options.no_cache, lazy=lazy)
     hide_dot_jobs = not options.hidden
     try:
         if options.pipeline or options.FROM:
-            loader = get_loader(variables, emulator_variables=False)
+            loader = get_loader(variables, emulator_variables=False, use_cache=not options.no_cache)
             loader.load(fullpath)
             with posix_cert_fixup():
                 if options.pipeline:
@@ -467,6 +716,8 @@ def run(args=None):
                     return
         else:
             loader.load(fullpath)
+            if lazy:
+                loader.resolve_jobs([jobname])
     except gitlabemu.jobs.NoSuchJob as err:
         die(f"Job error: {err}")
     except gitlabemu.errors.ConfigLoaderError as err:
@@ -489,6 +740,11 @@ def run(args=None):
             if job.check_skipped():
                 debugrule(f"{jobname} skipped by rules: {job.skipped_reason}")
             print(jobname)
+    elif options.pipeline_local:
+        if jobname:
+            die("--pipeline-local runs every job, do not give a JOB")
+        loader.config["ci_config_file"] = os.path.relpath(fullpath, rootdir)
+        do_pipeline_local(options, loader)
     elif not jobname:
         parser.print_usage()
         sys.exit(1)
@@ -498,7 +754,18 @@ def run(args=None):
             die(f"No such job {jobname}")
         job_options = {}
 
-        if options.parallel:
+        parallel_total = None
+        if options.parallel == "all":
+            parallel_total = loader.config[jobname].get("parallel", None)
+            if parallel_total is None:
+                die(f"Job {jobname} is not a parallel enabled job")
+            if not isinstance(parallel_total, int):
+                die("--parallel all only supports 'parallel: N' jobs")
+            if options.FULL:
+                die("--parallel all cannot be used with --full")
+            if options.enter_shell:
+                die("-i is not compatible with --parallel all")
+        elif options.parallel:
             if loader.config[jobname].get("parallel", None) is None:
                 die(f"Job {jobname} is not a parallel enabled job")
 
@@ -579,18 +846,50 @@ def run(args=None):
 
         GLE_RUNTIME_GLOBALS.reset()
 
-        executed_jobs = set()
-        execute_job(loader.config, jobname,
-                    seen=executed_jobs,
-                    use_runner=options.exec,
-                    recurse=options.FULL,
-                    noop=options.noop,
-                    options=job_options,
-                    overrides=overrides,
-                    jobfactory=jobfactory,
-                    chown=fix_ownership,
-                    pretty=options.pretty,
-                    )
+        if options.FULL:
+            try:
+                executor = execute_dag(loader.config, jobname,
+                                       max_jobs=options.max_jobs or 1,
+                                       keep_going=options.keep_going,
+                                       use_runner=options.exec,
+                                       noop=options.noop,
+                                       options=job_options,
+                                       overrides=overrides,
+                                       jobfactory=jobfactory,
+                                       chown=fix_ownership,
+                                       pretty=options.pretty,
+                                       )
+            except gitlabemu.errors.GitlabEmulatorError as err:
+                die(f"Config error: {err}")
+            print(executor.summary(), file=sys.stderr)
+            if executor.failed:
+                die("pipeline failed")
+        elif parallel_total:
+            executor = execute_parallel(loader.config, jobname, parallel_total,
+                                        # one spinner at a time, as with --jobs
+                                        max_jobs=1 if options.pretty else options.max_jobs,
+                                        use_runner=options.exec,
+                                        noop=options.noop,
+                                        options=job_options,
+                                        overrides=overrides,
+                                        jobfactory=jobfactory,
+                                        chown=fix_ownership,
+                                        pretty=options.pretty,
+                                        )
+            print(executor.summary(), file=sys.stderr)
+            if executor.failed:
+                die(f"{len([x for x in executor.jobs.values() if x.state == JOB_FAILED])} of {parallel_total} "
+                    f"{jobname} jobs failed")
+        else:
+            execute_job(loader.config, jobname,
+                        use_runner=options.exec,
+                        noop=options.noop,
+                        options=job_options,
+                        overrides=overrides,
+                        jobfactory=jobfactory,
+                        chown=fix_ownership,
+                        pretty=options.pretty,
+                        )
 
         if not options.gen_script:
             print("Build complete!")
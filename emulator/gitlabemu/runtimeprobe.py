@@ -0,0 +1,159 @@
+"""
+Detect the container runtime once and share the result between calls and gle processes
+"""
+import hashlib
+import json
+import os
+import subprocess
+import threading
+import time
+from typing import Dict, Optional, Any
+
+from .configcache import get_cache_dir, atomic_write
+from .logmsg import debug
+from .userconfigdata import DEFAULT_DOCKER_CLI
+
+RUNTIME_PROBE_TTL = 30
+RUNTIME_PROBE_FORMAT = "{{.ServerVersion}}|{{.OSType}}|{{.Isolation}}"
+# which engine a docker cli talks to depends on these as well as the cli
+RUNTIME_PROBE_ENVS = ["DOCKER_HOST", "DOCKER_CONTEXT"]
+
+_probed: Dict[str, "RuntimeInfo"] = {}
+_probe_lock = threading.Lock()
+
+
+class RuntimeInfo:
+    """What we know about the container runtime used by a docker cli"""
+
+    def __init__(self, docker_cli: str = DEFAULT_DOCKER_CLI):
+        self.docker_cli = docker_cli
+        self.present = False
+        self.server_version = ""
+        self.os_type = ""
+        self.isolation = ""
+        self.probe_time = 0.0
+
+    @property
+    def is_windows_hyperv(self) -> bool:
+        return self.isolation == "hyperv"
+
+    @property
+    def expired(self) -> bool:
+        age = time.time() - self.probe_time
+        return age < 0 or age > RUNTIME_PROBE_TTL
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "docker_cli": self.docker_cli,
+            "present": self.present,
+            "server_version": self.server_version,
+            "os_type": self.os_type,
+            "isolation": self.isolation,
+            "probe_time": self.probe_time,
+        }
+
+    def populate(self, data: Dict[str, Any]) -> "RuntimeInfo":
+        self.present = bool(data.get("present", False))
+        self.server_version = str(data.get("server_version", ""))
+        self.os_type = str(data.get("os_type", ""))
+        self.isolation = str(data.get("isolation", ""))
+        self.probe_time = float(data.get("probe_time", 0))
+        return self
+
+
+def probe_key(docker_cli: str) -> str:
+    """Get the key for probes of the engine that a docker cli uses with the current environment"""
+    return "\n".join([docker_cli] + [os.environ.get(name, "") for name in RUNTIME_PROBE_ENVS])
+
+
+def probe_cache_path(key: str) -> str:
+    name = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(get_cache_dir(), "runtime", name + ".json")
+
+
+def load_probe(docker_cli: str, key: str) -> Optional[RuntimeInfo]:
+    """Read a previous probe result from disk if it has not expired"""
+    path = probe_cache_path(key)
+    try:
+        with open(path, "r", encoding="utf-8") as fd:
+            found = RuntimeInfo(docker_cli).populate(json.load(fd))
+    except FileNotFoundError:
+        return None
+    except Exception as err:
+        debug(f"ignoring unreadable runtime probe {path}: {err}")
+        return None
+    if found.expired:
+        return None
+    return found
+
+
+def save_probe(found: RuntimeInfo, key: str) -> None:
+    """Save a probe result for other gle processes, unless docker was not found, so that it is tried again"""
+    if not found.present:
+        return
+    path = probe_cache_path(key)
+    try:
+        atomic_write(path, json.dumps(found.to_dict()).encode("utf-8"))
+    except OSError as err:
+        debug(f"could not save runtime probe {path}: {err}")
+
+
+def probe_runtime(docker_cli: str = DEFAULT_DOCKER_CLI) -> RuntimeInfo:
+    """
+    Run the docker cli to find out if docker is working and what kind of server it has
+    :param docker_cli:
+    :return:
+    """
+    found = RuntimeInfo(docker_cli)
+    found.probe_time = time.time()
+    # noinspection PyBroadException
+    try:
+        output = subprocess.check_output([docker_cli, "info", "--format", RUNTIME_PROBE_FORMAT],
+                                         stderr=subprocess.STDOUT, encoding="utf-8")
+        found.present = True
+        parts = output.strip().split("|")
+        if len(parts) == 3:
+            found.server_version, found.os_type, found.isolation = parts
+        debug(f"docker detected: {output.strip()}")
+    except subprocess.CalledProcessError:
+        # some docker compatible tools can't format every field
+        try:
+            subprocess.check_output([docker_cli, "info"], stderr=subprocess.STDOUT)
+            found.present = True
+            debug("docker detected")
+        except Exception:  # pragma: no cover
+            pass
+    except Exception:  # pragma: no cover
+        pass
+    return found
+
+
+def get_runtime_info(docker_cli: Optional[str] = None) -> RuntimeInfo:
+    """
+    Get the container runtime details, probing at most once per process unless a recent
+    probe from another gle process is found
+    :param docker_cli: the docker command to use, defaults to "docker"
+    :return:
+    """
+    if not docker_cli:
+        docker_cli = DEFAULT_DOCKER_CLI
+    key = probe_key(docker_cli)
+    with _probe_lock:
+        found = _probed.get(key, None)
+        if found is None:
+            found = load_probe(docker_cli, key)
+            if found is None:
+                found = probe_runtime(docker_cli)
+                save_probe(found, key)
+            _probed[key] = found
+        return found
+
+
+def forget_runtime_info() -> None:
+    """Forget all probe results so that the next call probes again"""
+    with _probe_lock:
+        for key in list(_probed.keys()):
+            path = probe_cache_path(key)
+            if os.path.exists(path):
+                os.unlink(path)
+        _probed.clear()
@@ -0,0 +1,414 @@
+"""
+Run a job and the jobs it needs, or a whole pipeline, running independent jobs at the same time
+"""
+import concurrent.futures
+import sys
+import threading
+import time
+from typing import Dict, Any, Optional, List, Callable, TextIO
+
+from .configloader import Loader, get_stages, load_job
+from .errors import GitlabEmulatorError
+from .jobs import Job
+from .jobtypes import JobFactory
+from .logmsg import info
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_SUCCESS = "success"
+JOB_FAILED = "failed"
+JOB_NOT_RUN = "not run"
+JOB_SKIPPED = "skipped"
+JOB_ALLOWED_FAILURE = "failed (allowed)"
+
+# needs in these states stop on_success jobs from running and let on_failure jobs run
+BLOCKING_STATES = [JOB_FAILED, JOB_NOT_RUN]
+
+
+class PrefixedOutput:
+    """A file-like object that writes each complete line to another stream with a prefix"""
+
+    def __init__(self, prefix: str, stream: TextIO, lock: threading.Lock):
+        self.prefix = prefix
+        self.stream = stream
+        self.lock = lock
+        self.pending = ""
+
+    @property
+    def encoding(self) -> str:
+        return getattr(self.stream, "encoding", None) or "utf-8"
+
+    def write(self, text: str) -> int:
+        self.pending += text
+        if "\n" in self.pending:
+            lines = self.pending.split("\n")
+            self.pending = lines.pop()
+            with self.lock:
+                for line in lines:
+                    self.stream.write(f"{self.prefix}{line}\n")
+                self.stream.flush()
+        return len(text)
+
+    def flush(self) -> None:
+        if self.pending:
+            with self.lock:
+                self.stream.write(f"{self.prefix}{self.pending}\n")
+                self.stream.flush()
+            self.pending = ""
+
+
+class ScheduledJob:
+    """A job and its state in the executor"""
+
+    def __init__(self, job: Job):
+        self.job = job
+        self.name: str = job.name
+        self.needs: List[str] = sorted(job.dependencies)
+        self.stage: str = job.stage
+        self.state = JOB_PENDING
+        self.started = 0.0
+        self.duration = 0.0
+        self.error: Optional[str] = None
+
+
+class DagExecutor:
+    """
+    Run a job after all the jobs it needs, running up to max_jobs jobs at once
+    """
+
+    def __init__(self,
+                 config: Dict[str, Any],
+                 jobname: str,
+                 runjob: Callable[[Job], None],
+                 max_jobs: int = 1,
+                 keep_going: bool = False,
+                 jobfactory: Optional[JobFactory] = None,
+                 overrides: Optional[Dict[str, Any]] = None,
+                 options: Optional[Dict[str, Any]] = None,
+                 stdout: Optional[TextIO] = None,
+                 ):
+        """
+        :param config: the loaded pipeline config
+        :param jobname: the job to run after all the jobs it needs
+        :param runjob: called to run each job, should raise an exception or exit if the job fails
+        :param max_jobs: the most jobs to run at once
+        :param keep_going: if True, keep starting jobs that don't need a failed job
+        :param jobfactory:
+        :param overrides: set in the top level of the job dictionary of jobname
+        :param options: attributes to set on jobname
+        :param stdout: if more than one job can run at once, write prefixed job output here
+        """
+        self.config = config
+        self.jobname = jobname
+        self.runjob = runjob
+        self.max_jobs = max(1, max_jobs)
+        self.keep_going = keep_going
+        self.jobfactory = jobfactory
+        self.overrides = overrides
+        self.options = options
+        self.stdout = stdout if stdout is not None else sys.stdout
+        self.output_lock = threading.Lock()
+        self.jobs: Dict[str, ScheduledJob] = {}
+        self.order: List[str] = []
+        self.allow_failures = False
+        self.show_stages = False
+
+    def load_job(self, name: str) -> Job:
+        """Load a job, applying the overrides and options if it is the requested job"""
+        if name == self.jobname:
+            job = load_job(self.config, name, overrides=self.overrides, jobfactory=self.jobfactory)
+            self.apply_options(job)
+        else:
+            job = load_job(self.config, name, jobfactory=self.jobfactory)
+        return job
+
+    def apply_options(self, job: Job) -> None:
+        for attr, value in (self.options or {}).items():
+            setattr(job, attr, value)
+
+    def load(self) -> None:
+        """Load the job and every job it needs"""
+        pending = [self.jobname]
+        while pending:
+            name = pending.pop(0)
+            if name not in self.jobs:
+                scheduled = ScheduledJob(self.load_job(name))
+                self.jobs[name] = scheduled
+                pending.extend(scheduled.needs)
+        self.sort([self.jobname])
+        self.prefix_output()
+
+    def sort(self, names: List[str]) -> None:
+        """
+        Put the jobs in an order they can run, each job after all the jobs it needs
+        :param names: visit the jobs in this order
+        :return:
+        """
+        visiting = set()
+
+        def visit(name: str, path: List[str]):
+            if name in self.order:
+                return
+            if name in visiting:
+                cycle = path[path.index(name):] + [name]
+                raise GitlabEmulatorError(f"circular needs: {' -> '.join(cycle)}")
+            visiting.add(name)
+            for need in self.jobs[name].needs:
+                visit(need, path + [name])
+            visiting.discard(name)
+            self.order.append(name)
+
+        for item in names:
+            visit(item, [])
+
+    def prefix_output(self) -> None:
+        """Prefix each line of job output with the job name if more than one job can run at once"""
+        if self.max_jobs > 1:
+            width = max(len(x) for x in self.order)
+            for scheduled in self.jobs.values():
+                scheduled.job.stdout = PrefixedOutput(f"[{scheduled.name:{width}}] ", self.stdout, self.output_lock)
+
+    def can_start(self, scheduled: ScheduledJob) -> Optional[bool]:
+        """
+        Decide if a pending job can start
+        :param scheduled:
+        :return: True if it can start now, False if it will never run or None if it must wait
+        """
+        states = [self.jobs[x].state for x in scheduled.needs]
+        if any(x in [JOB_PENDING, JOB_RUNNING] for x in states):
+            return None
+        if any(x in BLOCKING_STATES for x in states):
+            scheduled.state = JOB_NOT_RUN
+            return False
+        return True
+
+    def ready(self) -> List[ScheduledJob]:
+        """Get the pending jobs that can start now"""
+        found = []
+        for name in self.order:
+            scheduled = self.jobs[name]
+            if scheduled.state == JOB_PENDING:
+                if self.can_start(scheduled):
+                    found.append(scheduled)
+        return found
+
+    def execute(self, scheduled: ScheduledJob) -> None:
+        try:
+            self.runjob(scheduled.job)
+        finally:
+            if isinstance(scheduled.job.stdout, PrefixedOutput):
+                scheduled.job.stdout.flush()
+
+    @property
+    def failed(self) -> bool:
+        return any(x.state == JOB_FAILED for x in self.jobs.values())
+
+    @property
+    def stopping(self) -> bool:
+        """Return True if no more jobs should be started"""
+        return self.failed and not self.keep_going
+
+    def run(self) -> bool:
+        """
+        Run all the jobs
+        :return: True if every job succeeded
+        """
+        if not self.jobs:
+            self.load()
+        running: Dict[concurrent.futures.Future, ScheduledJob] = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_jobs) as pool:
+            try:
+                while True:
+                    if not self.stopping:
+                        for scheduled in self.ready()[:self.max_jobs - len(running)]:
+                            scheduled.state = JOB_RUNNING
+                            scheduled.started = time.monotonic()
+                            running[pool.submit(self.execute, scheduled)] = scheduled
+                    if not running:
+                        break
+                    done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        scheduled = running.pop(future)
+                        scheduled.duration = time.monotonic() - scheduled.started
+                        try:
+                            future.result()
+                            scheduled.state = JOB_SUCCESS
+                        except (Exception, SystemExit) as err:
+                            scheduled.error = str(err)
+                            if scheduled.job.allow_failure and self.allow_failures:
+                                scheduled.state = JOB_ALLOWED_FAILURE
+                                info(f"job {scheduled.name} failed (allowed to fail)")
+                            else:
+                                scheduled.state = JOB_FAILED
+                                info(f"job {scheduled.name} failed")
+            except KeyboardInterrupt:
+                for scheduled in running.values():
+                    scheduled.job.abort()
+                raise
+
+        for scheduled in self.jobs.values():
+            if scheduled.state == JOB_PENDING:
+                scheduled.state = JOB_NOT_RUN
+        return not self.failed
+
+    def summary(self) -> str:
+        """Get a table of the state and duration of each job"""
+        width = max([len(x) for x in self.order] + [3])
+        state_width = max([len(x.state) for x in self.jobs.values()] + [5])
+        stage_width = max([len(x.stage) for x in self.jobs.values()] + [5])
+        stage = f"{'stage':<{stage_width}}  " if self.show_stages else ""
+        lines = [f"{'job':<{width}}  {stage}{'state':<{state_width}}  {'duration':>8}"]
+        for name in self.order:
+            scheduled = self.jobs[name]
+            duration = ""
+            if scheduled.state in [JOB_SUCCESS, JOB_FAILED, JOB_ALLOWED_FAILURE]:
+                duration = f"{scheduled.duration:.1f}s"
+            if self.show_stages:
+                stage = f"{scheduled.stage:<{stage_width}}  "
+            lines.append(f"{name:<{width}}  {stage}{scheduled.state:<{state_width}}  {duration:>8}")
+        return "\n".join(lines)
+
+
+class PipelineExecutor(DagExecutor):
+    """
+    Run every job in a pipeline the way gitlab would, a stage at a time, except for jobs with needs
+    which start as soon as the jobs they need have finished.
+    """
+
+    def __init__(self,
+                 loader: Loader,
+                 runjob: Callable[[Job], None],
+                 max_jobs: int = 1,
+                 jobfactory: Optional[JobFactory] = None,
+                 overrides: Optional[Dict[str, Any]] = None,
+                 options: Optional[Dict[str, Any]] = None,
+                 stdout: Optional[TextIO] = None,
+                 ):
+        """
+        :param loader: the loaded pipeline
+        :param runjob: called to run each job, should raise an exception or exit if the job fails
+        :param max_jobs: the most jobs to run at once
+        :param jobfactory:
+        :param overrides: set in the top level of the job dictionary of every job
+        :param options: attributes to set on every job
+        :param stdout: if more than one job can run at once, write prefixed job output here
+        """
+        super().__init__(loader.config, "", runjob,
+                         max_jobs=max_jobs,
+                         jobfactory=jobfactory,
+                         overrides=overrides,
+                         options=options,
+                         stdout=stdout)
+        self.loader = loader
+        self.allow_failures = True
+        self.show_stages = True
+
+    def load_job(self, name: str) -> Job:
+        job = self.loader.load_job(name, overrides=self.overrides, jobfactory=self.jobfactory)
+        self.apply_options(job)
+        return job
+
+    def load(self) -> None:
+        """Load every job in the pipeline and work out what each one waits for"""
+        stages = list(get_stages(self.config))
+        if ".pre" not in stages:
+            stages.insert(0, ".pre")
+        if ".post" not in stages:
+            stages.append(".post")
+
+        names = [x for x in self.loader.get_jobs() if not x.startswith(".")]
+        for name in names:
+            scheduled = ScheduledJob(self.load_job(name))
+            self.jobs[name] = scheduled
+            if scheduled.job.check_skipped() or scheduled.job.when in ["never", "manual"]:
+                scheduled.state = JOB_SKIPPED
+
+        names.sort(key=lambda x: stages.index(self.jobs[x].stage))
+        active = [x for x in names if self.jobs[x].state != JOB_SKIPPED]
+        for name in names:
+            scheduled = self.jobs[name]
+            if "needs" in self.config[name]:
+                # needs that are not in this pipeline are ignored
+                scheduled.needs = [x for x in scheduled.needs if x in active]
+            else:
+                # wait for every job in the earlier stages
+                stage = stages.index(scheduled.stage)
+                scheduled.needs = [x for x in active if stages.index(self.jobs[x].stage) < stage]
+        self.sort(names)
+        self.prefix_output()
+
+    def can_start(self, scheduled: ScheduledJob) -> Optional[bool]:
+        states = [self.jobs[x].state for x in scheduled.needs]
+        if any(x in [JOB_PENDING, JOB_RUNNING] for x in states):
+            return None
+        blocked = any(x in BLOCKING_STATES for x in states)
+        when = scheduled.job.when
+        if when == "always":
+            return True
+        if when == "on_failure":
+            if blocked:
+                return True
+            scheduled.state = JOB_SKIPPED
+            return False
+        # on_success and delayed
+        if blocked:
+            scheduled.state = JOB_NOT_RUN
+            return False
+        return True
+
+    @property
+    def stopping(self) -> bool:
+        # the when rules of each job decide what runs after a failure
+        return False
+
+
+class ParallelExecutor(DagExecutor):
+    """
+    Run every index of a parallel job at the same time
+    """
+
+    def __init__(self,
+                 config: Dict[str, Any],
+                 jobname: str,
+                 runjob: Callable[[Job], None],
+                 total: int,
+                 max_jobs: Optional[int] = None,
+                 jobfactory: Optional[JobFactory] = None,
+                 overrides: Optional[Dict[str, Any]] = None,
+                 options: Optional[Dict[str, Any]] = None,
+                 stdout: Optional[TextIO] = None,
+                 ):
+        """
+        :param config: the loaded pipeline config
+        :param jobname: the parallel job
+        :param runjob: called to run each job, should raise an exception or exit if the job fails
+        :param total: the number of parallel jobs (CI_NODE_TOTAL)
+        :param max_jobs: the most jobs to run at once, defaults to total
+        :param jobfactory:
+        :param overrides: set in the top level of the job dictionary of each job
+        :param options: attributes to set on each job
+        :param stdout: if more than one job can run at once, write prefixed job output here
+        """
+        super().__init__(config, jobname, runjob,
+                         max_jobs=max_jobs or total,
+                         keep_going=True,
+                         jobfactory=jobfactory,
+                         overrides=overrides,
+                         options=options,
+                         stdout=stdout)
+        self.total = total
+
+    def load(self) -> None:
+        """Load a copy of the job for each index"""
+        for index in range(1, self.total + 1):
+            config = dict(self.config)
+            config[".gitlabemu-parallel-index"] = index
+            config[".gitlabemu-parallel-total"] = self.total
+            job = load_job(config, self.jobname, overrides=self.overrides, jobfactory=self.jobfactory)
+            self.apply_options(job)
+            scheduled = ScheduledJob(job)
+            scheduled.name = f"{self.jobname} {index}/{self.total}"
+            scheduled.needs = []
+            self.jobs[scheduled.name] = scheduled
+        self.sort(list(self.jobs))
+        self.prefix_output()
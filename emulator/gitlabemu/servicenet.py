@@ -0,0 +1,123 @@
+"""
+Give the services of each job their own docker network and remove it once nothing is using it
+"""
+import ipaddress
+import os
+import random
+import threading
+import time
+from typing import List, Optional
+
+from .errors import GitlabEmulatorError
+from .logmsg import info, debug, warning
+from .resnamer import generate_resource_name, is_gle_resource, resource_owner_alive
+
+SUBNET_POOL_ENV = "GLE_SERVICE_SUBNET_POOL"
+SERVICE_SUBNET_PREFIX = 26
+# the network used by older versions of gle
+LEGACY_SERVICE_NETWORK = "gle-service-network"
+NETWORK_REMOVE_TIMEOUT = 30
+
+
+def subnet_candidates(pool: str) -> List[str]:
+    """
+    Split a subnet pool into subnets for service networks, starting at a random place so that
+    concurrent gle processes usually try different subnets first
+    :param pool: a CIDR network, eg 192.168.94.0/23
+    :return:
+    """
+    try:
+        network = ipaddress.ip_network(pool, strict=False)
+    except ValueError as err:
+        raise GitlabEmulatorError(f"{SUBNET_POOL_ENV} is not a valid subnet: {err}")
+    if network.prefixlen >= SERVICE_SUBNET_PREFIX:
+        return [str(network)]
+    subnets = [str(x) for x in network.subnets(new_prefix=SERVICE_SUBNET_PREFIX)]
+    start = random.randrange(len(subnets))
+    return subnets[start:] + subnets[:start]
+
+
+class ServiceNetwork:
+    """A docker network that is removed when the last container using it has gone"""
+
+    def __init__(self, tool, name: str):
+        """
+        :param tool: the DockerTool
+        :param name: the network name
+        """
+        self.tool = tool
+        self.name = name
+        self.subnet: Optional[str] = None
+        self.refs = 0
+        self.lock = threading.Lock()
+
+    def create(self) -> None:
+        """Create the network, using a free subnet from GLE_SERVICE_SUBNET_POOL if set or else one docker picks"""
+        from .docker import DockerToolFailed
+        pool = os.getenv(SUBNET_POOL_ENV, "")
+        if not pool:
+            self.tool.create_network(self.name, None)
+            return
+        for subnet in subnet_candidates(pool):
+            try:
+                self.tool.create_network(self.name, subnet)
+                self.subnet = subnet
+                return
+            except DockerToolFailed as err:
+                if "overlap" not in str(err.stderr):
+                    raise
+                debug(f"subnet {subnet} is in use")
+        raise GitlabEmulatorError(f"no free subnets left in {SUBNET_POOL_ENV}={pool}")
+
+    def acquire(self) -> None:
+        with self.lock:
+            self.refs += 1
+
+    def release(self) -> None:
+        """Stop using the network, the last user removes it"""
+        with self.lock:
+            self.refs -= 1
+            if self.refs > 0:
+                return
+        self.remove()
+
+    def remove(self) -> None:
+        """Remove the network, waiting for containers that are still being removed to leave it"""
+        from .docker import DockerToolFailed
+        deadline = time.monotonic() + NETWORK_REMOVE_TIMEOUT
+        while True:
+            try:
+                self.tool.remove_network(self.name)
+                info(f"removed service network {self.name}")
+                return
+            except DockerToolFailed as err:
+                if time.monotonic() > deadline:
+                    warning(f"could not remove service network {self.name}: {err.stderr}")
+                    return
+            time.sleep(0.5)
+
+
+def create_service_network(tool) -> ServiceNetwork:
+    """
+    Create a new service network for a job
+    :param tool: the DockerTool
+    :return: the network, with one reference held by the caller
+    """
+    network = ServiceNetwork(tool, generate_resource_name("network"))
+    network.create()
+    network.acquire()
+    info(f"created service network {network.name}")
+    return network
+
+
+def remove_leftover_networks(tool) -> None:
+    """Remove service networks left behind by gle processes that have exited"""
+    from .docker import DockerToolFailed
+    for name in tool.networks:
+        if name == LEGACY_SERVICE_NETWORK or (is_gle_resource(name) is not None and not resource_owner_alive(name)):
+            info(f"Removing leftover docker network: {name}")
+            try:
+                tool.remove_network(name)
+            except DockerToolFailed as err:
+                # it is still in use
+                debug(f"could not remove {name}: {err.stderr}")
@@ -0,0 +1,178 @@
+"""
+Wait for docker service containers to be ready before a job script starts
+"""
+import re
+import socket
+import time
+from typing import Dict, Optional, Any, Set
+
+from .errors import GitlabEmulatorError
+from .helpers import is_linux
+from .logmsg import debug
+
+SERVICE_READY_VAR = "GLE_SERVICE_READY"
+SERVICE_TIMEOUT_VAR = "GLE_SERVICE_TIMEOUT"
+DEFAULT_SERVICE_TIMEOUT = 30
+SERVICE_POLL_INTERVAL = 0.25
+
+PROBE_NONE = "none"
+PROBE_TCP = "tcp"
+PROBE_HEALTH = "health"
+PROBE_LOG = "log"
+PROBE_KINDS = [PROBE_NONE, PROBE_TCP, PROBE_HEALTH, PROBE_LOG]
+# read the socket tables of the service's network namespace from inside it
+SOCKET_TABLE_COMMAND = ["sh", "-c", "cat /proc/net/tcp /proc/net/tcp6 2>/dev/null; exit 0"]
+TCP_LISTEN_STATE = "0A"
+
+
+class ReadinessProbe:
+    """How to tell that a service has started"""
+
+    def __init__(self, kind: str = PROBE_HEALTH, arg: Optional[str] = None, timeout: float = DEFAULT_SERVICE_TIMEOUT):
+        self.kind = kind
+        self.arg = arg
+        self.timeout = timeout
+        self.pattern = re.compile(arg) if kind == PROBE_LOG else None
+
+    def __str__(self):
+        if self.arg:
+            return f"{self.kind}:{self.arg}"
+        return self.kind
+
+
+def parse_readiness(variables: Dict[str, Any]) -> ReadinessProbe:
+    """
+    Get the readiness probe from a service's variables. GLE_SERVICE_READY can be "tcp:PORT", "health",
+    "log:REGEX" or "none" and GLE_SERVICE_TIMEOUT is the number of seconds to wait. If not set, wait for
+    the container healthcheck if the image has one.
+    :param variables: the service variables
+    :return:
+    """
+    spec = str(variables.get(SERVICE_READY_VAR, PROBE_HEALTH) or PROBE_HEALTH)
+    kind, _, arg = spec.partition(":")
+    if kind not in PROBE_KINDS:
+        raise GitlabEmulatorError(f"{SERVICE_READY_VAR} must start with one of {PROBE_KINDS}, not '{spec}'")
+    if kind in [PROBE_TCP, PROBE_LOG] and not arg:
+        raise GitlabEmulatorError(f"{SERVICE_READY_VAR}={spec} needs a value after the ':'")
+    if kind == PROBE_TCP and not arg.isdigit():
+        raise GitlabEmulatorError(f"{SERVICE_READY_VAR}={spec} needs a port number")
+    try:
+        timeout = float(variables.get(SERVICE_TIMEOUT_VAR, DEFAULT_SERVICE_TIMEOUT))
+    except ValueError:
+        raise GitlabEmulatorError(f"{SERVICE_TIMEOUT_VAR} must be a number of seconds")
+    try:
+        return ReadinessProbe(kind, arg or None, timeout)
+    except re.error as err:
+        raise GitlabEmulatorError(f"{SERVICE_READY_VAR}={spec} is not a valid regex: {err}")
+
+
+def container_address(state: Dict[str, Any], network: Optional[str]) -> Optional[str]:
+    """Get the IP address of a container, preferring the one on the given network"""
+    networks = state.get("NetworkSettings", {}).get("Networks", None) or {}
+    if network in networks and networks[network].get("IPAddress"):
+        return networks[network]["IPAddress"]
+    for item in networks.values():
+        if item.get("IPAddress"):
+            return item["IPAddress"]
+    return None
+
+
+def healthy(state: Dict[str, Any]) -> bool:
+    """Return True if a running container's healthcheck passes, images without a healthcheck are always healthy"""
+    health = state.get("State", {}).get("Health", None)
+    return health is None or health.get("Status") == "healthy"
+
+
+def listening_ports(table: str) -> Set[int]:
+    """
+    Get the TCP ports that have a listening socket
+    :param table: the content of /proc/net/tcp and /proc/net/tcp6
+    :return:
+    """
+    ports = set()
+    for line in table.splitlines():
+        fields = line.split()
+        if len(fields) > 3 and fields[0].endswith(":") and fields[3] == TCP_LISTEN_STATE:
+            ports.add(int(fields[1].rsplit(":", 1)[1], 16))
+    return ports
+
+
+def port_listening(tool, container: str, port: int) -> Optional[bool]:
+    """
+    Check from inside a container whether anything in it listens on a TCP port. Unlike connecting from here this
+    works when the container network cannot be reached from the host (eg, docker desktop)
+    :param tool: the DockerTool
+    :param container: the service container
+    :param port: the port number
+    :return: None if the container cannot show its sockets (eg, it has no shell)
+    """
+    try:
+        table = tool.container_exec(container, SOCKET_TABLE_COMMAND)
+    except GitlabEmulatorError as err:
+        debug(f"could not read the sockets of {container}: {err}")
+        return None
+    if "local_address" not in table:
+        return None
+    return port in listening_ports(table)
+
+
+def probe_once(tool, container: str, probe: ReadinessProbe, network: Optional[str]) -> Optional[bool]:
+    """
+    Check a service once
+    :param tool: the DockerTool
+    :param container: the service container
+    :param probe: the readiness check
+    :param network: the service network
+    :return: True if ready, False if not yet ready, None if the service has stopped
+    """
+    try:
+        state = tool.container_inspect(container)
+    except GitlabEmulatorError:
+        # services are removed when they stop
+        return None
+    if not state.get("State", {}).get("Running", True):
+        return None
+    if probe.kind == PROBE_HEALTH:
+        return healthy(state)
+    if probe.kind == PROBE_TCP:
+        listening = port_listening(tool, container, int(probe.arg))
+        if listening is not None:
+            return listening
+        if not is_linux():
+            # the service network is inside a VM that cannot be reached from here, settle for the healthcheck
+            return healthy(state)
+        address = container_address(state, network)
+        if address is None:
+            return False
+        try:
+            with socket.create_connection((address, int(probe.arg)), timeout=1):
+                return True
+        except OSError:
+            return False
+    if probe.kind == PROBE_LOG:
+        return probe.pattern.search(tool.container_logs(container)) is not None
+    return True
+
+
+def wait_until_ready(tool, container: str, probe: ReadinessProbe, network: Optional[str] = None) -> bool:
+    """
+    Wait for a service to be ready
+    :param tool: the DockerTool
+    :param container: the service container
+    :param probe: the readiness check
+    :param network: the service network
+    :return: False if the service did not become ready in time
+    """
+    if probe.kind == PROBE_NONE:
+        return True
+    deadline = time.monotonic() + probe.timeout
+    while True:
+        ready = probe_once(tool, container, probe, network)
+        if ready is None:
+            debug(f"service {container} has stopped")
+            return False
+        if ready:
+            return True
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(SERVICE_POLL_INTERVAL)
@@ -0,0 +1,111 @@
+"""
+Enforce the timeouts of every running job with one timer on the shared event loop
+"""
+import asyncio
+import heapq
+import itertools
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .aiorunner import get_loop
+from .logmsg import info
+
+# deadlines this close together are fired at the same time
+DEADLINE_TOLERANCE = 0.001
+
+
+class TimeoutSupervisor:
+    """
+    Keep the deadlines of running jobs in a heap and arm a single loop timer for the earliest one
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.lock = threading.Lock()
+        self.heap: List[Tuple[float, int]] = []
+        self.watched: Dict[int, Callable[[], None]] = {}
+        self.tokens = itertools.count()
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.timer_when: Optional[float] = None
+
+    def __len__(self):
+        return len(self.watched)
+
+    def watch(self, deadline: float, callback: Callable[[], None]) -> int:
+        """
+        Call a function once a deadline passes
+        :param deadline: a time.monotonic() time
+        :param callback: called in the loop's executor, so it may block
+        :return: a token for unwatch()
+        """
+        token = next(self.tokens)
+        with self.lock:
+            self.watched[token] = callback
+            heapq.heappush(self.heap, (deadline, token))
+        self.loop.call_soon_threadsafe(self.arm)
+        return token
+
+    def unwatch(self, token: int) -> None:
+        """Stop watching a deadline, eg because the job has finished"""
+        with self.lock:
+            self.watched.pop(token, None)
+            if len(self.heap) > 2 * len(self.watched) + 16:
+                # drop the deadlines of jobs that have finished
+                self.heap = [x for x in self.heap if x[1] in self.watched]
+                heapq.heapify(self.heap)
+        self.loop.call_soon_threadsafe(self.arm)
+
+    def arm(self) -> None:
+        """Set the loop timer for the earliest deadline"""
+        with self.lock:
+            while self.heap and self.heap[0][1] not in self.watched:
+                heapq.heappop(self.heap)
+            when = self.heap[0][0] if self.heap else None
+        if self.timer is not None and self.timer_when == when:
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.timer_when = when
+        if when is not None:
+            self.timer = self.loop.call_at(when, self.fire)
+
+    def fire(self) -> None:
+        """Run the callbacks of every deadline that has passed"""
+        self.timer = None
+        self.timer_when = None
+        now = self.loop.time() + DEADLINE_TOLERANCE
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                _, token = heapq.heappop(self.heap)
+                callback = self.watched.pop(token, None)
+                if callback is not None:
+                    due.append(callback)
+        for callback in due:
+            self.loop.run_in_executor(None, run_callback, callback)
+        self.arm()
+
+
+def run_callback(callback: Callable[[], None]) -> None:
+    try:
+        callback()
+    except Exception as err:  # pragma: no cover
+        info(f"timeout supervisor error: {err}")
+
+
+_supervisor: Optional[TimeoutSupervisor] = None
+_supervisor_lock = threading.Lock()
+
+
+def get_supervisor() -> TimeoutSupervisor:
+    """
+    Get the supervisor for the shared event loop
+    :return:
+    """
+    global _supervisor
+    with _supervisor_lock:
+        loop = get_loop()
+        if _supervisor is None or _supervisor.loop is not loop:
+            _supervisor = TimeoutSupervisor(loop)
+        return _supervisor
@@ -108,6 +108,10 @@ def envs():
             if name.startswith(exclude):
                 del os.environ[name]
     envs["GLE_CONFIG"] = os.path.join(temp, "test-config.yaml")
+    # keep job logs, artifacts and caches out of the real cache
+    os.environ["GLE_CACHE_DIR"] = os.path.join(temp, "cache")
+    os.environ["GLE_RUN_DIR"] = os.path.join(temp, "runs")
+    os.environ["GLE_JOB_CACHE_DIR"] = os.path.join(temp, "jobcache")
     yield
     if os.path.exists(temp):
         shutil.rmtree(temp)
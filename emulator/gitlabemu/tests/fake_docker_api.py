@@ -0,0 +1,207 @@
+"""
+A pretend docker engine listening on a unix socket, exec requests run the command on this machine
+"""
+import json
+import os
+import socketserver
+import struct
+import subprocess
+import threading
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler
+from typing import Dict, Any, List
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "FakeDockerServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status: int, body: Any = None, raw: bytes = None):
+        if raw is None:
+            raw = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def not_found(self, what: str):
+        self.reply(404, {"message": f"No such {what}"})
+
+    def read_body(self) -> bytes:
+        size = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(size) if size else b""
+
+    def route(self, method: str):
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        parts = [urllib.parse.unquote(x) for x in url.path.strip("/").split("/")]
+        body = self.read_body()
+        self.server.requests.append((method, url.path, query))
+        state = self.server
+
+        if parts == ["version"]:
+            return self.reply(200, {"Version": "24.0.7", "Os": "linux"})
+        if parts[0] == "images":
+            if parts[-1] == "create":
+                image = f"{query['fromImage']}:{query['tag']}"
+                if image in state.missing:
+                    lines = [{"status": "Pulling"}, {"error": f"pull access denied for {image}"}]
+                else:
+                    state.images[image] = {"Id": "sha256:" + uuid.uuid4().hex, "Os": "linux", "Config": {}}
+                    lines = [{"status": "Pulling"}, {"status": "Done"}]
+                return self.reply(200, raw="\r\n".join(json.dumps(x) for x in lines).encode("utf-8"))
+            image = "/".join(parts[1:-1])
+            if image not in state.images:
+                return self.not_found("image")
+            return self.reply(200, state.images[image])
+        if parts[0] == "containers":
+            if parts[1] == "json":
+                return self.reply(200, [{"Id": x} for x in state.containers])
+            if parts[1] == "create":
+                config = json.loads(body)
+                if config["Image"] not in state.images:
+                    return self.not_found("image")
+                container = uuid.uuid4().hex
+                config["Name"] = "/" + query.get("name", container[:12])
+                state.containers[container] = config
+                return self.reply(201, {"Id": container})
+            container = parts[1]
+            if container not in state.containers:
+                return self.not_found("container")
+            if parts[2] == "json":
+                return self.reply(200, state.containers[container])
+            if parts[2] == "logs":
+                output = state.logs.get(state.containers[container]["Image"], b"")
+                return self.reply(200, raw=struct.pack(">BxxxL", 1, len(output)) + output)
+            if parts[2] in ["start", "kill"]:
+                if parts[2] == "kill":
+                    state.containers.pop(container)
+                return self.reply(204)
+            if parts[2] == "exec":
+                exec_id = uuid.uuid4().hex
+                state.execs[exec_id] = {"Config": json.loads(body), "Running": False, "ExitCode": None}
+                return self.reply(201, {"Id": exec_id})
+        if parts[0] == "exec":
+            exec_id = parts[1]
+            if exec_id not in state.execs:
+                return self.not_found("exec instance")
+            if parts[2] == "json":
+                return self.reply(200, state.execs[exec_id])
+            if parts[2] == "start":
+                return self.hijack(state.execs[exec_id])
+        if parts[0] == "networks":
+            if parts[1] == "create":
+                config = json.loads(body)
+                state.networks[config["Name"]] = config
+                return self.reply(201, {"Id": config["Name"]})
+            network = parts[1]
+            if network not in state.networks:
+                return self.not_found("network")
+            if method == "DELETE":
+                state.networks.pop(network)
+                return self.reply(204)
+            if len(parts) > 2 and parts[2] == "connect":
+                state.networks[network].setdefault("Containers", []).append(json.loads(body))
+                return self.reply(200)
+            return self.reply(200, state.networks[network])
+        return self.reply(404, {"message": f"page not found {self.path}"})
+
+    def hijack(self, exe: Dict[str, Any]):
+        """Take over the connection and stream the exec's stdin and output over it"""
+        config = exe["Config"]
+        env = dict(os.environ)
+        for item in config.get("Env", []) or []:
+            name, value = item.split("=", 1)
+            env[name] = value
+        self.wfile.write(b"HTTP/1.1 101 UPGRADED\r\n"
+                         b"Content-Type: application/vnd.docker.raw-stream\r\n"
+                         b"Connection: Upgrade\r\n"
+                         b"Upgrade: tcp\r\n\r\n")
+        self.wfile.flush()
+        exe["Running"] = True
+        self.server.hijacked += 1
+        proc = subprocess.Popen(config["Cmd"], cwd=config.get("WorkingDir"), env=env,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        lock = threading.Lock()
+
+        def send_input():
+            try:
+                while True:
+                    data = self.rfile.read1(65536)
+                    if not data:
+                        break
+                    proc.stdin.write(data)
+                    proc.stdin.flush()
+            except OSError:
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except OSError:
+                    pass
+
+        def send_output(stream, kind: int):
+            while True:
+                data = stream.read1(65536)
+                if not data:
+                    break
+                with lock:
+                    self.wfile.write(struct.pack(">BxxxL", kind, len(data)) + data)
+                    self.wfile.flush()
+
+        threading.Thread(target=send_input, daemon=True).start()
+        readers = [threading.Thread(target=send_output, args=(proc.stdout, 1)),
+                   threading.Thread(target=send_output, args=(proc.stderr, 2))]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        exe["ExitCode"] = proc.wait()
+        exe["Running"] = False
+        self.close_connection = True
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_PUT(self):
+        self.route("PUT")
+
+    def do_DELETE(self):
+        self.route("DELETE")
+
+
+class FakeDockerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str):
+        super().__init__(path, FakeDockerHandler)
+        self.images: Dict[str, Dict[str, Any]] = {}
+        self.missing: List[str] = []
+        self.containers: Dict[str, Dict[str, Any]] = {}
+        self.execs: Dict[str, Dict[str, Any]] = {}
+        self.networks: Dict[str, Dict[str, Any]] = {}
+        # image -> output of its containers
+        self.logs: Dict[str, bytes] = {}
+        self.requests: List[tuple] = []
+        self.connections = 0
+        self.hijacked = 0
+
+    def get_request(self):
+        self.connections += 1
+        return super().get_request()
+
+    def start(self) -> "FakeDockerServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
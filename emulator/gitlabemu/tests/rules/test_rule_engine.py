@@ -0,0 +1,183 @@
+"""
+Check the native and antlr rule engines against the original rule evaluator
+"""
+import itertools
+import re
+from pathlib import Path
+from typing import Dict, Optional
+
+import pytest
+from antlr4 import InputStream, CommonTokenStream
+from antlr4.Token import CommonToken
+
+from ... import ruleengine, ruleparser
+from ...rules.GitlabRuleLexer import GitlabRuleLexer
+from ...rules.GitlabRuleParser import GitlabRuleParser
+from ...rules.GitlabRuleVisitor import GitlabRuleVisitor
+from ...yamlloader import ordered_load
+
+HERE = Path(__file__).parent
+
+EXPRESSIONS = [
+    '$COLOR == "red"',
+    '"blue" == $COLOR',
+    '$COLOR != ""',
+    '$COLOR',
+    '$DEFINED && $SIZE == "small"',
+    '$DEFINED || $SIZE == "small"',
+    '($SHAPE || $SPEED) && $NAME == "bob"',
+    '$SHAPE || $SPEED && $NAME == "bob"',
+    '$SHAPE && $SPEED || $NAME != "bob" && $COLOR',
+    '(($SHAPE))',
+    '$COLOR =~ /dark/',
+    '$COLOR !~ /dark/',
+    '$COLOR =~ /^(red|blue)$/ || $SIZE !~ /big/',
+    '$COLOR =~ $PATT',
+    '$COLOR !~ $PATT',
+    '/dark/',
+    '/dark/ && $COLOR',
+]
+
+VALUES = [
+    {},
+    {"COLOR": "red", "SIZE": "small", "DEFINED": "1"},
+    {"COLOR": "darkblue", "PATT": "/re/", "NAME": "bob", "SPEED": "1"},
+    {"COLOR": "", "SIZE": "big", "SHAPE": "square", "PATT": "re", "NAME": "dave"},
+    {"INCLUDE": "colors", "COLOR": "blue", "PATT": "/^b/", "DEFINED": ""},
+]
+
+
+class ReferenceVisitor(GitlabRuleVisitor):
+    """The rule evaluator gle used before rules were compiled, kept as a reference for both engines"""
+
+    def __init__(self, variables: Optional[Dict[str, str]] = None):
+        self.variables: Dict[str, str] = {}
+        if variables:
+            self.variables.update(variables)
+
+    def get_variable_name(self, symbol: CommonToken):
+        if symbol.type == GitlabRuleLexer.VARIABLE:
+            name = symbol.text[1:]
+            return name
+        return ""
+
+    def resolve_variable(self, symbol: CommonToken):
+        text = symbol.text
+        name = self.get_variable_name(symbol)
+        if name:
+            return self.variables.get(name, "")
+        # strip quotes
+        if text[0] == '"':
+            return text[1:-1]
+        return text
+
+    def visitRegex(self, ctx: GitlabRuleParser.RegexContext):
+        assert len(ctx.children) == 1
+        return ctx.children[0].symbol.text
+
+    def visitVariable(self, ctx: GitlabRuleParser.VariableContext):
+        """Return True if VARNAME is set to anything except the empty string"""
+        assert len(ctx.children) == 1
+        name = self.get_variable_name(ctx.children[0].symbol)
+        return self.variables.get(name, "") != ""
+
+    def visitCompare(self, ctx: GitlabRuleParser.CompareContext):
+        """Compare strings/variables for equality"""
+        assert len(ctx.children) == 3
+        assert ctx.op.type in [GitlabRuleLexer.EQ, GitlabRuleLexer.NE]
+        left = self.resolve_variable(ctx.children[0].symbol)
+        right = self.resolve_variable(ctx.children[2].symbol)
+
+        if ctx.op.type == GitlabRuleLexer.EQ:
+            return left == right
+        return left != right
+
+    def visitMatch(self, ctx: GitlabRuleParser.MatchContext):
+        assert len(ctx.children) == 3
+        assert ctx.op.type in [GitlabRuleLexer.MATCH, GitlabRuleLexer.NMATCH]
+        left = self.resolve_variable(ctx.children[0].symbol)
+        right = self.resolve_variable(ctx.children[2].symbol)
+        if right.startswith("/") and right.endswith("/"):
+            # is a regex
+            patt = re.compile(right[1:-1])
+            matched = patt.search(left)
+            if ctx.op.type == GitlabRuleLexer.MATCH:
+                return matched is not None
+            return matched is None
+        return False
+
+    def visitBoolAnd(self, ctx: GitlabRuleParser.BoolAndContext):
+        left = self.visit(ctx.expr(0))
+        right = self.visit(ctx.expr(1))
+        return left and right
+
+    def visitBoolOr(self, ctx: GitlabRuleParser.BoolOrContext):
+        left = self.visit(ctx.expr(0))
+        right = self.visit(ctx.expr(1))
+        return left or right
+
+    def visitParens(self, ctx: GitlabRuleParser.ParensContext):
+        return self.visit(ctx.expr())
+
+
+
+def reference_result(rule: str, variables: Dict[str, str]):
+    parser = GitlabRuleParser(CommonTokenStream(GitlabRuleLexer(InputStream(rule))))
+    return ReferenceVisitor(variables).visit(parser.expr())
+
+
+def corpus_rules():
+    """Get all the rule expressions used in the pipelines in this folder and the expressions above"""
+    found = list(EXPRESSIONS)
+    for filename in sorted(HERE.rglob("*.yml")):
+        with open(filename, "r") as fd:
+            loaded = ordered_load(fd) or {}
+        for value in loaded.values():
+            items = value if isinstance(value, list) else [value]
+            for item in items:
+                if isinstance(item, dict):
+                    for rule in item.get("rules", []):
+                        if "if" in rule:
+                            found.append(rule["if"])
+    return found
+
+
+def test_corpus_found():
+    rules = corpus_rules()
+    assert '$INCLUDE =~ /colors/' in rules
+    assert '$COLOR == "red"' in rules
+
+
+@pytest.mark.parametrize("rule,variables", list(itertools.product(corpus_rules(), VALUES)))
+def test_engines_match_reference(rule: str, variables: dict):
+    expected = reference_result(rule, variables)
+    native = ruleengine.RuleParser(rule).parse()
+    assert native(variables) == expected
+    assert ruleparser.evaluate_rule(rule, variables) == expected
+
+
+@pytest.mark.parametrize("rule", [
+    '$COLOR ==',
+    '"red" == "red"',
+    '$COLOR == "red" &&',
+    '($COLOR',
+    '$COLOR = "red"',
+    '$COLOR == "red',
+    '$COLOR =~ /red',
+])
+def test_native_syntax_errors(rule: str):
+    with pytest.raises(ruleengine.RuleSyntaxError):
+        ruleengine.RuleParser(rule).parse()
+    # we fall back to the antlr engine for the same result as before
+    assert ruleengine.evaluate_rule(rule, {"COLOR": "red"}) == ruleparser.evaluate_rule(rule, {"COLOR": "red"})
+
+
+def test_select_engine(monkeypatch):
+    assert ruleengine.get_rule_engine() == ruleengine.RULE_ENGINE_NATIVE
+    monkeypatch.setenv(ruleengine.RULE_ENGINE_ENV, ruleengine.RULE_ENGINE_ANTLR)
+    assert ruleengine.get_rule_engine() == ruleengine.RULE_ENGINE_ANTLR
+    assert ruleengine.compile_rule("$COLOR") is ruleparser.compile_rule("$COLOR")
+    assert ruleengine.evaluate_rule('$COLOR == "red"', {"COLOR": "red"}) is True
+    monkeypatch.setenv(ruleengine.RULE_ENGINE_ENV, "bison")
+    with pytest.raises(ruleengine.GitlabEmulatorError):
+        ruleengine.evaluate_rule("$COLOR", {})
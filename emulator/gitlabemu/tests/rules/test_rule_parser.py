@@ -137,3 +137,19 @@ def test_regex():
             "PATT": "/re/"
         })
     assert result is True
+
+
+def test_compiled_rule_cache():
+    parser.compile_rule.cache_clear()
+    rule = '$COLOR =~ /dark/ && $SIZE != "small"'
+    compiled = parser.compile_rule(rule)
+    assert parser.compile_rule(rule) is compiled
+    assert compiled({"COLOR": "darkred", "SIZE": "big"})
+    assert not compiled({"COLOR": "red", "SIZE": "big"})
+    assert not compiled({"COLOR": "darkred", "SIZE": "small"})
+
+    for _ in range(10):
+        parser.evaluate_rule(rule, {})
+    info = parser.compile_rule.cache_info()
+    assert info.misses == 1
+    assert info.hits == 11
@@ -0,0 +1,168 @@
+"""
+Test running job processes on the shared event loop
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from pathlib import Path
+
+import pytest
+
+from .. import aiorunner
+from ..aiorunner import AsyncProcess, popen, stop_process
+from ..helpers import communicate
+from ..jobs import Job
+
+
+def running(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            # killed orphans stay as zombies if nothing reaps them
+            return stat.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def loop_threads() -> list:
+    return [x for x in threading.enumerate() if x.name == "gle-asyncio"]
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_popen_communicate():
+    proc = popen(["/bin/sh", "-"], stdin=subprocess.PIPE)
+    assert isinstance(proc, AsyncProcess)
+    script = "".join(f"echo line {i}\n" for i in range(1000)) + "exit 3\n"
+    output = StringIO()
+    lines = []
+    communicate(proc, stdout=output, script=script.encode(), linehandler=lines.append)
+    expected = "".join(f"line {i}\n" for i in range(1000))
+    assert output.getvalue() == expected
+    assert b"".join(lines) == expected.encode()
+    assert proc.returncode == 3
+    assert proc.poll() == 3
+
+    proc = popen([sys.executable, "-c", "import sys; sys.exit(1)"])
+    with pytest.raises(subprocess.CalledProcessError):
+        communicate(proc, stdout=StringIO(), throw=True)
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_concurrent_jobs_share_a_loop(tmp_path: Path):
+    def run(index: int) -> str:
+        output = StringIO()
+        proc = popen(["/bin/sh", "-c", f"sleep 0.2; echo job {index}"])
+        communicate(proc, stdout=output)
+        return output.getvalue()
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=20) as pool:
+        results = list(pool.map(run, range(20)))
+    assert results == [f"job {i}\n" for i in range(20)]
+    assert time.monotonic() - started < 5
+    assert len(loop_threads()) == 1
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_stop_escalates():
+    proc = popen([sys.executable, "-c",
+                  "import signal, time\n"
+                  "signal.signal(signal.SIGTERM, signal.SIG_IGN)\n"
+                  "print('ready', flush=True)\n"
+                  "time.sleep(60)\n"])
+    assert aiorunner.run_coroutine(proc.stdout.readline()) == b"ready\n"
+    started = time.monotonic()
+    stop_process(proc, grace=0.2)
+    assert proc.returncode == -9
+    assert time.monotonic() - started < 5
+
+    with pytest.raises(subprocess.TimeoutExpired):
+        popen(["sleep", "5"]).wait(timeout=0.1)
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_process_group_keeps_session():
+    # a new group but the same session, so the job keeps our controlling terminal
+    proc = popen(["sleep", "60"], new_group=True)
+    try:
+        assert os.getpgid(proc.pid) == proc.pid
+        assert os.getsid(proc.pid) == os.getsid(0)
+    finally:
+        stop_process(proc, grace=1)
+
+
+@pytest.mark.usefixtures("linux_only")
+def test_stop_process_group(tmp_path: Path):
+    # the shell exits on SIGTERM, its child does not and still holds the output pipe
+    child = tmp_path / "child.pid"
+    proc = popen(["/bin/sh", "-c",
+                  f"sh -c 'trap \"\" TERM; echo $$ > {child}; sleep 60' & wait"], new_group=True)
+    while not child.exists() or not child.read_text().strip():
+        time.sleep(0.05)
+    output = StringIO()
+    started = time.monotonic()
+    stop_process(proc, grace=0.5)
+    communicate(proc, stdout=output)
+    assert time.monotonic() - started < 5
+    assert not running(int(child.read_text()))
+
+    # without a group of its own, only the process is signalled
+    proc = subprocess.Popen(["sleep", "60"])
+    stop_process(proc, grace=1)
+    assert proc.returncode == -15
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_job_timeout(tmp_path: Path):
+    job = Job()
+    job.name = "sleepy"
+    job.workspace = str(tmp_path)
+    job.timeout_seconds = 0.5
+    job.script = ["exec sleep 30"]
+    started = time.monotonic()
+    with pytest.raises(SystemExit):
+        job.run()
+    assert job.timed_out
+    assert isinstance(job.build_process, AsyncProcess)
+    assert time.monotonic() - started < 10
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_async_runner_disabled(tmp_path: Path, monkeypatch):
+    monkeypatch.setenv(aiorunner.ASYNC_RUNNER_ENV, "no")
+    job = Job()
+    job.name = "threads"
+    job.workspace = str(tmp_path)
+    job.script = ["true"]
+    job.run()
+    assert isinstance(job.build_process, subprocess.Popen)
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_thread_runner_timeout(tmp_path: Path, monkeypatch):
+    # as on python 3.6, which has no get_running_loop, timeouts still stop the job
+    monkeypatch.setattr(aiorunner, "ASYNC_RUNNER_MIN_PYTHON", (99, 0))
+    monkeypatch.delattr(asyncio, "get_running_loop")
+    job = Job()
+    job.name = "sleepy"
+    job.workspace = str(tmp_path)
+    job.timeout_seconds = 0.5
+    job.script = ["exec sleep 30"]
+    started = time.monotonic()
+    with pytest.raises(SystemExit):
+        job.run()
+    assert job.timed_out
+    assert isinstance(job.build_process, subprocess.Popen)
+    assert time.monotonic() - started < 10
+
+
+def test_async_runner_old_python(monkeypatch):
+    assert aiorunner.async_runner_enabled()
+    monkeypatch.setattr(aiorunner, "ASYNC_RUNNER_MIN_PYTHON", (99, 0))
+    assert not aiorunner.async_runner_enabled()
+    monkeypatch.setenv(aiorunner.ASYNC_RUNNER_ENV, "yes")
+    assert not aiorunner.async_runner_enabled()
@@ -0,0 +1,84 @@
+"""
+Test the persistent pipeline cache
+"""
+from pathlib import Path
+
+import pytest
+
+from .. import configloader
+from ..configcache import PipelineCache
+
+
+PIPELINE = """
+include:
+  - local: included.yml
+    rules:
+      - if: $WITH_EXTRA
+variables:
+  COLOR: red
+job1:
+  script:
+    - echo $COLOR
+"""
+
+INCLUDED = """
+job2:
+  script:
+    - echo job2
+"""
+
+
+def make_pipeline(folder: Path) -> Path:
+    (folder / "included.yml").write_text(INCLUDED)
+    pipeline = folder / ".gitlab-ci.yml"
+    pipeline.write_text(PIPELINE)
+    return pipeline
+
+
+def visible_jobs(loader: configloader.Loader) -> list:
+    return [x for x in loader.get_jobs() if not x.startswith(".")]
+
+
+def cached_loader(cache: PipelineCache, **variables) -> configloader.Loader:
+    loader = configloader.Loader(use_cache=True)
+    loader.cache = cache
+    for name, value in variables.items():
+        loader.add_variable(name, value)
+    return loader
+
+
+def test_cache_warm_load(temp_folder: Path, monkeypatch):
+    pipeline = make_pipeline(temp_folder)
+    cache = PipelineCache(str(temp_folder / "cache"))
+    loader = cached_loader(cache, WITH_EXTRA="1")
+    loader.load(str(pipeline))
+    assert visible_jobs(loader) == ["job1", "job2"]
+
+    def no_read(*args, **kwargs):
+        raise AssertionError("pipeline should have been loaded from cache")
+
+    monkeypatch.setattr(configloader, "read", no_read)
+    warm = cached_loader(cache, WITH_EXTRA="1")
+    warm.load(str(pipeline))
+    assert visible_jobs(warm) == ["job1", "job2"]
+    assert warm.included_files == loader.included_files
+    assert warm.get_job_filename("job2") == "included.yml"
+    assert warm.variables["WITH_EXTRA"] == "1"
+
+    # different include rule variables must not use the same entry
+    with pytest.raises(AssertionError):
+        cached_loader(cache).load(str(pipeline))
+
+
+def test_cache_invalidated_by_include(temp_folder: Path):
+    pipeline = make_pipeline(temp_folder)
+    cache = PipelineCache(str(temp_folder / "cache"))
+    cached_loader(cache, WITH_EXTRA="1").load(str(pipeline))
+
+    (temp_folder / "included.yml").write_text(INCLUDED.replace("job2", "job3"))
+    loader = cached_loader(cache, WITH_EXTRA="1")
+    loader.load(str(pipeline))
+    assert visible_jobs(loader) == ["job1", "job3"]
+
+    cache.clear()
+    assert cache.get(str(pipeline), {}) is None
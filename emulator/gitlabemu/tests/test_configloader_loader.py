@@ -117,3 +117,64 @@ def test_load_builtin_stages():
     assert job2["stage"] == "test"
     job3 = loader.get_job("job3")
     assert job3["stage"] == ".post"
+
+
+LAZY_PIPELINE = """
+variables:
+  COLOR: red
+.template:
+  image: alpine:3.14
+  before_script:
+    - echo before
+build:
+  extends: .template
+  script:
+    - echo build
+test:
+  extends: .template
+  needs: [build]
+  script: !reference [build, script]
+broken:
+  extends: .missing
+  script:
+    - echo broken
+"""
+
+
+def test_load_lazy(temp_folder):
+    cfg_file = temp_folder / ".gitlab-ci.yml"
+    cfg_file.write_text(LAZY_PIPELINE)
+    loader = configloader.Loader(lazy=True)
+    loader.load(str(cfg_file))
+    assert {".template", "broken", "build", "test"}.issubset(loader.get_jobs())
+    # nothing is resolved until asked for
+    assert "extends" in loader.config["test"]
+
+    job = loader.load_job("test")
+    assert job.docker_image == "alpine:3.14"
+    assert job.before_script == ["echo before"]
+    assert job.script == ["echo build"]
+    assert job.dependencies == ["build"]
+    # the needed job is resolved with it, unrelated jobs are not
+    assert "extends" not in loader.config["build"]
+    assert loader.config["build"]["variables"] == {"COLOR": "red"}
+    assert "extends" in loader.config["broken"]
+
+    with pytest.raises(BadSyntaxError) as err:
+        loader.get_job("broken")
+    assert "extends '.missing' which does not exist" in str(err.value)
+
+    eager = configloader.Loader()
+    with pytest.raises(BadSyntaxError):
+        eager.load(str(cfg_file))
+
+
+def test_load_lazy_resolve_all(temp_folder):
+    cfg_file = temp_folder / ".gitlab-ci.yml"
+    cfg_file.write_text(LAZY_PIPELINE.split("broken:")[0])
+    eager = configloader.Loader()
+    eager.load(str(cfg_file))
+    loader = configloader.Loader(lazy=True)
+    loader.load(str(cfg_file))
+    loader.resolve_all()
+    assert loader.config == eager.config
@@ -0,0 +1,133 @@
+"""
+Test the pool of re-usable job containers
+"""
+import subprocess
+import time
+
+import pytest
+
+from .. import containerpool
+from ..docker import DockerJob
+
+
+@pytest.fixture(scope="function")
+def killed(mocker):
+    found = []
+
+    def fake_call(cmdline, **kwargs):
+        assert cmdline[1] == "kill"
+        found.append(cmdline[2])
+        return 0
+
+    def fake_check_output(cmdline, **kwargs):
+        if cmdline[1] == "diff":
+            return "C /tmp\nA /tmp/build.log\nC /etc\nA /etc/gitconfig\n"
+        return "true\n"
+
+    mocker.patch("subprocess.call", side_effect=fake_call)
+    mocker.patch("subprocess.check_call", return_value=0)
+    mocker.patch("subprocess.check_output", side_effect=fake_check_output)
+    return found
+
+
+def make_pooled(image: str = "alpine:3.14", name: str = "c1") -> containerpool.PooledContainer:
+    key = containerpool.pool_key("docker", image, None, ["/a:/a:rw"], True)
+    return containerpool.PooledContainer(key, name, name)
+
+
+def test_pool_reuse(killed):
+    pool = containerpool.ContainerPool(2, ttl=60)
+    first = make_pooled()
+    assert pool.acquire(first.key) is None
+    pool.release(first)
+    assert pool.acquire(make_pooled("debian").key) is None
+    assert pool.acquire(first.key) is first
+    assert pool.acquire(first.key) is None
+    assert not killed
+
+
+def test_changed_paths():
+    assert containerpool.changed_paths("") == []
+    assert containerpool.changed_paths("C /tmp\nA /tmp/x\nD /var/tmp/y\nC /etc\nA /etc/gitconfig\n") == []
+    assert containerpool.changed_paths("C /etc\nC /etc/passwd\nC /usr\nC /usr/bin\nA /usr/bin/curl\n") == [
+        "/etc/passwd", "/usr/bin/curl"]
+    assert containerpool.changed_paths("C /etc\nD /etc/motd\n") == ["/etc/motd"]
+
+
+def test_pool_reset(killed, mocker):
+    pool = containerpool.ContainerPool(2, ttl=60)
+    check_call = subprocess.check_call
+    first = make_pooled()
+    pool.release(first)
+    assert check_call.call_args[0][0] == ["docker", "exec", "-u", "0", "c1", "sh", "-c",
+                                          containerpool.RESET_SCRIPT]
+    assert pool.idle == [first]
+
+    # a job that installed something does not give back its container
+    mocker.patch("subprocess.check_output", return_value="C /usr\nA /usr/bin/curl\n")
+    second = make_pooled(name="c2")
+    pool.release(second)
+    assert killed == ["c2"]
+    assert pool.idle == [first]
+
+    mocker.patch("subprocess.check_call", side_effect=subprocess.CalledProcessError(126, ["docker"]))
+    pool.release(make_pooled(name="c3"))
+    assert killed == ["c2", "c3"]
+    assert pool.idle == [first]
+
+
+def test_pool_stopped(killed, mocker):
+    pool = containerpool.ContainerPool(2, ttl=60)
+    first = make_pooled()
+    pool.release(first)
+    mocker.patch("subprocess.check_output", side_effect=subprocess.CalledProcessError(1, ["docker"]))
+    assert pool.acquire(first.key) is None
+    assert not pool.idle
+
+
+def test_pool_evict(killed, mocker):
+    pool = containerpool.ContainerPool(2, ttl=60)
+    for name in ["c1", "c2", "c3"]:
+        pool.release(make_pooled(name=name))
+    # the oldest container does not fit
+    assert killed == ["c1"]
+    assert [x.name for x in pool.idle] == ["c2", "c3"]
+
+    mocker.patch("time.monotonic", return_value=time.monotonic() + 61)
+    assert pool.acquire(make_pooled().key) is None
+    assert killed == ["c1", "c2", "c3"]
+
+    pool.release(make_pooled(name="c4"))
+    pool.close()
+    assert killed[-1] == "c4"
+
+
+def test_pool_enabled(monkeypatch, killed):
+    containerpool.close_container_pool()
+    assert containerpool.get_container_pool() is None
+    monkeypatch.setenv(containerpool.POOL_SIZE_ENV, "3")
+    monkeypatch.setenv(containerpool.POOL_TTL_ENV, "5")
+    pool = containerpool.get_container_pool()
+    try:
+        assert pool.size == 3
+        assert pool.ttl == 5
+        assert containerpool.get_container_pool() is pool
+    finally:
+        containerpool.close_container_pool()
+
+
+@pytest.mark.parametrize("returncode", [0, 1])
+def test_job_returns_container(killed, returncode: int):
+    pool = containerpool.ContainerPool(2, ttl=60)
+    job = DockerJob()
+    job.container = "c1"
+    job._pooled = make_pooled()
+    job.build_process = subprocess.CompletedProcess([], returncode)
+    job.stop_container(pool)
+    if returncode:
+        # failed jobs do not give back their container
+        assert killed == ["c1"]
+        assert not pool.idle
+    else:
+        assert not killed
+        assert pool.idle == [job._pooled]
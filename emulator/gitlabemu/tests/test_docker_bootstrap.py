@@ -0,0 +1,165 @@
+"""
+Test how scripts and settings are passed to job containers
+"""
+import json
+import os
+import stat
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from ..docker import DockerJob, BOOTSTRAP_HAS_BASH, BOOTSTRAP_USER_FAILED
+from ..jobs import make_script
+
+# a docker cli that runs "exec" commands on this machine
+FAKE_DOCKER = """
+import json, os, subprocess, sys
+args = sys.argv[1:]
+with open(os.environ["FAKE_DOCKER_LOG"], "a") as log:
+    log.write(json.dumps(args) + "\\n")
+if args[0] != "exec":
+    sys.exit(1)
+args.pop(0)
+env = dict(os.environ)
+cwd = None
+while args[0].startswith("-"):
+    opt = args.pop(0)
+    if opt in ["-i", "-t"]:
+        continue
+    value = args.pop(0)
+    if opt == "-w":
+        cwd = value
+    elif opt == "-e":
+        name, value = value.split("=", 1)
+        env[name] = value
+    elif opt == "--env-file":
+        with open(value) as envfile:
+            for line in envfile.read().splitlines():
+                name, value = line.split("=", 1)
+                env[name] = value
+args.pop(0)  # the container
+sys.exit(subprocess.call(args, cwd=cwd, env=env))
+"""
+
+
+@pytest.fixture(scope="function")
+def fake_docker(temp_folder: Path, monkeypatch) -> Path:
+    tool = temp_folder / "docker"
+    tool.write_text(f"#!{sys.executable}\n{FAKE_DOCKER}")
+    tool.chmod(tool.stat().st_mode | stat.S_IEXEC)
+    log = temp_folder / "docker.log"
+    monkeypatch.setenv("FAKE_DOCKER_LOG", str(log))
+    return tool
+
+
+def calls(fake_docker: Path) -> list:
+    log = fake_docker.parent / "docker.log"
+    if not log.exists():
+        return []
+    return [json.loads(line) for line in log.read_text().splitlines()]
+
+
+def make_job(fake_docker: Path) -> DockerJob:
+    job = DockerJob()
+    job.name = "bootstrap"
+    job.workspace = str(fake_docker.parent)
+    job.docker.tool = str(fake_docker)
+    job.docker.container = "c1"
+    job._has_bash = False
+    return job
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_script_over_stdin(fake_docker, capfd):
+    job = make_job(fake_docker)
+    job.docker.add_env("GREETING", "hello world")
+    job.docker.add_env("MULTI", "one\ntwo")
+    task = job._run_script(make_script(["echo \"$GREETING\"", "echo \"$MULTI\"", "pwd"]))
+    assert task.returncode == 0
+    stdout, _ = capfd.readouterr()
+    assert "hello world\none\ntwo\n" in stdout
+    assert str(fake_docker.parent) in stdout
+
+    # one docker exec, with an env file for simple values
+    found = calls(fake_docker)
+    assert len(found) == 1
+    assert found[0][0] == "exec"
+    assert "--env-file" in found[0]
+    assert "GREETING=hello world" not in found[0]
+    assert "MULTI=one\ntwo" in found[0]
+    # the saved script is removed
+    assert not [x for x in os.listdir("/tmp") if x.startswith("gle-script-")]
+
+    env_file = found[0][found[0].index("--env-file") + 1]
+    assert os.path.exists(env_file)
+    job.docker.cleanup()
+    assert not os.path.exists(env_file)
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_script_failure(fake_docker, capfd):
+    job = make_job(fake_docker)
+    task = job._run_script(make_script(["echo one", "false", "echo two"]))
+    assert task.returncode != 0
+    stdout, _ = capfd.readouterr()
+    assert "one" in stdout
+    assert "two" not in stdout
+
+
+def test_bootstrap_script(mocker):
+    job = DockerJob()
+    job.workspace = "/builds/my project"
+    job._shell_is_user = True
+    job._shell_uid = 1001
+    job._shell_gid = 1002
+    mocker.patch.object(job.docker, "get_user", return_value="app:staff")
+    script = job.bootstrap_script()
+    assert "chown -R app.staff ." in script
+    assert "git config --system --add safe.directory '/builds/my project'" in script
+    assert "1001:1002" in script
+    assert "mkdir /gle-tmp-home && chown 1001 /gle-tmp-home" in script
+    assert script.endswith("exit 0")
+
+
+def test_prepare_container(mocker):
+    job = DockerJob()
+    job.workspace = "/builds/project"
+    job._shell_is_user = True
+    mocker.patch.object(job.docker, "get_user", return_value=None)
+    check_call = mocker.patch.object(job.docker, "check_call",
+                                     return_value=f"{BOOTSTRAP_HAS_BASH}\n{BOOTSTRAP_USER_FAILED}\n".encode())
+    warning = mocker.patch("gitlabemu.docker.warning")
+    job.prepare_container()
+    # all the setup is done in one exec as root
+    assert check_call.call_count == 1
+    assert check_call.call_args.kwargs["user"] == "0"
+    assert job.has_bash()
+    warning.assert_called_once()
+
+    check_call.side_effect = subprocess.CalledProcessError(1, ["docker"])
+    job.prepare_container()
+    assert not job.has_bash()
+
+
+def test_env_file_removed_when_start_fails(mocker, tmp_path: Path):
+    job = DockerJob()
+    job.name = "broken"
+    job.workspace = str(tmp_path)
+    job._runner = mocker.Mock()
+    job._runner.docker.runtime_volumes.return_value = []
+    job._image = "alpine:3.18"
+    written = []
+
+    def fail_start(pool):
+        written.extend(job.docker.get_envs())
+        raise subprocess.CalledProcessError(125, ["docker", "run"])
+
+    mocker.patch.object(job, "start_container", side_effect=fail_start)
+    job.variables["SECRET"] = "hunter2"
+    with pytest.raises(subprocess.CalledProcessError):
+        job.run_impl()
+    # the job variables are not left in the temp folder
+    env_file = written[written.index("--env-file") + 1]
+    assert not os.path.exists(env_file)
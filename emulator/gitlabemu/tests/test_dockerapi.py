@@ -0,0 +1,238 @@
+"""
+Test the docker engine API backend against a fake engine
+"""
+import http.client
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from pathlib import Path
+
+import pytest
+
+from .. import dockerapi, imagecache
+from ..docker import DockerJob, DockerTool, DockerToolFailed, docker_services, wait_for_service_teardown
+from ..errors import GitlabEmulatorError
+from ..jobs import make_script
+from .fake_docker_api import FakeDockerServer
+
+
+@pytest.fixture(scope="function")
+def fake_engine(monkeypatch):
+    # unix socket paths must be short
+    folder = tempfile.mkdtemp(prefix="gle-api-")
+    path = str(Path(folder) / "docker.sock")
+    server = FakeDockerServer(path).start()
+    monkeypatch.setenv("DOCKER_HOST", f"unix://{path}")
+    monkeypatch.setenv("GLE_CACHE_DIR", folder)
+    monkeypatch.setenv(dockerapi.DOCKER_BACKEND_ENV, dockerapi.DOCKER_BACKEND_API)
+    dockerapi._clients.clear()
+    imagecache.forget_image_info()
+    yield server
+    imagecache.forget_image_info()
+    for client in dockerapi._clients.values():
+        client.close()
+    dockerapi._clients.clear()
+    server.stop()
+    shutil.rmtree(folder)
+
+
+def test_socket_path(monkeypatch):
+    monkeypatch.setenv("DOCKER_HOST", "unix:///run/user/1000/docker.sock")
+    assert dockerapi.docker_socket_path() == "/run/user/1000/docker.sock"
+    monkeypatch.setenv("DOCKER_HOST", "tcp://127.0.0.1:2375")
+    assert dockerapi.docker_socket_path() is None
+
+
+def test_split_image_tag():
+    assert dockerapi.split_image_tag("alpine") == ("alpine", "latest")
+    assert dockerapi.split_image_tag("alpine:3.18") == ("alpine", "3.18")
+    assert dockerapi.split_image_tag("localhost:5000/tools/gcc") == ("localhost:5000/tools/gcc", "latest")
+    assert dockerapi.split_image_tag("localhost:5000/gcc:12") == ("localhost:5000/gcc", "12")
+    assert dockerapi.split_image_tag("alpine@sha256:abcd") == ("alpine", "sha256:abcd")
+
+
+def test_request_retry(mocker):
+    made = []
+
+    def make_connection(path):
+        conn = mocker.Mock()
+        conn.getresponse.return_value.status = 200
+        conn.getresponse.return_value.will_close = False
+        conn.getresponse.return_value.read.return_value = b"{}"
+        made.append(conn)
+        return conn
+
+    mocker.patch.object(dockerapi, "UnixHTTPConnection", side_effect=make_connection)
+    client = dockerapi.DockerApiClient("/var/run/docker.sock")
+    assert client.request("GET", "/info") == b"{}"
+    # the engine closed the idle connection
+    made[0].getresponse.side_effect = http.client.RemoteDisconnected("closed")
+    assert client.request("GET", "/info") == b"{}"
+    assert len(made) == 2
+
+    # the engine may have started this container, so it is not started twice
+    made[1].getresponse.side_effect = http.client.RemoteDisconnected("closed")
+    with pytest.raises(http.client.RemoteDisconnected):
+        client.request("POST", "/containers/c1/start")
+    assert len(made) == 2
+
+    # the engine never got this request
+    client.request("GET", "/info")
+    made[2].request.side_effect = BrokenPipeError()
+    assert client.request("POST", "/containers/c1/start") == b"{}"
+    assert len(made) == 4
+
+    # a new connection is not tried again
+    client.close()
+    mocker.patch.object(dockerapi, "UnixHTTPConnection", side_effect=ConnectionRefusedError())
+    with pytest.raises(ConnectionRefusedError):
+        client.request("GET", "/info")
+
+
+def test_requests_do_not_wait(mocker):
+    pulling = threading.Event()
+    pulled = threading.Event()
+
+    def make_connection(path):
+        conn = mocker.Mock()
+        conn.getresponse.return_value.status = 200
+        conn.getresponse.return_value.will_close = False
+        conn.getresponse.return_value.read.return_value = b"{}"
+        return conn
+
+    def slow_pull(method, url, **kwargs):
+        if url.startswith("/images/create"):
+            pulling.set()
+            assert pulled.wait(5)
+
+    mocker.patch.object(dockerapi, "UnixHTTPConnection", side_effect=make_connection)
+    client = dockerapi.DockerApiClient("/var/run/docker.sock")
+    client.request("GET", "/info")
+    client._idle[0].request.side_effect = slow_pull
+    pull = threading.Thread(target=client.request, args=("POST", "/images/create"))
+    pull.start()
+    try:
+        assert pulling.wait(5)
+        # other requests use another connection while the pull is running
+        assert client.request("GET", "/containers/c1/json") == b"{}"
+    finally:
+        pulled.set()
+        pull.join()
+    assert len(client._idle) == 2
+
+
+def test_exec_without_exit_status(mocker):
+    client = mocker.Mock()
+    client.exec_inspect.return_value = {"Running": True}
+    mocker.patch.object(dockerapi, "EXEC_EXIT_CHECKS", 2)
+    mocker.patch("time.sleep")
+    left, right = socket.socketpair()
+    right.close()
+    proc = dockerapi.ApiExecProcess(client, "abcd", left, b"")
+    assert proc.wait(5) == -1
+    proc.stdout.close()
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_backend_selection(fake_engine, monkeypatch):
+    assert DockerTool().api is not None
+    podman = DockerTool()
+    podman.tool = "podman"
+    assert podman.api is None
+
+    monkeypatch.setenv(dockerapi.DOCKER_BACKEND_ENV, "cli")
+    assert DockerTool().api is None
+    monkeypatch.setenv(dockerapi.DOCKER_BACKEND_ENV, "grpc")
+    with pytest.raises(GitlabEmulatorError):
+        dockerapi.get_docker_backend()
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_images(fake_engine):
+    tool = DockerTool()
+    tool.image = "registry.local/tools/alpine:3.18"
+    assert not tool.image_present
+    tool.pull()
+    assert tool.pulled
+    assert tool.image_present
+    assert tool.inspect()["Os"] == "linux"
+    # all of these requests used one connection
+    assert fake_engine.connections == 1
+    assert ("POST", "/images/create", {"fromImage": "registry.local/tools/alpine", "tag": "3.18"}) \
+        in fake_engine.requests
+
+    fake_engine.missing.append("private/image:latest")
+    with pytest.raises(DockerToolFailed) as err:
+        tool.pull_image("private/image")
+    assert "pull access denied" in err.value.stderr
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_run_and_exec(fake_engine, temp_folder: Path, capfd):
+    fake_engine.images["alpine:3.18"] = {"Id": "sha256:1234", "Os": "linux", "Config": {"User": "app:app"}}
+    job = DockerJob()
+    job.name = "api-job"
+    job.workspace = str(temp_folder)
+    job._has_bash = False
+    job.docker.image = "alpine:3.18"
+    job.docker.name = "gle-docker-api-test"
+    job.docker.volumes = [f"{temp_folder}:{temp_folder}"]
+    job.docker.add_env("GREETING", "hello world")
+    job.docker.add_env("MULTI", "one\ntwo")
+    job.docker.run()
+    assert job.docker.get_user() == "app:app"
+
+    config = fake_engine.containers[job.docker.container]
+    assert config["Name"] == "/gle-docker-api-test"
+    assert config["HostConfig"]["Binds"] == [f"{temp_folder}:{temp_folder}:rw"]
+    assert "GREETING=hello world" in config["Env"]
+    assert job.docker.containers == [job.docker.container]
+    assert job.docker.container_name(job.docker.container) == "gle-docker-api-test"
+
+    # the script is sent over the exec connection and output is streamed back
+    task = job._run_script(make_script(["echo \"$GREETING\"", "echo \"$MULTI\"", "pwd", "echo oops >&2"]))
+    assert task.returncode == 0
+    stdout, _ = capfd.readouterr()
+    assert "hello world\n" in stdout
+    assert "one\ntwo\n" in stdout
+    # stderr is a separate stream so it may arrive before earlier stdout
+    assert "oops" in stdout
+    assert str(temp_folder) in stdout
+
+    task = job._run_script(make_script(["echo one", "exit 3"]))
+    assert task.returncode == 3
+
+    job.docker.write_file(str(temp_folder / "written.txt"), "some text\n")
+    assert (temp_folder / "written.txt").read_text() == "some text\n"
+    assert job.docker.check_call(str(temp_folder), ["cat", "written.txt"], capture=True) == b"some text\n"
+    assert fake_engine.hijacked == 4
+
+    job.docker.kill()
+    assert not job.docker.containers
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_services(fake_engine):
+    fake_engine.images["redis:7"] = {"Id": "sha256:5678", "Os": "linux", "Config": {}}
+    job = DockerJob()
+    job.docker.pull_policy = "never"
+    job.services = [{"name": "redis:7", "alias": "cache", "variables": {"GLE_SERVICE_READY": "log:Ready to accept"}}]
+    fake_engine.logs["redis:7"] = b"Server initialized\nReady to accept connections tcp\n"
+    with docker_services(job, {"PASSWORD": "secret"}) as network:
+        assert network.startswith(f"gle-network-{os.getpid()}-")
+        assert len(fake_engine.containers) == 1
+        container, config = list(fake_engine.containers.items())[0]
+        assert "PASSWORD=secret" in config["Env"]
+        connected = fake_engine.networks[network]["Containers"][0]
+        assert connected["Container"] == container
+        assert connected["EndpointConfig"]["Aliases"] == ["redis", "cache"]
+        # readiness checks can look inside the service
+        assert job.docker.container_exec(container, ["sh", "-c", "echo listening"]) == "listening\n"
+        with pytest.raises(DockerToolFailed):
+            job.docker.container_exec(container, ["sh", "-c", "exit 1"])
+    wait_for_service_teardown()
+    assert not fake_engine.containers
+    # the network is removed with the last service
+    assert not job.docker.network_exists(network)
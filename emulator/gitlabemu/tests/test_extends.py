@@ -6,6 +6,7 @@ from pathlib import Path
 from .test_configloader import HERE
 from .. import configloader
 from ..runner import run
+from ..yamlloader import StringableOrderedDict
 
 INVALID_DIR = Path(__file__).parent / "invalid"
 
@@ -54,3 +55,59 @@ def test_load_extends():
     assert last.after_script == ["echo template-basic after_script"]
     assert last.before_script == top.before_script
     assert last.script == top.script
+
+
+def test_extends_cycle(in_tests: str, capfd) -> None:
+    extends_cycle = INVALID_DIR / "extends-cycle.yaml"
+    with pytest.raises(SystemExit):
+        run(["-c", str(extends_cycle), "-l"])
+    _, stderr = capfd.readouterr()
+    assert "Config error: Job '.top' has circular extends: .base -> .middle -> .top -> .base" in stderr
+
+
+def test_extends_shared_templates():
+    config = {
+        "variables": {"COLOR": "red"},
+        ".base": {"image": "base:image", "script": ["base"], "variables": {"SHAPE": "square"}},
+        ".middle": {"extends": ".base", "before_script": ["middle"]},
+    }
+    for i in range(5):
+        config[f"job{i}"] = {"extends": [".middle"], "variables": {"INDEX": str(i)}}
+    configloader.do_extends(config)
+
+    for i in range(5):
+        job = config[f"job{i}"]
+        assert job["image"] == "base:image"
+        assert job["before_script"] == ["middle"]
+        assert job["variables"] == {"SHAPE": "square", "INDEX": str(i), "COLOR": "red"}
+    # resolved jobs must not share mutable state
+    config["job0"]["script"].append("changed")
+    assert config["job1"]["script"] == ["base"]
+    assert config[".base"]["script"] == ["base"]
+    config["job0"]["variables"]["SHAPE"] = "circle"
+    assert config["job1"]["variables"]["SHAPE"] == "square"
+    assert config[".base"]["variables"]["SHAPE"] == "square"
+
+
+def test_extends_keeps_mapping_type():
+    config = {
+        ".base": StringableOrderedDict([("image", StringableOrderedDict([("name", "base:image")])),
+                                        ("cache", StringableOrderedDict([("paths", ["b", "a"]), ("key", "deps")]))]),
+        "job": {"extends": ".base", "script": ["true"]},
+    }
+    configloader.do_extends(config)
+    assert isinstance(config["job"]["image"], StringableOrderedDict)
+    assert isinstance(config["job"]["cache"], StringableOrderedDict)
+    assert list(config["job"]["cache"]) == ["paths", "key"]
+    assert config["job"]["image"] is not config[".base"]["image"]
+
+
+def test_load_job_overrides_copy():
+    loader = configloader.Loader()
+    loader.load(os.path.join(HERE, "test_extends.yaml"))
+    top = loader.load_job("top", overrides={"image": "override:image", "before_script": None})
+    assert top.docker_image == "override:image"
+    assert top.before_script == []
+    # the loaded pipeline is unchanged
+    assert loader.get_job("top")["before_script"][0] == "middle before_script"
+    assert loader.load_job("top").docker_image == "baseimage:image"
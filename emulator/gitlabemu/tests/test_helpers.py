@@ -7,9 +7,11 @@ import pytest
 import subprocess
 import uuid
 from io import StringIO
+from .. import helpers
 from ..helpers import (
     clean_leftovers,
     communicate,
+    get_output_batch_size,
     get_git_remote_urls,
     git_commit_sha,
     git_current_branch,
@@ -56,6 +58,37 @@ def test_communicate_throws() -> None:
         communicate(proc, script=None, throw=True)
 
 
+def test_output_batch_size(monkeypatch):
+    assert get_output_batch_size() == helpers.DEFAULT_OUTPUT_BATCH
+    monkeypatch.setenv(helpers.OUTPUT_BATCH_ENV, "4096")
+    assert get_output_batch_size() == 4096
+    monkeypatch.setenv(helpers.OUTPUT_BATCH_ENV, "lots")
+    assert get_output_batch_size() == helpers.DEFAULT_OUTPUT_BATCH
+    monkeypatch.setenv(helpers.OUTPUT_BATCH_ENV, "0")
+    assert get_output_batch_size() == 1
+
+
+@pytest.mark.usefixtures("posix_only")
+@pytest.mark.parametrize("batch", ["1", "100", ""])
+def test_communicate_chunks(monkeypatch, batch: str) -> None:
+    # lines and multi-byte chars that are split across reads still arrive whole
+    monkeypatch.setattr(helpers, "OUTPUT_CHUNK_SIZE", 7)
+    monkeypatch.setenv(helpers.OUTPUT_BATCH_ENV, batch)
+    script = ("import sys\n"
+              "for i in range(200):\n"
+              "    sys.stdout.buffer.write(f'line {i} \u00e9\u20ac\\n'.encode())\n"
+              "sys.stdout.buffer.write(b'bad \\xff\\xfe end')\n")
+    proc = subprocess.Popen([sys.executable, "-c", script], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = StringIO()
+    lines = []
+    communicate(proc, stdout=output, linehandler=lines.append)
+    expected = "".join(f"line {i} \u00e9\u20ac\n" for i in range(200))
+    assert output.getvalue() == expected + "bad \ufffd\ufffd end"
+    data = b"".join(lines)
+    assert data == expected.encode() + b"bad \xff\xfe end"
+    assert all(x.endswith(b"\n") for x in lines[:-1])
+
+
 @pytest.mark.usefixtures("has_docker")
 @pytest.mark.usefixtures("posix_only")
 def test_clean():
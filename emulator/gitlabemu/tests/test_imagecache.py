@@ -0,0 +1,118 @@
+"""
+Test the docker image details cache
+"""
+import json
+import subprocess
+
+import pytest
+
+from .. import imagecache
+from ..docker import DockerJob, DockerTool
+
+ALPINE = {
+    "Id": "sha256:1111",
+    "Os": "linux",
+    "Config": {"User": "app:app", "Entrypoint": ["/bin/sh"]},
+}
+
+
+@pytest.fixture(scope="function")
+def image_cache(temp_folder, monkeypatch):
+    monkeypatch.setenv("GLE_CACHE_DIR", str(temp_folder))
+    imagecache.forget_image_info()
+    yield temp_folder
+    imagecache.forget_image_info()
+
+
+def test_pull_digest():
+    output = "3.18: Pulling from library/alpine\nDigest: sha256:abc123\nStatus: Image is up to date for alpine:3.18\n"
+    assert imagecache.pull_digest(output) == "sha256:abc123"
+    assert imagecache.pull_digest("nothing") is None
+
+
+def test_inspect_once(image_cache, mocker):
+    inspect = mocker.Mock(return_value=ALPINE)
+    found = imagecache.get_image_info("docker", "alpine:3.18", inspect)
+    assert found.image_id == "sha256:1111"
+    assert found.os == "linux"
+    assert found.user == "app:app"
+    assert found.entrypoint == ["/bin/sh"]
+    assert found.has_bash is None
+    assert imagecache.get_image_info("docker", "alpine:3.18", inspect) is found
+    assert inspect.call_count == 1
+
+    imagecache.set_image_has_bash(found, False)
+    # another gle process still inspects the image but remembers what it learned about it
+    imagecache.forget_image_info()
+    found = imagecache.get_image_info("docker", "alpine:3.18", inspect)
+    assert inspect.call_count == 2
+    assert found.has_bash is False
+
+    missing = mocker.Mock(return_value=None)
+    assert imagecache.get_image_info("docker", "missing", missing) is None
+    assert imagecache.get_image_info("docker", "missing", missing) is None
+    assert missing.call_count == 2
+
+
+def test_pull_invalidates(image_cache, mocker):
+    inspect = mocker.Mock(return_value=ALPINE)
+    imagecache.image_pulled("docker", "alpine:3.18", "sha256:aaaa")
+    assert imagecache.get_image_info("docker", "alpine:3.18", inspect).image_id == "sha256:1111"
+    assert inspect.call_count == 1
+
+    # pulled again in this process, same digest
+    imagecache.image_pulled("docker", "alpine:3.18", "sha256:aaaa")
+    imagecache.get_image_info("docker", "alpine:3.18", inspect)
+    assert inspect.call_count == 1
+
+    # a later run pulls the same digest, so it does not need to inspect the image at all
+    imagecache.forget_image_info()
+    imagecache.image_pulled("docker", "alpine:3.18", "sha256:aaaa")
+    assert imagecache.get_image_info("docker", "alpine:3.18", inspect).user == "app:app"
+    assert inspect.call_count == 1
+
+    # the image changed
+    inspect.return_value = dict(ALPINE, Id="sha256:2222", Config={"User": "root"})
+    imagecache.image_pulled("docker", "alpine:3.18", "sha256:bbbb")
+    found = imagecache.get_image_info("docker", "alpine:3.18", inspect)
+    assert inspect.call_count == 2
+    assert found.image_id == "sha256:2222"
+    assert found.user == "root"
+
+    # a pull without a digest always inspects again
+    imagecache.image_pulled("docker", "alpine:3.18", None)
+    imagecache.get_image_info("docker", "alpine:3.18", inspect)
+    assert inspect.call_count == 3
+
+
+def test_docker_tool_inspects_once(image_cache, mocker):
+    def docker_call(*args, **kwargs):
+        if args[:2] == ("image", "inspect"):
+            return subprocess.CompletedProcess(args, 0, stdout=json.dumps([ALPINE]), stderr="")
+        return subprocess.CompletedProcess(args, 0, stdout="", stderr="")
+
+    call = mocker.patch.object(DockerTool, "docker_call", side_effect=docker_call)
+    job = DockerJob()
+    job.workspace = "/builds/project"
+    job.docker.image = "alpine:3.18"
+    job.docker.pull_policy = "if-not-present"
+    job.pull_image()
+    assert job.docker.image_present
+    assert job.docker.get_user() == "app:app"
+    assert job.docker.image_info().os == "linux"
+    assert call.call_count == 1
+
+    # once we know if the image has bash, later jobs do not check for it
+    check_call = mocker.patch.object(job.docker, "check_call", return_value=b"")
+    job.prepare_container()
+    assert not job.has_bash()
+    assert "command -v bash" in check_call.call_args.args[1][2]
+
+    job = DockerJob()
+    job.workspace = "/builds/project"
+    job.docker.image = "alpine:3.18"
+    check_call = mocker.patch.object(job.docker, "check_call", return_value=b"")
+    job.prepare_container()
+    assert "command -v bash" not in check_call.call_args.args[1][2]
+    assert not job.has_bash()
+    assert call.call_count == 1
@@ -0,0 +1,62 @@
+"""
+Test fetching and caching of remote includes
+"""
+from pathlib import Path
+
+import requests
+from requests_mock import Mocker
+
+from .. import configloader
+from ..configcache import IncludeCache
+
+PIPELINE = """
+include:
+  - remote: https://example.com/ci/one.yml
+  - remote: https://example.com/ci/two.yml
+  - remote: https://example.com/ci/skipped.yml
+    rules:
+      - if: $NEVER_SET
+
+job0:
+  script:
+    - echo job0
+"""
+
+
+def remote_job(name: str) -> str:
+    return f"{name}:\n  script:\n    - echo {name}\n"
+
+
+def load_pipeline(folder: Path) -> configloader.Loader:
+    pipeline = folder / ".gitlab-ci.yml"
+    pipeline.write_text(PIPELINE)
+    loader = configloader.Loader()
+    loader.include_cache = IncludeCache(str(folder / "cache"))
+    loader.load(str(pipeline))
+    return loader
+
+
+def test_fetch_remote_includes(temp_folder: Path, requests_mock: Mocker):
+    requests_mock.get("https://example.com/ci/one.yml", text=remote_job("job1"), headers={"ETag": "\"one\""})
+    requests_mock.get("https://example.com/ci/two.yml", text=remote_job("job2"))
+    skipped = requests_mock.get("https://example.com/ci/skipped.yml", text=remote_job("job3"))
+
+    loader = load_pipeline(temp_folder)
+    assert "job1" in loader.get_jobs()
+    assert "job2" in loader.get_jobs()
+    assert "job3" not in loader.get_jobs()
+    assert not skipped.called
+    assert loader.get_job_filename("job1") == "https://example.com/ci/one.yml"
+
+    # the second load should revalidate using the etag
+    one = requests_mock.get("https://example.com/ci/one.yml", status_code=304)
+    loader = load_pipeline(temp_folder)
+    assert "job1" in loader.get_jobs()
+    assert one.last_request.headers["If-None-Match"] == "\"one\""
+
+    # and work offline
+    requests_mock.get("https://example.com/ci/one.yml", exc=requests.ConnectionError)
+    requests_mock.get("https://example.com/ci/two.yml", exc=requests.ConnectionError)
+    loader = load_pipeline(temp_folder)
+    assert "job1" in loader.get_jobs()
+    assert "job2" in loader.get_jobs()
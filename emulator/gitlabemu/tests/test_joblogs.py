@@ -0,0 +1,139 @@
+"""
+Test saving and reading job logs
+"""
+import gzip
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from .. import joblogs, rundir
+from ..jobs import Job
+from ..runner import run
+
+
+def write_log(path: str, chunks, timestamps=None) -> None:
+    writer = joblogs.JobLogWriter(path)
+    for index, chunk in enumerate(chunks):
+        when = timestamps[index] if timestamps else 1000.0
+        writer.append(chunk, when)
+    writer.finish()
+
+
+def numbered(start: int, end: int) -> bytes:
+    return b"".join(f"line {x}\n".encode() for x in range(start, end))
+
+
+def test_log_is_gzip(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(joblogs, "LOG_BLOCK_SIZE", 1000)
+    path = str(tmp_path / "job.log.gz")
+    data = numbered(0, 5000)
+    # split output mid line, blocks must still start at a line
+    chunks = [data[x:x + 333] for x in range(0, len(data), 333)]
+    write_log(path, chunks)
+    with gzip.open(path, "rb") as fd:
+        assert fd.read() == data
+
+    reader = joblogs.JobLogReader(path)
+    assert len(reader.index) > 10
+    for entry in reader.index:
+        assert entry.offset == 0 or data[entry.offset - 1:entry.offset] == b"\n"
+        assert data[:entry.offset].count(b"\n") == entry.line
+    assert b"".join(reader.between()) == data
+
+
+def test_tail(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(joblogs, "LOG_BLOCK_SIZE", 4096)
+    path = str(tmp_path / "job.log.gz")
+    write_log(path, [numbered(x, x + 100) for x in range(0, 10000, 100)])
+    reader = joblogs.JobLogReader(path)
+    assert b"".join(reader.tail(200)) == numbered(9800, 10000)
+    assert b"".join(reader.tail(1)) == numbered(9999, 10000)
+    assert b"".join(reader.tail(20000)) == numbered(0, 10000)
+    assert list(reader.tail(0)) == []
+
+    # no line break at the end
+    path = str(tmp_path / "partial.log.gz")
+    write_log(path, [numbered(0, 10), b"no newline"])
+    reader = joblogs.JobLogReader(path)
+    assert b"".join(reader.tail(2)) == b"line 9\nno newline"
+
+
+def test_between(tmp_path: Path):
+    path = str(tmp_path / "job.log.gz")
+    # ten seconds of output, one chunk per second
+    write_log(path, [numbered(x * 10, x * 10 + 10) for x in range(10)],
+              timestamps=[1000.0 + x for x in range(10)])
+    reader = joblogs.JobLogReader(path)
+    assert len(reader.index) == 10
+    assert b"".join(reader.between(since=3)) == numbered(30, 100)
+    assert b"".join(reader.between(until=2)) == numbered(0, 30)
+    assert b"".join(reader.between(since=4.5, until=6)) == numbered(40, 70)
+
+
+def test_read_while_writing(tmp_path: Path):
+    log = joblogs.JobLog(str(tmp_path / "running.log.gz"))
+    log.write(numbered(0, 50))
+    # the writer makes the log readable once the job goes quiet
+    deadline = time.monotonic() + 10
+    lines = []
+    while time.monotonic() < deadline:
+        lines = list(joblogs.JobLogReader(log.path).tail(5))
+        if lines:
+            break
+        time.sleep(0.1)
+    assert b"".join(lines) == numbered(45, 50)
+    log.close()
+    with gzip.open(log.path, "rb") as fd:
+        assert fd.read() == numbered(0, 50)
+
+
+def test_prune_runs(tmp_path: Path, monkeypatch):
+    monkeypatch.setenv(rundir.RUN_DIR_ENV, str(tmp_path))
+    monkeypatch.setenv(rundir.KEEP_RUNS_ENV, "3")
+    for index in range(5):
+        os.makedirs(tmp_path / f"20240101-00000{index}-1")
+    rundir.reset_run_dir()
+    current = rundir.get_run_dir()
+    runs = rundir.list_runs()
+    assert len(runs) == 3
+    assert current in runs
+    assert str(tmp_path / "20240101-000004-1") in runs
+    assert rundir.get_run_dir() == current
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_job_saves_log(tmp_path: Path, monkeypatch):
+    monkeypatch.setenv(rundir.RUN_DIR_ENV, str(tmp_path / "runs"))
+    job = Job()
+    job.name = "logged 1/2"
+    job.workspace = str(tmp_path)
+    job.script = ["echo hello log"]
+    job.run()
+    path = joblogs.find_job_log(rundir.list_runs(), "logged 1/2")
+    assert path
+    with gzip.open(path, "rb") as fd:
+        assert b"hello log\n" in fd.read()
+
+    monkeypatch.setenv(joblogs.JOB_LOGS_ENV, "0")
+    job.name = "not logged"
+    job.run()
+    assert joblogs.find_job_log(rundir.list_runs(), "not logged") is None
+
+
+@pytest.mark.usefixtures("posix_only")
+@pytest.mark.usefixtures("in_tests")
+def test_gle_logs(capfd):
+    run(["-c", "pipeline-local.yml", "b1"])
+    capfd.readouterr()
+    run(["-c", "pipeline-local.yml", "--logs"])
+    stdout, _ = capfd.readouterr()
+    assert stdout.splitlines() == ["b1"]
+    run(["-c", "pipeline-local.yml", "--logs", "b1", "--tail", "200"])
+    stdout, _ = capfd.readouterr()
+    assert "b1" in stdout
+    with pytest.raises(SystemExit):
+        run(["-c", "pipeline-local.yml", "--logs", "b2"])
+    _, stderr = capfd.readouterr()
+    assert "No log found for b2" in stderr
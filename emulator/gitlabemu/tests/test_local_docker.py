@@ -180,6 +180,10 @@ def test_no_such_exec():
     assert len(comm.errors) == 1
     assert isinstance(comm.errors[0], DockerExecError)
 
+    # found in a chunk of several lines even if other lines are not utf-8
+    comm.handle_lines(b"building\n\xff\xfe binary\nError: No such exec instance: 1234\n")
+    assert len(comm.errors) == 2
+
 
 def test_services(linux_docker, capsys):
     """
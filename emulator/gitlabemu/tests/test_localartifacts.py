@@ -0,0 +1,198 @@
+"""
+Test collecting and restoring local job artifacts
+"""
+import errno
+import json
+import os
+import stat
+from pathlib import Path
+
+import pytest
+
+from .. import localartifacts, rundir
+from ..artifacts import GitlabArtifacts
+from ..jobs import Job
+from ..localartifacts import ArtifactError, ArtifactStore, collect_artifacts, restore_artifacts, select_files
+
+
+def make_artifacts(**data) -> GitlabArtifacts:
+    artifacts = GitlabArtifacts()
+    artifacts.load(data)
+    return artifacts
+
+
+@pytest.fixture
+def workspace(tmp_path: Path) -> Path:
+    folder = tmp_path / "workspace"
+    (folder / "build" / "lib").mkdir(parents=True)
+    (folder / "build" / "app").write_text("app")
+    (folder / "build" / "app.o").write_text("object")
+    (folder / "build" / "lib" / "libx.so").write_text("library")
+    (folder / "build" / "lib" / "libx.o").write_text("object")
+    (folder / "report.txt").write_text("report")
+    (folder / "src").mkdir()
+    (folder / "src" / "main.c").write_text("int main() {}")
+    return folder
+
+
+def test_select_files(workspace: Path):
+    artifacts = make_artifacts(paths=["build/", "$REPORT"], exclude=["build/**/*.o"])
+    assert select_files(str(workspace), artifacts, {"REPORT": "report.txt"}) == [
+        "build/app", "build/lib/libx.so", "report.txt"]
+    artifacts = make_artifacts(paths=["**/*.o"])
+    assert select_files(str(workspace), artifacts, {}) == ["build/app.o", "build/lib/libx.o"]
+    for path in ["../outside", "/etc/passwd"]:
+        with pytest.raises(ArtifactError):
+            select_files(str(workspace), make_artifacts(paths=[path]), {})
+
+
+def test_should_collect():
+    assert localartifacts.should_collect(make_artifacts(paths=["x"]), True)
+    assert not localartifacts.should_collect(make_artifacts(paths=["x"]), False)
+    assert localartifacts.should_collect(make_artifacts(paths=["x"], when="on_failure"), False)
+    assert not localartifacts.should_collect(make_artifacts(paths=["x"], when="on_failure"), True)
+    assert localartifacts.should_collect(make_artifacts(paths=["x"], when="always"), False)
+
+
+def test_store_dedupes(tmp_path: Path):
+    store = ArtifactStore(str(tmp_path / "objects"))
+    (tmp_path / "one").write_text("same")
+    (tmp_path / "two").write_text("same")
+    digest = store.add(str(tmp_path / "one"))
+    assert store.add(str(tmp_path / "two")) == digest
+    stored = Path(store.object_path(digest))
+    assert stored.read_text() == "same"
+    assert not stored.stat().st_mode & stat.S_IWUSR
+    assert len(list((tmp_path / "objects").glob("*/*"))) == 1
+
+    assert store.collect_garbage({digest}, grace=0) == 0
+    assert store.collect_garbage(set(), grace=60) == 0
+    assert store.collect_garbage(set(), grace=0) == 1
+    assert not stored.exists()
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_collect_and_restore(workspace: Path, tmp_path: Path):
+    os.chmod(workspace / "build" / "app", 0o755)
+    os.symlink("libx.so", workspace / "build" / "lib" / "libx.so.1")
+    artifacts = make_artifacts(paths=["build"], exclude=["**/*.o"])
+    manifest = collect_artifacts("compile", str(workspace), artifacts, True, {})
+    with open(manifest) as fd:
+        data = json.load(fd)
+    assert sorted(data["files"]) == ["build/app", "build/lib/libx.so"]
+    assert data["links"] == {"build/lib/libx.so.1": "libx.so"}
+
+    other = tmp_path / "other"
+    other.mkdir()
+    linked, copied = restore_artifacts(str(other), ["compile"])
+    assert linked == 0 and copied == 2
+    app = other / "build" / "app"
+    assert app.read_text() == "app"
+    assert stat.S_IMODE(app.stat().st_mode) == 0o755
+    assert stat.S_IMODE((other / "build" / "lib" / "libx.so").stat().st_mode) == data["files"]["build/lib/libx.so"][1]
+    assert os.readlink(other / "build" / "lib" / "libx.so.1") == "libx.so"
+
+    # changing a restored file does not change the store
+    stored = Path(ArtifactStore().object_path(data["files"]["build/app"][0]))
+    with open(app, "a") as fd:
+        fd.write("tampered")
+    os.chmod(app, 0o700)
+    assert stored.read_text() == "app"
+    assert stat.S_IMODE(stored.stat().st_mode) == 0o555
+    restore_artifacts(str(other), ["compile"])
+    assert app.read_text() == "app"
+
+    # already there, the mode is put back
+    os.chmod(app, 0o700)
+    assert restore_artifacts(str(other), ["compile"]) == (0, 0)
+    assert stat.S_IMODE(app.stat().st_mode) == 0o755
+    # files that are already the same are left alone
+    assert restore_artifacts(str(workspace), ["compile"]) == (0, 0)
+    assert (workspace / "build" / "app").stat().st_nlink == 1
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_restore_links(workspace: Path, tmp_path: Path, monkeypatch):
+    monkeypatch.setenv(localartifacts.ARTIFACT_LINKS_ENV, "1")
+    os.chmod(workspace / "report.txt", 0o644)
+    manifest = collect_artifacts("compile", str(workspace), make_artifacts(paths=["report.txt"]), True, {})
+    with open(manifest) as fd:
+        digest = json.load(fd)["files"]["report.txt"][0]
+    other = tmp_path / "other"
+    assert restore_artifacts(str(other), ["compile"]) == (1, 0)
+    report = other / "report.txt"
+    assert report.stat().st_ino == os.stat(ArtifactStore().object_path(digest)).st_ino
+    assert stat.S_IMODE(report.stat().st_mode) == 0o644
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_restore_copies_across_filesystems(workspace: Path, tmp_path: Path, mocker, monkeypatch):
+    monkeypatch.setenv(localartifacts.ARTIFACT_LINKS_ENV, "1")
+    collect_artifacts("compile", str(workspace), make_artifacts(paths=["report.txt"]), True, {})
+    mocker.patch("os.link", side_effect=OSError(errno.EXDEV, "Invalid cross-device link"))
+    other = tmp_path / "other"
+    assert restore_artifacts(str(other), ["compile"]) == (0, 1)
+    assert (other / "report.txt").read_text() == "report"
+    assert (other / "report.txt").stat().st_mode & stat.S_IWUSR
+
+
+def test_artifacts_when(workspace: Path):
+    collect_artifacts("tests", str(workspace), make_artifacts(paths=["report.txt"]), False, {})
+    other = workspace / "other"
+    restore_artifacts(str(other), ["tests"])
+    assert not other.exists()
+    collect_artifacts("tests", str(workspace), make_artifacts(paths=["report.txt"], when="on_failure"), False, {})
+    restore_artifacts(str(other), ["tests"])
+    assert (other / "report.txt").exists()
+
+
+def test_restore_from_earlier_run(workspace: Path, tmp_path: Path, monkeypatch):
+    monkeypatch.setenv(rundir.RUN_DIR_ENV, str(tmp_path / "runs"))
+    collect_artifacts("compile 1/2", str(workspace), make_artifacts(paths=["report.txt"]), True, {})
+    collect_artifacts("compile 2/2", str(workspace), make_artifacts(paths=["src"]), True, {})
+    # a new gle process
+    rundir.reset_run_dir()
+    os.rename(rundir.list_runs()[0], str(tmp_path / "runs" / "20000101-000000-1"))
+    other = tmp_path / "other"
+    # only on request, the old files could replace newer ones in the project folder
+    assert restore_artifacts(str(other), ["compile"]) == (0, 0)
+    assert not other.exists()
+    monkeypatch.setenv(localartifacts.LOCAL_ARTIFACTS_ENV, "all")
+    assert localartifacts.local_artifacts_enabled()
+    restore_artifacts(str(other), ["compile"])
+    assert (other / "report.txt").read_text() == "report"
+    assert (other / "src" / "main.c").exists()
+
+
+def test_prune_collects_objects(workspace: Path, tmp_path: Path, monkeypatch):
+    monkeypatch.setenv(rundir.RUN_DIR_ENV, str(tmp_path / "runs"))
+    monkeypatch.setenv(rundir.KEEP_RUNS_ENV, "1")
+    monkeypatch.setattr(localartifacts, "OBJECT_GC_GRACE", 0)
+    collect_artifacts("compile", str(workspace), make_artifacts(paths=["report.txt"]), True, {})
+    objects = Path(localartifacts.get_objects_dir())
+    assert len(list(objects.glob("*/*"))) == 1
+    os.rename(rundir.list_runs()[0], str(tmp_path / "runs" / "20000101-000000-1"))
+    rundir.reset_run_dir()
+    rundir.get_run_dir()
+    assert len(rundir.list_runs()) == 1
+    assert len(list(objects.glob("*/*"))) == 0
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_jobs_pass_artifacts(tmp_path: Path):
+    first = Job()
+    first.name = "first"
+    first.workspace = str(tmp_path / "one")
+    os.makedirs(first.workspace)
+    first.script = ["mkdir -p out", "echo built > out/file.txt", "echo temp > out/file.tmp"]
+    first.artifacts.load({"paths": ["out/"], "exclude": ["out/*.tmp"]})
+    first.run()
+
+    second = Job()
+    second.name = "second"
+    second.workspace = str(tmp_path / "two")
+    os.makedirs(second.workspace)
+    second.needed_artifacts = ["first"]
+    second.script = ["test -f out/file.txt", "test ! -f out/file.tmp"]
+    second.run()
+    assert (tmp_path / "two" / "out" / "file.txt").read_text() == "built\n"
@@ -0,0 +1,171 @@
+"""
+Test the local job cache
+"""
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from .. import localcache
+from ..errors import BadSyntaxError
+from ..jobs import Job
+from ..localcache import CacheError, CacheStore, JobCache, load_job_caches, restore_caches, save_caches
+
+
+@pytest.fixture
+def workspace(tmp_path: Path) -> Path:
+    folder = tmp_path / "workspace"
+    (folder / "node_modules" / "left-pad").mkdir(parents=True)
+    (folder / "node_modules" / "left-pad" / "index.js").write_text("module.exports = pad")
+    (folder / "package-lock.json").write_text('{"lockfileVersion": 3}')
+    return folder
+
+
+def make_cache(**data) -> JobCache:
+    return load_job_caches(data)[0]
+
+
+def test_load_caches():
+    assert load_job_caches(None) == []
+    caches = load_job_caches([{"key": "one", "paths": ["a"]}, {"paths": "b", "policy": "pull"}, {"key": "empty"}])
+    assert len(caches) == 2
+    assert caches[0].key == "one"
+    assert caches[1].key == localcache.DEFAULT_CACHE_KEY
+    assert caches[1].paths == ["b"]
+    with pytest.raises(BadSyntaxError):
+        load_job_caches("nope")
+    with pytest.raises(BadSyntaxError):
+        load_job_caches({"key": {"prefix": "x"}, "paths": ["a"]})
+    with pytest.raises(CacheError):
+        make_cache(paths=["a"], policy="$POLICY").get_policy({"POLICY": "sometimes"})
+    assert make_cache(paths=["a"], policy="$POLICY").get_policy({"POLICY": "pull"}) == "pull"
+
+
+def test_resolve_key(workspace: Path):
+    assert make_cache(key="$CI_JOB_NAME-deps", paths=["a"]).resolve_key(str(workspace), {"CI_JOB_NAME": "x"}) == \
+        "x-deps"
+    cache = make_cache(key={"files": ["package-lock.json", "missing.txt"], "prefix": "$CI_JOB_NAME"}, paths=["a"])
+    first = cache.resolve_key(str(workspace), {"CI_JOB_NAME": "build"})
+    assert first.startswith("build-")
+    assert cache.resolve_key(str(workspace), {"CI_JOB_NAME": "build"}) == first
+    (workspace / "package-lock.json").write_text('{"lockfileVersion": 2}')
+    assert cache.resolve_key(str(workspace), {"CI_JOB_NAME": "build"}) != first
+    os.unlink(workspace / "package-lock.json")
+    assert cache.resolve_key(str(workspace), {"CI_JOB_NAME": "build"}) == "build-default"
+
+
+def test_save_and_restore(workspace: Path, tmp_path: Path):
+    cache = make_cache(key="deps", paths=["node_modules/"])
+    save_caches(str(workspace), [cache], {}, passed=True)
+
+    other = tmp_path / "other"
+    other.mkdir()
+    restore_caches(str(other), [cache], {})
+    assert (other / "node_modules" / "left-pad" / "index.js").read_text() == "module.exports = pad"
+
+    # unchanged, so not extracted again
+    store = CacheStore()
+    digest = store.lookup("deps")
+    assert not store.restore(digest, str(other), cache.paths, {})
+    (other / "node_modules" / "left-pad" / "index.js").write_text("changed")
+    assert store.restore(digest, str(other), cache.paths, {})
+    assert (other / "node_modules" / "left-pad" / "index.js").read_text() == "module.exports = pad"
+
+
+def test_policy_and_when(workspace: Path, tmp_path: Path):
+    pull = make_cache(key="deps", paths=["node_modules"], policy="pull")
+    save_caches(str(workspace), [pull], {}, passed=True)
+    assert CacheStore().lookup("deps") is None
+
+    push = make_cache(key="deps", paths=["node_modules"], policy="push")
+    save_caches(str(workspace), [push], {}, passed=False)
+    assert CacheStore().lookup("deps") is None
+    save_caches(str(workspace), [push], {}, passed=True)
+    assert CacheStore().lookup("deps") is not None
+
+    other = tmp_path / "other"
+    restore_caches(str(other), [push], {})
+    assert not other.exists()
+
+    always = make_cache(key="failed", paths=["node_modules"], when="always")
+    save_caches(str(workspace), [always], {}, passed=False)
+    assert CacheStore().lookup("failed") is not None
+
+
+def test_fallback_keys(workspace: Path, tmp_path: Path):
+    save_caches(str(workspace), [make_cache(key="main", paths=["node_modules"])], {}, passed=True)
+    cache = make_cache(key="$BRANCH", fallback_keys=["nope", "main"], paths=["node_modules"])
+    other = tmp_path / "other"
+    restore_caches(str(other), [cache], {"BRANCH": "feature"})
+    assert (other / "node_modules" / "left-pad" / "index.js").exists()
+
+    cache = make_cache(key="$BRANCH", paths=["node_modules"])
+    other = tmp_path / "global"
+    restore_caches(str(other), [cache], {"BRANCH": "feature", "CACHE_FALLBACK_KEY": "main"})
+    assert (other / "node_modules" / "left-pad" / "index.js").exists()
+
+
+def test_content_addressed(workspace: Path):
+    store = CacheStore()
+    cache_dir = Path(localcache.get_job_cache_dir())
+    first = store.save("one", str(workspace), ["node_modules"], {})
+    second = store.save("two", str(workspace), ["node_modules"], {})
+    assert first == second
+    assert len(list((cache_dir / "archives").iterdir())) == 1
+    assert store.save("none", str(workspace), ["missing"], {}) is None
+
+
+def test_lru_eviction(workspace: Path, monkeypatch):
+    store = CacheStore()
+    cache_dir = Path(localcache.get_job_cache_dir())
+    for index in range(4):
+        (workspace / "data.bin").write_bytes(bytes([index]) * 100000)
+        store.save(f"key{index}", str(workspace), ["data.bin"], {})
+        # make the order of use clear
+        os.utime(store.key_path(f"key{index}"), (time.time() - 100 + index, time.time() - 100 + index))
+    assert len(list((cache_dir / "archives").iterdir())) == 4
+    # use the oldest
+    assert store.lookup("key0")
+    assert store.evict(limit=250000) == 2
+    assert store.lookup("key0")
+    assert store.lookup("key3")
+    assert store.lookup("key1") is None
+    assert store.lookup("key2") is None
+    assert len(list((cache_dir / "archives").iterdir())) == 2
+
+    # the cache just saved is kept even if it is too big
+    monkeypatch.setenv(localcache.JOB_CACHE_SIZE_ENV, "0.05")
+    (workspace / "data.bin").write_bytes(b"x" * 100000)
+    store.save("big", str(workspace), ["data.bin"], {})
+    assert store.lookup("big")
+    assert store.lookup("key0") is None
+
+
+def test_evict_keeps_shared_archive(workspace: Path):
+    store = CacheStore()
+    (workspace / "data.bin").write_bytes(b"x" * 100000)
+    digest = store.save("kept", str(workspace), ["data.bin"], {})
+    os.utime(store.key_path("kept"), (time.time() - 100, time.time() - 100))
+    assert store.save("other", str(workspace), ["data.bin"], {}) == digest
+    # the kept key is the oldest, the other key using the same archive goes
+    assert store.evict(limit=1000, keep="kept") == 1
+    assert store.lookup("other") is None
+    assert store.lookup("kept") == digest
+    assert os.path.exists(store.archive_path(digest))
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_job_cache(tmp_path: Path):
+    def make_job(name: str, script) -> Job:
+        job = Job()
+        job.name = name
+        job.workspace = str(tmp_path / name)
+        os.makedirs(job.workspace)
+        job.script = script
+        job.caches = load_job_caches({"key": "deps", "paths": [".deps"]})
+        return job
+
+    make_job("first", ["mkdir -p .deps", "echo installed > .deps/lib"]).run()
+    make_job("second", ["test -f .deps/lib"]).run()
+    assert (tmp_path / "second" / ".deps" / "lib").read_text() == "installed\n"
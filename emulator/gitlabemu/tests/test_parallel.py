@@ -1,6 +1,7 @@
 import os.path
 
 import pytest
+from .. import runner
 from ..runner import run
 
 HERE = os.path.dirname(__file__)
@@ -33,3 +34,42 @@ def test_docker_parallel_m_of_n_denied(top_dir, capsys):
     with pytest.raises(SystemExit) as err:
         run(["-c", PARALLEL_CONFIG, "normaljob", "--parallel", "2/4"])
     assert err.value.code == 1
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_parallel_all(top_dir, capfd):
+    run(["-c", PARALLEL_CONFIG, "shelljob", "--parallel", "all"])
+    stdout, stderr = capfd.readouterr()
+    for index in [1, 2, 3]:
+        assert f"[shelljob {index}/3] index={index} total=3 name=shelljob {index}/3\n" in stdout
+        assert f"shelljob {index}/3  success" in stderr
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_parallel_all_failed(top_dir, capfd):
+    with pytest.raises(SystemExit) as err:
+        run(["-c", PARALLEL_CONFIG, "shelljob", "--parallel", "all", "-j", "1", "--var", "FAIL_INDEX=2"])
+    assert err.value.code == 1
+    stdout, stderr = capfd.readouterr()
+    # the other jobs still run
+    assert "index=3" in stdout
+    assert "shelljob 2/3  failed" in stderr
+    assert "1 of 3 shelljob jobs failed" in stderr
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_parallel_all_pretty(top_dir, mocker):
+    # the pretty mode spinner can only show one job at a time
+    spy = mocker.spy(runner, "execute_parallel")
+    run(["-c", PARALLEL_CONFIG, "shelljob", "--parallel", "all", "--pretty"])
+    assert spy.call_args[1]["max_jobs"] == 1
+    with pytest.raises(SystemExit):
+        run(["-c", PARALLEL_CONFIG, "shelljob", "--parallel", "all", "--pretty", "-j", "2"])
+
+
+def test_parallel_all_matrix_denied(top_dir, capfd):
+    with pytest.raises(SystemExit) as err:
+        run(["-c", PARALLEL_CONFIG, "matrixjob", "--parallel", "all"])
+    assert err.value.code == 1
+    _, stderr = capfd.readouterr()
+    assert "only supports 'parallel: N'" in stderr
@@ -0,0 +1,85 @@
+"""
+Test the container runtime probe
+"""
+import os
+import subprocess
+import time
+
+import pytest
+
+from .. import runtimeprobe
+from ..helpers import has_docker
+
+
+@pytest.fixture(scope="function")
+def probe_cache(temp_folder, monkeypatch):
+    monkeypatch.setenv("GLE_CACHE_DIR", str(temp_folder))
+    runtimeprobe.forget_runtime_info()
+    yield temp_folder
+    runtimeprobe.forget_runtime_info()
+
+
+def test_probe_once(probe_cache, mocker):
+    check_output = mocker.patch("subprocess.check_output", return_value="24.0.7|linux|\n")
+    info = runtimeprobe.get_runtime_info()
+    assert info.present
+    assert info.server_version == "24.0.7"
+    assert info.os_type == "linux"
+    assert not info.is_windows_hyperv
+    assert has_docker()
+    assert has_docker("docker")
+    assert check_output.call_count == 1
+
+    # another process re-uses the result saved on disk
+    runtimeprobe._probed.clear()
+    assert runtimeprobe.get_runtime_info().server_version == "24.0.7"
+    assert check_output.call_count == 1
+
+    # until it expires
+    runtimeprobe._probed.clear()
+    mocker.patch("time.time", return_value=time.time() + runtimeprobe.RUNTIME_PROBE_TTL + 1)
+    assert runtimeprobe.get_runtime_info().present
+    assert check_output.call_count == 2
+
+
+def test_probe_docker_cli(probe_cache, mocker):
+    def fake_docker(cmdline, **kwargs):
+        if cmdline[0] == "podman":
+            if "--format" in cmdline:
+                raise subprocess.CalledProcessError(1, cmdline)
+            return b"host: ..."
+        if cmdline[0] == "hyperdocker":
+            return "20.10|windows|hyperv"
+        raise FileNotFoundError(cmdline[0])
+
+    mocker.patch("subprocess.check_output", side_effect=fake_docker)
+    assert not has_docker()
+    podman = runtimeprobe.get_runtime_info("podman")
+    assert podman.present
+    assert podman.server_version == ""
+    assert runtimeprobe.get_runtime_info("hyperdocker").is_windows_hyperv
+
+
+def test_probe_per_engine(probe_cache, mocker, monkeypatch):
+    engines = {"unix:///var/run/docker.sock": "24.0.7|linux|\n", "tcp://builder:2376": "25.0.1|linux|\n"}
+
+    def fake_docker(cmdline, **kwargs):
+        host = os.environ.get("DOCKER_HOST", "")
+        if host not in engines:
+            raise subprocess.CalledProcessError(1, cmdline)
+        return engines[host]
+
+    check_output = mocker.patch("subprocess.check_output", side_effect=fake_docker)
+    monkeypatch.setenv("DOCKER_HOST", "unix:///var/run/docker.sock")
+    assert runtimeprobe.get_runtime_info().server_version == "24.0.7"
+    monkeypatch.setenv("DOCKER_HOST", "tcp://builder:2376")
+    runtimeprobe._probed.clear()
+    assert runtimeprobe.get_runtime_info().server_version == "25.0.1"
+    assert check_output.call_count == 2
+
+    # a failed probe is not saved for other processes
+    monkeypatch.setenv("DOCKER_HOST", "tcp://stopped:2376")
+    assert not runtimeprobe.get_runtime_info().present
+    runtimeprobe._probed.clear()
+    engines["tcp://stopped:2376"] = "26.0.0|linux|\n"
+    assert runtimeprobe.get_runtime_info().present
@@ -0,0 +1,197 @@
+"""
+Test running a job and the jobs it needs with the dag executor
+"""
+import threading
+import time
+
+import pytest
+
+from .. import configloader, scheduler
+from ..runner import run
+
+
+def load_dag() -> dict:
+    loader = configloader.Loader()
+    loader.load("dag.yml")
+    return loader.config
+
+
+@pytest.mark.usefixtures("in_tests")
+def test_dag_order():
+    started = []
+    lock = threading.Lock()
+
+    def runjob(job):
+        with lock:
+            started.append(job.name)
+        if job.name == "lint":
+            time.sleep(0.2)
+
+    executor = scheduler.DagExecutor(load_dag(), "test", runjob, max_jobs=4)
+    assert executor.run()
+    assert set(started[:2]) == {"build", "lint"}
+    assert started[-1] == "test"
+    assert executor.order == ["build", "lint", "test"]
+    assert all(x.state == scheduler.JOB_SUCCESS for x in executor.jobs.values())
+
+
+@pytest.mark.usefixtures("in_tests")
+def test_dag_parallel():
+    barrier = threading.Barrier(2, timeout=5)
+
+    def runjob(job):
+        if job.name in ["build", "lint"]:
+            # both jobs must be running at the same time to get past here
+            barrier.wait()
+
+    executor = scheduler.DagExecutor(load_dag(), "test", runjob, max_jobs=2)
+    assert executor.run()
+
+
+@pytest.mark.parametrize("keep_going", [False, True])
+@pytest.mark.usefixtures("in_tests")
+def test_dag_failure(keep_going: bool):
+    ran = []
+
+    def runjob(job):
+        if job.name == "docs":
+            raise SystemExit(1)
+        ran.append(job.name)
+
+    executor = scheduler.DagExecutor(load_dag(), "package", runjob, keep_going=keep_going)
+    assert not executor.run()
+    assert executor.jobs["docs"].state == scheduler.JOB_FAILED
+    assert executor.jobs["package"].state == scheduler.JOB_NOT_RUN
+    if keep_going:
+        assert ran == ["build", "lint", "test"]
+    else:
+        assert "test" not in ran
+        assert executor.jobs["test"].state == scheduler.JOB_NOT_RUN
+    summary = executor.summary().splitlines()
+    assert summary[0].split() == ["job", "state", "duration"]
+    assert any(line.split()[:2] == ["docs", "failed"] for line in summary)
+
+
+def test_dag_cycle(temp_folder):
+    loader = configloader.Loader()
+    config = temp_folder / ".gitlab-ci.yml"
+    config.write_text("one:\n  script: [echo]\n  needs: [two]\n"
+                      "two:\n  script: [echo]\n  needs: [three]\n"
+                      "three:\n  script: [echo]\n")
+    loader.load(str(config))
+    # make a cycle that the loader would normally refuse
+    loader.config["three"]["needs"] = ["one"]
+    executor = scheduler.DagExecutor(loader.config, "one", lambda job: None)
+    with pytest.raises(scheduler.GitlabEmulatorError) as err:
+        executor.load()
+    assert "one -> two -> three -> one" in str(err.value)
+
+
+def test_prefixed_output(capsys):
+    import sys
+    lock = threading.Lock()
+    output = scheduler.PrefixedOutput("[job] ", sys.stdout, lock)
+    output.write("hello\nwor")
+    output.write("ld\npartial")
+    output.flush()
+    stdout, _ = capsys.readouterr()
+    assert stdout == "[job] hello\n[job] world\n[job] partial\n"
+
+
+@pytest.mark.usefixtures("in_tests")
+@pytest.mark.usefixtures("posix_only")
+def test_full_jobs(capfd):
+    run(["--full", "test", "-c", "dag.yml", "-j", "2", "--ignore-docker"])
+    stdout, stderr = capfd.readouterr()
+    assert "[build] build-done" in stdout
+    assert "[lint ] lint-done" in stdout
+    assert "[test ] test" in stdout
+    assert "build  success" in stderr
+
+
+@pytest.mark.usefixtures("in_tests")
+@pytest.mark.usefixtures("posix_only")
+def test_full_keep_going(capfd):
+    with pytest.raises(SystemExit):
+        run(["--full", "package", "-c", "dag.yml", "--keep-going", "--ignore-docker"])
+    stdout, stderr = capfd.readouterr()
+    assert "docs-start" in stdout
+    assert "test\n" in stdout
+    assert "package" not in stdout
+    assert "package  not run" in stderr
+
+
+def load_pipeline() -> configloader.Loader:
+    loader = configloader.Loader()
+    loader.load("pipeline-local.yml")
+    return loader
+
+
+@pytest.mark.usefixtures("in_tests")
+def test_pipeline_stages():
+    started = []
+    lock = threading.Lock()
+    early_started = threading.Event()
+
+    def runjob(job):
+        with lock:
+            started.append(job.name)
+        if job.name == "early":
+            early_started.set()
+        if job.name == "b2":
+            # early only needs b1 so it starts before the build stage has finished
+            assert early_started.wait(5)
+        if job.name in ["t1", "t2"]:
+            raise SystemExit(1)
+
+    executor = scheduler.PipelineExecutor(load_pipeline(), runjob, max_jobs=4)
+    assert not executor.run()
+    states = {name: job.state for name, job in executor.jobs.items()}
+    assert states == {
+        "b1": scheduler.JOB_SUCCESS,
+        "b2": scheduler.JOB_SUCCESS,
+        "early": scheduler.JOB_SUCCESS,
+        "t1": scheduler.JOB_FAILED,
+        "t2": scheduler.JOB_ALLOWED_FAILURE,
+        "cleanup": scheduler.JOB_SUCCESS,
+        "deploy": scheduler.JOB_SKIPPED,
+        "manual": scheduler.JOB_SKIPPED,
+        "notify": scheduler.JOB_NOT_RUN,
+        "always": scheduler.JOB_SUCCESS,
+    }
+    assert started.index("t1") > started.index("b2")
+    assert started[-1] == "always"
+    assert executor.jobs["early"].needs == ["b1"]
+    assert executor.jobs["cleanup"].needs == ["b1", "b2", "early", "t1", "t2"]
+
+
+@pytest.mark.usefixtures("in_tests")
+def test_pipeline_success():
+    executor = scheduler.PipelineExecutor(load_pipeline(), lambda job: None)
+    assert executor.run()
+    assert executor.jobs["cleanup"].state == scheduler.JOB_SKIPPED
+    assert executor.jobs["notify"].state == scheduler.JOB_SUCCESS
+    assert executor.order.index("notify") > executor.order.index("t2")
+
+
+@pytest.mark.usefixtures("in_tests")
+@pytest.mark.usefixtures("posix_only")
+def test_pipeline_local(capfd):
+    with pytest.raises(SystemExit):
+        run(["--pipeline-local", "-c", "pipeline-local.yml", "-j", "3", "--ignore-docker"])
+    stdout, stderr = capfd.readouterr()
+    assert "t1 test\n" in stdout
+    assert "[deploy ]" not in stdout
+    assert "cleanup" in stdout
+    assert "always" in stdout
+    assert "deploy   deploy  skipped" in stderr
+    assert "notify   deploy  not run" in stderr
+    assert "pipeline failed" in stderr
+
+
+@pytest.mark.usefixtures("in_tests")
+def test_pipeline_local_job_denied(capfd):
+    with pytest.raises(SystemExit):
+        run(["--pipeline-local", "-c", "pipeline-local.yml", "b1"])
+    _, stderr = capfd.readouterr()
+    assert "do not give a JOB" in stderr
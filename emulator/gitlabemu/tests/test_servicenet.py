@@ -0,0 +1,71 @@
+"""
+Test the per-job docker service networks
+"""
+import ipaddress
+import os
+
+import pytest
+
+from .. import servicenet
+from ..docker import DockerToolFailed
+from ..errors import GitlabEmulatorError
+from ..servicenet import ServiceNetwork, create_service_network, remove_leftover_networks, subnet_candidates
+
+
+def test_subnet_candidates():
+    subnets = subnet_candidates("192.168.94.0/23")
+    assert len(subnets) == 8
+    assert sorted(subnets, key=ipaddress.ip_network)[0] == "192.168.94.0/26"
+    assert all(ipaddress.ip_network(x).prefixlen == servicenet.SERVICE_SUBNET_PREFIX for x in subnets)
+    assert subnet_candidates("10.1.2.0/28") == ["10.1.2.0/28"]
+    with pytest.raises(GitlabEmulatorError):
+        subnet_candidates("10.1.2")
+
+
+def test_create_network(mocker, monkeypatch):
+    tool = mocker.Mock()
+    network = create_service_network(tool)
+    assert network.name.startswith(f"gle-network-{os.getpid()}-")
+    tool.create_network.assert_called_once_with(network.name, None)
+    assert network.refs == 1
+
+    # find a subnet that no other network is using
+    monkeypatch.setenv(servicenet.SUBNET_POOL_ENV, "172.30.0.0/25")
+    tool.create_network.reset_mock()
+    tool.create_network.side_effect = [DockerToolFailed("create", "", "Pool overlaps with other one"), None]
+    network = create_service_network(tool)
+    assert tool.create_network.call_count == 2
+    assert network.subnet in ["172.30.0.0/26", "172.30.0.64/26"]
+    assert network.subnet == tool.create_network.call_args.args[1]
+
+    tool.create_network.side_effect = DockerToolFailed("create", "", "Pool overlaps with other one")
+    with pytest.raises(GitlabEmulatorError):
+        create_service_network(tool)
+    tool.create_network.side_effect = DockerToolFailed("create", "", "permission denied")
+    with pytest.raises(DockerToolFailed):
+        create_service_network(tool)
+
+
+def test_network_refs(mocker, monkeypatch):
+    monkeypatch.setattr("time.sleep", lambda x: None)
+    tool = mocker.Mock()
+    network = ServiceNetwork(tool, "gle-network-1-abc")
+    for _ in range(3):
+        network.acquire()
+    network.release()
+    network.release()
+    tool.remove_network.assert_not_called()
+
+    # the last container is still leaving the network
+    tool.remove_network.side_effect = [DockerToolFailed("rm", "", "network has active endpoints"), None]
+    network.release()
+    assert tool.remove_network.call_count == 2
+
+
+def test_remove_leftover_networks(mocker):
+    tool = mocker.Mock()
+    mine = f"gle-network-{os.getpid()}-abcdefg"
+    tool.networks = ["bridge", "gle-service-network", "gle-network-999999999-abcdefg", mine, "gle-my-own-net"]
+    remove_leftover_networks(tool)
+    removed = [x.args[0] for x in tool.remove_network.call_args_list]
+    assert removed == ["gle-service-network", "gle-network-999999999-abcdefg"]
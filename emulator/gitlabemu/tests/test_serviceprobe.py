@@ -0,0 +1,200 @@
+"""
+Test starting docker services and waiting for them to be ready
+"""
+import socket
+import threading
+import time
+
+import pytest
+
+from .. import serviceprobe
+from ..docker import DockerJob, DockerTool, DockerToolFailed, docker_services, wait_for_service_teardown
+from ..errors import GitlabEmulatorError
+from ..serviceprobe import parse_readiness, wait_until_ready
+
+
+@pytest.fixture(scope="function", autouse=True)
+def fast_poll(monkeypatch):
+    monkeypatch.setattr(serviceprobe, "SERVICE_POLL_INTERVAL", 0.01)
+
+
+def running(**kwargs) -> dict:
+    state = {"Running": True}
+    state.update(kwargs)
+    return {"State": state, "NetworkSettings": {"Networks": {"net": {"IPAddress": "127.0.0.1"}}}}
+
+
+def test_parse_readiness():
+    probe = parse_readiness({})
+    assert probe.kind == serviceprobe.PROBE_HEALTH
+    assert probe.timeout == serviceprobe.DEFAULT_SERVICE_TIMEOUT
+    probe = parse_readiness({"GLE_SERVICE_READY": "tcp:5432", "GLE_SERVICE_TIMEOUT": "90"})
+    assert str(probe) == "tcp:5432"
+    assert probe.timeout == 90
+    assert parse_readiness({"GLE_SERVICE_READY": "log:ready to accept: \\d+"}).arg == "ready to accept: \\d+"
+    assert parse_readiness({"GLE_SERVICE_READY": "none"}).kind == serviceprobe.PROBE_NONE
+
+    for bad in ["http:80", "tcp", "tcp:postgres", "log:", "log:(unclosed"]:
+        with pytest.raises(GitlabEmulatorError):
+            parse_readiness({"GLE_SERVICE_READY": bad})
+    with pytest.raises(GitlabEmulatorError):
+        parse_readiness({"GLE_SERVICE_TIMEOUT": "soon"})
+
+
+def test_wait_health(mocker):
+    tool = mocker.Mock()
+    tool.container_inspect.side_effect = [running(Health={"Status": "starting"})] * 3 + \
+        [running(Health={"Status": "healthy"})]
+    assert wait_until_ready(tool, "c1", parse_readiness({}))
+    assert tool.container_inspect.call_count == 4
+
+    # no healthcheck in the image
+    tool.container_inspect.side_effect = None
+    tool.container_inspect.return_value = running()
+    assert wait_until_ready(tool, "c1", parse_readiness({}))
+
+    # the service stopped
+    tool.container_inspect.return_value = {"State": {"Running": False}}
+    assert not wait_until_ready(tool, "c1", parse_readiness({}))
+    tool.container_inspect.side_effect = DockerToolFailed("gone", "", "No such container")
+    assert not wait_until_ready(tool, "c1", parse_readiness({}))
+
+
+SOCKET_TABLE = """\
+  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 00000000:1538 00000000:0000 0A 00000000:00000000 00:00000000 00000000   999        0 1 1 0 100 0 0 10 0
+   1: 0100007F:0CEA 0100007F:1538 01 00000000:00000000 00:00000000 00000000     0        0 2 1 0 20 4 30 10 -1
+"""
+
+
+def test_listening_ports():
+    assert serviceprobe.listening_ports(SOCKET_TABLE) == {5432}
+    assert serviceprobe.listening_ports("") == set()
+
+
+def test_wait_tcp_inside(mocker):
+    tool = mocker.Mock()
+    tool.container_inspect.return_value = running()
+    tool.container_exec.side_effect = [SOCKET_TABLE.replace(" 0A ", " 07 ")] * 2 + [SOCKET_TABLE]
+    assert wait_until_ready(tool, "c1", parse_readiness({"GLE_SERVICE_READY": "tcp:5432"}), "net")
+    assert tool.container_exec.call_count == 3
+    assert tool.container_exec.call_args[0] == ("c1", serviceprobe.SOCKET_TABLE_COMMAND)
+
+    # no shell in the service and the network cannot be reached, use the healthcheck
+    mocker.patch.object(serviceprobe, "is_linux", return_value=False)
+    tool.container_exec.side_effect = DockerToolFailed("exec failed", "", "executable file not found")
+    tool.container_inspect.return_value = running(Health={"Status": "healthy"})
+    assert wait_until_ready(tool, "c1", parse_readiness({"GLE_SERVICE_READY": "tcp:5432"}), "net")
+
+
+def test_wait_tcp(mocker):
+    tool = mocker.Mock()
+    tool.container_inspect.return_value = running()
+    # the service has no shell, so connect to it from here
+    tool.container_exec.side_effect = DockerToolFailed("exec failed", "", "executable file not found")
+    mocker.patch.object(serviceprobe, "is_linux", return_value=True)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    port = server.getsockname()[1]
+    probe = parse_readiness({"GLE_SERVICE_READY": f"tcp:{port}", "GLE_SERVICE_TIMEOUT": "0.2"})
+    try:
+        assert not wait_until_ready(tool, "c1", probe, "net")
+        server.listen(1)
+        assert wait_until_ready(tool, "c1", probe, "net")
+    finally:
+        server.close()
+
+
+def test_wait_log(mocker):
+    tool = mocker.Mock()
+    tool.container_inspect.return_value = running()
+    tool.container_logs.side_effect = ["starting\n", "starting\nlistening on port 9000\n"]
+    assert wait_until_ready(tool, "c1", parse_readiness({"GLE_SERVICE_READY": "log:listening on port \\d+"}))
+    assert tool.container_logs.call_count == 2
+
+    tool.container_logs.side_effect = None
+    tool.container_logs.return_value = "starting\n"
+    start = time.monotonic()
+    probe = parse_readiness({"GLE_SERVICE_READY": "log:listening", "GLE_SERVICE_TIMEOUT": "0.1"})
+    assert not wait_until_ready(tool, "c1", probe)
+    assert time.monotonic() - start < 1
+
+
+def test_services_start_together(mocker):
+    killed = []
+    pulled = []
+
+    def slow_pull(image):
+        time.sleep(0.5)
+        pulled.append(image)
+
+    def kill(container, signal=None):
+        time.sleep(0.5)
+        killed.append(container)
+
+    mocker.patch.object(DockerTool, "create_network")
+    mocker.patch.object(DockerTool, "remove_network")
+    mocker.patch.object(DockerTool, "pull_image", side_effect=slow_pull)
+    run_service = mocker.patch.object(DockerTool, "run_service", side_effect=lambda image, *args: f"id-{image}")
+    mocker.patch.object(DockerTool, "connect_network")
+    mocker.patch.object(DockerTool, "kill_container", side_effect=kill)
+    mocker.patch.object(DockerTool, "container_inspect", return_value=running())
+
+    job = DockerJob()
+    job.name = "services"
+    job.services = ["postgres:16",
+                    {"name": "redis:7", "variables": {"GLE_SERVICE_READY": "none"}},
+                    {"name": "minio/minio", "alias": "s3", "variables": {"MINIO_ROOT_USER": "admin"}}]
+    start = time.monotonic()
+    with docker_services(job, {"CI_JOB_NAME": "services"}) as network:
+        assert network
+        assert sorted(pulled) == ["minio/minio", "postgres:16", "redis:7"]
+        # the pulls happened at the same time
+        assert time.monotonic() - start < 1.2
+    # removing the services does not hold up the job
+    assert time.monotonic() - start < 1.2
+    envs = {x.args[0]: x.args[1] for x in run_service.call_args_list}
+    assert envs["minio/minio"] == {"CI_JOB_NAME": "services", "MINIO_ROOT_USER": "admin"}
+    assert envs["redis:7"]["CI_JOB_NAME"] == "services"
+
+    wait_for_service_teardown()
+    assert sorted(killed) == ["id-minio/minio", "id-postgres:16", "id-redis:7"]
+    assert not [x for x in threading.enumerate() if x.name == "services-services"]
+
+
+def test_service_start_fails(mocker):
+    killed = []
+
+    def run_service(image, *args):
+        if image == "broken":
+            raise DockerToolFailed("run failed", "", "no such image")
+        return f"id-{image}"
+
+    mocker.patch.object(DockerTool, "create_network")
+    mocker.patch.object(DockerTool, "remove_network")
+    mocker.patch.object(DockerTool, "pull_image")
+    mocker.patch.object(DockerTool, "run_service", side_effect=run_service)
+    mocker.patch.object(DockerTool, "connect_network")
+    mocker.patch.object(DockerTool, "kill_container", side_effect=lambda x, y=None: killed.append(x))
+    mocker.patch.object(DockerTool, "container_inspect", return_value=running())
+
+    job = DockerJob()
+    job.services = ["redis:7", "broken"]
+    with pytest.raises(DockerToolFailed):
+        with docker_services(job, {}):
+            pass  # pragma: no cover
+    wait_for_service_teardown()
+    # the service that did start is removed
+    assert killed == ["id-redis:7"]
+
+
+def test_pull_job_image_in_background(mocker):
+    pull = mocker.patch.object(DockerTool, "pull", side_effect=lambda: time.sleep(0.2))
+    job = DockerJob()
+    job.docker.image = "alpine:3.18"
+    job.start_pulling_image()
+    # start_container() waits for the pull that is already running
+    job.pull_image()
+    assert pull.call_count == 1
+    job.pull_image()
+    assert pull.call_count == 2
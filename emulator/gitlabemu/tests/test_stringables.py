@@ -1,6 +1,6 @@
 import os.path
 from io import StringIO
-from ..yamlloader import ordered_load, ordered_dump
+from ..yamlloader import ordered_load, ordered_dump, GitlabReference
 
 HERE = os.path.abspath(os.path.dirname(__file__))
 
@@ -17,3 +17,23 @@ def test_yaml_roundtrips():
 
     reloaded = ordered_load(buf)
     assert reloaded == loaded
+
+
+def plain(value):
+    """Convert loaded yaml into comparable builtin types, retaining key order"""
+    if isinstance(value, dict):
+        return [(type(value).__name__, key, plain(item)) for key, item in value.items()]
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    if isinstance(value, GitlabReference):
+        return repr(value), value.location.line, value.location.column
+    return value
+
+
+def test_yaml_pure_loader_identical():
+    for filename in ["test-services.yaml", "references.yaml", "test_extends.yaml", "test-inherit.yaml"]:
+        with open(os.path.join(HERE, filename), "rb") as fd:
+            content = fd.read()
+        fast = ordered_load(content)
+        pure = ordered_load(content, pure=True)
+        assert plain(fast) == plain(pure)
@@ -0,0 +1,107 @@
+"""
+Test the job timeout supervisor and aborting jobs
+"""
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from .. import aiorunner
+from ..docker import DockerJob
+from ..jobs import Job
+from ..supervisor import get_supervisor
+
+
+def test_deadlines_fire_in_order():
+    supervisor = get_supervisor()
+    fired = {}
+    done = threading.Event()
+    start = time.monotonic()
+    deadlines = {}
+    tokens = {}
+    for index in range(30):
+        deadline = start + 0.1 + (index % 10) * 0.03
+        deadlines[index] = deadline
+
+        def callback(index=index):
+            fired[index] = time.monotonic()
+            if len(fired) == 20:
+                done.set()
+
+        tokens[index] = supervisor.watch(deadline, callback)
+    # these jobs finish in time
+    for index in range(20, 30):
+        supervisor.unwatch(tokens[index])
+
+    assert done.wait(5)
+    time.sleep(0.2)
+    assert sorted(fired) == list(range(20))
+    for index, when in fired.items():
+        assert when >= deadlines[index] - 0.002
+        assert when - deadlines[index] < 0.1
+    assert len(supervisor) == 0
+    assert supervisor.timer is None
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_job_unwatched_when_done(tmp_path: Path):
+    job = Job()
+    job.name = "quick"
+    job.workspace = str(tmp_path)
+    job.timeout_seconds = 60
+    job.script = ["true"]
+    job.run()
+    assert not job.timed_out
+    assert len(get_supervisor()) == 0
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_job_timeout_kills_children(tmp_path: Path, monkeypatch):
+    monkeypatch.setenv(aiorunner.ABORT_GRACE_ENV, "0.5")
+    job = Job()
+    job.name = "stubborn"
+    job.workspace = str(tmp_path)
+    job.timeout_seconds = 0.5
+    # the sleep is a child of the script shell and ignores SIGTERM
+    job.script = ["sh -c 'trap \"\" TERM; sleep 60'"]
+    started = time.monotonic()
+    with pytest.raises(SystemExit):
+        job.run()
+    assert job.timed_out
+    assert time.monotonic() - started < 10
+
+
+def test_abort_grace(monkeypatch):
+    assert aiorunner.get_abort_grace() == aiorunner.DEFAULT_ABORT_GRACE
+    monkeypatch.setenv(aiorunner.ABORT_GRACE_ENV, "2.5")
+    assert aiorunner.get_abort_grace() == 2.5
+    monkeypatch.setenv(aiorunner.ABORT_GRACE_ENV, "-1")
+    assert aiorunner.get_abort_grace() == 0
+    monkeypatch.setenv(aiorunner.ABORT_GRACE_ENV, "never")
+    assert aiorunner.get_abort_grace() == aiorunner.DEFAULT_ABORT_GRACE
+
+
+@pytest.mark.usefixtures("posix_only")
+def test_docker_abort_escalates(mocker, monkeypatch):
+    monkeypatch.setenv(aiorunner.ABORT_GRACE_ENV, "0.2")
+    job = DockerJob()
+    job.name = "container"
+    job.container = "gle-container-1-abc"
+    job.docker.container = "c1"
+    check_call = mocker.patch.object(job.docker, "check_call")
+    kill = mocker.patch.object(job.docker, "kill")
+    job.script_process = mocker.Mock()
+    job.script_process.poll.return_value = None
+    job.abort()
+    assert check_call.call_args.args[1] == ["sh", "-c", "kill -TERM -1"]
+    assert check_call.call_args.kwargs["user"] == "0"
+    job.script_process.wait.assert_called_once_with(timeout=0.2)
+    kill.assert_called_once()
+
+    # no grace, just kill the container
+    monkeypatch.setenv(aiorunner.ABORT_GRACE_ENV, "0")
+    check_call.reset_mock()
+    job.abort()
+    check_call.assert_not_called()
+    assert kill.call_count == 2
@@ -54,3 +54,29 @@ def test_default_context(tmp_path):
     os.environ["GLE_CONFIG"] = str(tmp_path / "foo.yml")
     ctx = userconfig.get_current_user_context()
     assert ctx == "emulator"
+
+
+def test_cached_context(tmp_path, mocker):
+    cfg_file = tmp_path / "gle.yml"
+    cfg_file.write_text("emulator:\n  docker:\n    privileged: true\n")
+    os.environ["GLE_CONFIG"] = str(cfg_file)
+    load = mocker.spy(userconfig, "get_user_config")
+    ctx = userconfig.get_user_config_context()
+    assert ctx.docker.privileged
+    assert userconfig.get_user_config_context() is ctx
+    assert load.call_count == 1
+
+    # a changed file is loaded again
+    cfg_file.write_text("emulator:\n  docker:\n    privileged: false\n")
+    ctx = userconfig.get_user_config_context()
+    assert not ctx.docker.privileged
+    assert load.call_count == 2
+
+    # so is a change of context
+    os.environ["GLE_CONTEXT"] = "emulator"
+    userconfig.get_user_config_context()
+    assert load.call_count == 3
+
+    userconfig.invalidate_user_config()
+    assert userconfig.get_user_config_context() is not ctx
+    assert load.call_count == 4
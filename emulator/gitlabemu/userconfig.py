@@ -1,11 +1,17 @@
 import os
-from typing import Optional
+import threading
+from typing import Optional, Tuple, Any
 from .userconfigdata import UserConfigFile, UserContext
 from .logmsg import fatal
 
 USER_CFG_ENV = "GLE_CONFIG"
 USER_CFG_DIR = os.environ.get("LOCALAPPDATA", os.environ.get("HOME", os.getcwd()))
 USER_CFG_DEFAULT = os.path.join(USER_CFG_DIR, ".gle", "emulator.yml")
+USER_CTX_ENV = "GLE_CONTEXT"
+
+_cached_config: Optional[UserConfigFile] = None
+_cached_key: Optional[Tuple[Any, ...]] = None
+_cache_lock = threading.Lock()
 
 
 def get_user_config_path() -> str:
@@ -23,16 +29,49 @@ def get_user_config(filename: Optional[str] = None) -> UserConfigFile:
     return config
 
 
+def user_config_key(filename: str) -> Tuple[Any, ...]:
+    """Get a value that changes if the config file or the selected context changes"""
+    try:
+        st = os.stat(filename)
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+    except OSError:
+        stamp = None
+    return os.path.abspath(filename), stamp, os.environ.get(USER_CTX_ENV, None)
+
+
+def get_cached_user_config() -> UserConfigFile:
+    """
+    Get the user config, only loading the file again if it has changed.
+    The returned object is shared, use get_user_config() to get a copy to modify and save.
+    """
+    global _cached_config, _cached_key
+    filename = get_user_config_path()
+    key = user_config_key(filename)
+    with _cache_lock:
+        if _cached_config is None or key != _cached_key:
+            _cached_config = get_user_config(filename)
+            _cached_key = key
+        return _cached_config
+
+
+def invalidate_user_config() -> None:
+    """Forget the cached user config, eg after saving changes to it"""
+    global _cached_config, _cached_key
+    with _cache_lock:
+        _cached_config = None
+        _cached_key = None
+
+
 def get_user_config_context() -> UserContext:
-    cfg = get_user_config()
+    cfg = get_cached_user_config()
     return cfg.contexts[cfg.current_context]
 
 
 def get_current_user_context() -> str:
     """Get the currently set context name"""
-    current_context = os.getenv("GLE_CONTEXT", None)
+    current_context = os.getenv(USER_CTX_ENV, None)
     if current_context == "current_context":
         fatal("'current_context' is not allowed for GLE_CONFIG")
     if current_context is None:
-        current_context = get_user_config().current_context
+        current_context = get_cached_user_config().current_context
     return current_context
@@ -15,6 +15,7 @@ FORBIDDEN_CONTEXT_NAMES = [
 ]
 DEFAULT_GITLAB_VERSION = "15.7"
 DEFAULT_DOCKER_CLI = "docker"
+DEFAULT_POOL_TTL = 300
 
 EXECUTOR_SHELL = "shell"
 EXECUTOR_DOCKER = "docker"
@@ -181,14 +182,16 @@ class DockerConfiguration(VariablesConfiguration, VolumesMixin):
         self.docker_cli = DEFAULT_DOCKER_CLI
         super(DockerConfiguration, self).__init__()
         self.volumes = []
+        self.pool_size = 0
+        self.pool_ttl = DEFAULT_POOL_TTL
 
     @property
     def yaml_keys(self) -> List[str]:
-        return super().yaml_keys + ["volumes", "privileged", "docker_cli"]
+        return super().yaml_keys + ["volumes", "privileged", "docker_cli", "pool_size", "pool_ttl"]
 
     def populate(self, data: dict):
         super(DockerConfiguration, self).populate(data)
-        self.setattrs_from_dict(data, "volumes", "privileged", "docker_cli")
+        self.setattrs_from_dict(data, "volumes", "privileged", "docker_cli", "pool_size", "pool_ttl")
         # validate the volumes
         self.validate()
         return self
@@ -280,7 +283,7 @@ class UserContext(VariablesConfiguration):
 
     def builtin_runners(self) -> List["GleRunnerConfig"]:
         ret = []
-        if has_docker():
+        if has_docker(self.docker.docker_cli):
             builtin_docker = GleRunnerConfig()
             builtin_docker.name = "default-docker"
             builtin_docker.is_builtin = True
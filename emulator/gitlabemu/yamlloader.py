@@ -2,7 +2,7 @@
 Preserve order of keys
 """
 import json
-from typing import List
+from typing import List, Optional
 
 import yaml
 from collections import OrderedDict
@@ -38,7 +38,15 @@ class GitlabReference:
         return repr(self) + f" at {self.location}"
 
 
-class OrderedLoader(yaml.FullLoader):
+try:
+    from yaml import CSafeLoader as _FastLoader
+except ImportError:  # pragma: no cover
+    # pyyaml was built without libyaml
+    _FastLoader = None
+
+
+class OrderedLoader(yaml.SafeLoader):
+    """Pure python loader that returns ordered mappings and understands !reference"""
     def __init__(self, stream, firstpass=None):
         super(OrderedLoader, self).__init__(stream)
         if firstpass is None:
@@ -62,22 +70,46 @@ def reference_constructor(loader: OrderedLoader, node):
     return reference
 
 
-yaml.add_constructor(u"!reference", reference_constructor)
-
-
-def ordered_load(stream, preloaded=None):
-
-    def construct_mapping(loader, node):
-        loader.flatten_mapping(node)
-        return StringableOrderedDict(loader.construct_pairs(node))
+def construct_mapping(loader, node):
+    loader.flatten_mapping(node)
+    return StringableOrderedDict(loader.construct_pairs(node))
 
-    OrderedLoader.add_constructor(BaseResolver.DEFAULT_MAPPING_TAG, construct_mapping)
 
-    def context_loader(*kwargs):
-        ret = OrderedLoader(*kwargs, preloaded)
-        return ret
-
-    return yaml.load(stream, context_loader)
+yaml.add_constructor(u"!reference", reference_constructor)
+OrderedLoader.add_constructor(u"!reference", reference_constructor)
+OrderedLoader.add_constructor(BaseResolver.DEFAULT_MAPPING_TAG, construct_mapping)
+
+if _FastLoader is not None:
+    class COrderedLoader(_FastLoader):
+        """libyaml accelerated version of OrderedLoader"""
+        def __init__(self, stream, firstpass=None):
+            super(COrderedLoader, self).__init__(stream)
+            if firstpass is None:
+                firstpass = StringableOrderedDict()
+            self.first_pass = firstpass
+
+    COrderedLoader.add_constructor(u"!reference", reference_constructor)
+    COrderedLoader.add_constructor(BaseResolver.DEFAULT_MAPPING_TAG, construct_mapping)
+else:  # pragma: no cover
+    COrderedLoader = None
+
+
+def get_loader_class(pure: Optional[bool] = False) -> type:
+    """Get the fastest available ordered loader, or the pure python one if pure is set"""
+    if pure or COrderedLoader is None:
+        return OrderedLoader
+    return COrderedLoader
+
+
+def ordered_load(stream, preloaded=None, pure: Optional[bool] = False):
+    """
+    Parse a yaml document, mappings are loaded as ordered dicts
+    :param stream: yaml text or a file object
+    :param preloaded: unused, retained for compatibility
+    :param pure: if True, do not use libyaml
+    :return:
+    """
+    return yaml.load(stream, Loader=get_loader_class(pure))
 
 
 def ordered_dump(data, **kwargs):